@@ -1,12 +1,32 @@
-﻿import json
+﻿import argparse
+import json
 import math
 import os
 import random
-import uuid
+import sys
+import time
+from collections import OrderedDict
 
 
+import bmesh
 import bpy
+import numpy as np
 from bpy_extras.object_utils import world_to_camera_view
+from mathutils import Matrix, Vector
+from mathutils.bvhtree import BVHTree
+
+# blender does not add the script folder to the path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+import annotation_log  # noqa: E402
+import cache_manifest  # noqa: E402
+import hdri_versions  # noqa: E402
+import image_encoder  # noqa: E402
+import masks  # noqa: E402
+import telemetry as telemetry_module  # noqa: E402
+import work_queue  # noqa: E402
+from annotation_log import derive_seed, load_finished_seeds, sample_file_name  # noqa: E402
+from projection import (  # noqa: E402
+    bounding_box_from_projection, frame_projection_matrix, project_points)
 
 SAMPLES_NUMBER = 10
 X_RES = 640
@@ -14,25 +34,205 @@ Y_RES = 480
 BACKGROUND_SAMPLES = int(SAMPLES_NUMBER*0.25)
 IS_OCLUSSION_ENABLE = True
 BACKGROUND_PATH = './backgrounds'
+# downsampled versions of the backgrounds, see preprocess_backgrounds.py
+BACKGROUND_CACHE_PATH = './backgrounds/cache'
 MODELS_PATH = "./models"
+# preprocessed models, see preprocess_models.py
+MODEL_CACHE_PATH = './models/cache'
+MODEL_SCALE = 0.066
 RENDERS_PATH = './renders'
+# append-only log, export it to bb.json with utils/annotation_log.py
+ANNOTATIONS_PATH = 'annotations.jsonl'
 USE_GPU = True
 CYCLES = 128
 ENGINE = 'CYCLES'
 # ENGINE = 'BLENDER_EEVEE_NEXT'
-
+# compare the numpy projection against the per-vertex one on every sample
+VERIFY_PROJECTION = False
+# 'raycast' estimates the visible surface with BVH ray casts,
+# 'bbox' uses the overlap of the 2D bounding boxes
+OCCLUSION_METHOD = 'raycast'
+# number of rays cast for every visibility estimate
+VISIBILITY_RAYS = 256
+MAX_OCCLUSION = 0.55
+MIN_OCCLUSION = 0.0
+# candidate poses sampled by the planner for each sample
+PLANNER_CANDIDATES = 64
+# samples planned together, PLANNER_CANDIDATES each
+PLANNER_BATCH = 64
+# new candidates drawn for a sample before giving up on it
+MAX_PLANNER_ATTEMPTS = 20
+# smallest side of the target box (normalized 0-1)
+MIN_BOX_SIZE = 0.02
+# fraction of the unclamped target box that has to be inside the frame
+MIN_IN_FRAME = 0.6
+OCCLUDER_SHAPES = ['plane', 'cube', 'sphere', 'cylinder']
+# memory budget for the background images kept loaded, in MB
+BACKGROUND_CACHE_MB = 2048
+# every sample seed derives from it, the same seed renders the same dataset
+RUN_SEED = 0
+# Cycles settings per quality tier, compare them with benchmark_quality.py.
+# An adaptive threshold of 0 turns adaptive sampling off.
+QUALITY_PROFILES = {
+    'draft': {
+        'samples': 16, 'adaptive_threshold': 0.1, 'denoise': True,
+        'max_bounces': 3, 'diffuse_bounces': 1, 'glossy_bounces': 1, 'transmission_bounces': 2,
+    },
+    'fast': {
+        'samples': 32, 'adaptive_threshold': 0.05, 'denoise': True,
+        'max_bounces': 4, 'diffuse_bounces': 2, 'glossy_bounces': 2, 'transmission_bounces': 4,
+    },
+    'balanced': {
+        'samples': 64, 'adaptive_threshold': 0.02, 'denoise': True,
+        'max_bounces': 8, 'diffuse_bounces': 3, 'glossy_bounces': 3, 'transmission_bounces': 6,
+    },
+    # the settings used before the profiles existed
+    'high': {
+        'samples': CYCLES, 'adaptive_threshold': 0.0, 'denoise': False,
+        'max_bounces': 12, 'diffuse_bounces': 4, 'glossy_bounces': 4, 'transmission_bounces': 12,
+    },
+    'reference': {
+        'samples': 2048, 'adaptive_threshold': 0.0, 'denoise': False,
+        'max_bounces': 12, 'diffuse_bounces': 4, 'glossy_bounces': 4, 'transmission_bounces': 12,
+    },
+}
+QUALITY = 'high'
+# samples keyframed on consecutive frames and rendered by one animation
+# render with persistent data, 0 renders every sample as a still
+BATCH_SIZE = 0
+# encode the images on background threads from the float render result
+# instead of writing them from the render, with an approximation of the
+# view transform
+ASYNC_ENCODE = False
+IMAGE_FORMAT = 'png'  # or 'webp'
+PNG_COMPRESSION = 6  # zlib level, 0-9
+# full object mask of every sample, rendered on an extra view layer
+# without the occluders, see setup_mask_output
+MASK_OUTPUT = False
+MODEL_PASS_INDEX = 1
+OCCLUDER_PASS_INDEX = 2
+# visible box, measured occlusion and instance mask of every sample from
+# the object index pass of the render, needs the masks, see collect_masks
+TIGHT_LABELS = False
+# models per render: the model of the task and MODELS_PER_IMAGE - 1 others
+# from the library placed around it, see compose_sample
+MODELS_PER_IMAGE = 1
+# pass index of the first of the other models, the next ones follow it
+COMPANION_PASS_INDEX = 3
+# placements tried at once for every other model
+COMPANION_CANDIDATES = 64
+# gap kept between the boxes of the models (normalized 0-1)
+COMPANION_MARGIN = 0.01
+
+
+def parse_args():
+    """
+    Arguments given after `--` on the blender command line, e.g.
+    blender -b --python auto_render.py -- --shard shards/worker-0.json
+    """
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+
+    # the scripts importing this module have their own flags, an abbreviation
+    # would take them, e.g. --model for --models-per-image
+    parser = argparse.ArgumentParser(prog='auto_render.py', allow_abbrev=False)
+    parser.add_argument(
+        '--shard', help='json file with the (model, sample range) tasks of this worker')
+    parser.add_argument(
+        '--queue', help='shared work queue directory to take the tasks from, see utils/work_queue.py')
+    parser.add_argument('--renders-path', default=RENDERS_PATH)
+    parser.add_argument('--annotations', default=ANNOTATIONS_PATH)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='render threads, 0 uses all the cores')
+    parser.add_argument('--cpu', action='store_true',
+                        help='render on the CPU even if USE_GPU is set')
+    parser.add_argument('--seed', type=int, default=RUN_SEED)
+    parser.add_argument('--quality', default=QUALITY,
+                        choices=list(QUALITY_PROFILES))
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--async-encode', action='store_true', default=ASYNC_ENCODE)
+    parser.add_argument('--image-format', default=IMAGE_FORMAT,
+                        choices=list(image_encoder.IMAGE_FORMATS))
+    parser.add_argument('--compression', type=int, default=PNG_COMPRESSION,
+                        help='PNG zlib level, 0-9')
+    parser.add_argument('--masks', action='store_true', default=MASK_OUTPUT,
+                        help='also write the object mask of every sample')
+    parser.add_argument('--tight-labels', action='store_true', default=TIGHT_LABELS,
+                        help='also record the visible box and occlusion from the rendered masks')
+    parser.add_argument('--models-per-image', type=int, default=MODELS_PER_IMAGE,
+                        help='models placed in every render, each with its own box')
+    parser.add_argument('--metrics', default=telemetry_module.METRICS_PATH,
+                        help='rolling metrics file in the Prometheus text format')
+    parser.add_argument('--telemetry-log', default=telemetry_module.TELEMETRY_LOG,
+                        help='per-sample stage timings and rejections')
+    parser.add_argument('--finished-log', action='append', default=[],
+                        help='other annotation logs whose samples are already rendered')
+
+    if __name__ == "__main__":
+        # a misspelled flag is an error instead of the default value
+        return parser.parse_args(argv)
+
+    # scripts importing this module have their own arguments
+    return parser.parse_known_args(argv)[0]
+
+
+def apply_quality_profile(scene, name):
+    profile = QUALITY_PROFILES[name]
+    cycles = scene.cycles
+
+    cycles.samples = profile['samples']
+    cycles.use_adaptive_sampling = profile['adaptive_threshold'] > 0
+    if cycles.use_adaptive_sampling:
+        cycles.adaptive_threshold = profile['adaptive_threshold']
+
+    cycles.use_denoising = profile['denoise']
+    if profile['denoise']:
+        cycles.denoiser = 'OPENIMAGEDENOISE'
+
+    cycles.max_bounces = profile['max_bounces']
+    cycles.diffuse_bounces = profile['diffuse_bounces']
+    cycles.glossy_bounces = profile['glossy_bounces']
+    cycles.transmission_bounces = profile['transmission_bounces']
+
+
+args = parse_args()
+RENDERS_PATH = args.renders_path
+ANNOTATIONS_PATH = args.annotations
+RUN_SEED = args.seed
+BATCH_SIZE = args.batch_size
+IMAGE_FORMAT = args.image_format
+TIGHT_LABELS = args.tight_labels
+# the occlusion is measured against the full mask of the model
+MASK_OUTPUT = args.masks or TIGHT_LABELS
+MODELS_PER_IMAGE = args.models_per_image
+MASKS_PATH = os.path.join(RENDERS_PATH, 'masks')
+os.makedirs(RENDERS_PATH, exist_ok=True)
+
+task_queue = None
+if args.queue:
+    task_queue = work_queue.WorkQueue(args.queue)
+    # the workers of every node share the queue, each writes its own log
+    ANNOTATIONS_PATH = task_queue.worker_path('annotations.jsonl')
+    RUN_SEED = task_queue.meta().get('seed', RUN_SEED)
 
 # set the proper engine
 bpy.context.scene.render.engine = ENGINE
-bpy.context.scene.cycles.device = 'GPU' if USE_GPU else 'CPU'
-bpy.context.scene.cycles.samples = CYCLES
+bpy.context.scene.cycles.device = 'GPU' if USE_GPU and not args.cpu else 'CPU'
+if args.threads:
+    # several workers on the same machine should not oversubscribe the cores
+    bpy.context.scene.render.threads_mode = 'FIXED'
+    bpy.context.scene.render.threads = args.threads
+apply_quality_profile(bpy.context.scene, args.quality)
 bpy.context.scene.render.resolution_x = X_RES
 bpy.context.scene.render.resolution_y = Y_RES
 bpy.context.scene.view_settings.look = 'AgX - High Contrast'
+bpy.context.scene.render.image_settings.file_format = IMAGE_FORMAT.upper()
+bpy.context.scene.render.image_settings.compression = round(
+    args.compression / 9 * 100)
 
 
-# load a random background
-backgrounds = os.listdir(BACKGROUND_PATH)
+# load a random background, listed in the same order on every machine so a
+# seed picks the same one
+backgrounds = sorted(os.listdir(BACKGROUND_PATH))
 filered_backgrounds = []
 
 for file in backgrounds:
@@ -56,11 +256,109 @@ for node in nodes:
 
 camera = bpy.context.scene.camera
 
+# loaded background images by path, least recently used first
+background_cache = OrderedDict()
+background_manifest = cache_manifest.read_manifest(BACKGROUND_CACHE_PATH)
+background_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# one hidden occluder per shape, reused by every sample of a model
+occluder_pool = {}
+
+# the other models of the current task, placed again on every sample
+companions = []
+
+# per-model geometry computed once and reused on every sample, keyed by
+# object name
+geometry_cache = {}
+
+
+def get_vertex_coordinates(obj):
+    """
+    Reads the mesh vertex coordinates (object space) into a (N, 3) numpy array
+    using foreach_get, without creating a Python object per vertex.
+    """
+    vertices = obj.data.vertices
+    coordinates = np.empty(len(vertices) * 3, dtype=np.float32)
+    vertices.foreach_get('co', coordinates)
+
+    return coordinates.reshape(-1, 3)
+
+
+def get_camera_projection_matrix(scene, cam):
+    """
+    Builds a 4x4 matrix that maps world coordinates to the same space as
+    world_to_camera_view, see projection.frame_projection_matrix.
+    """
+    camera_data = cam.data
+    frame = [corner[:] for corner in camera_data.view_frame(scene=scene)]
+    world_to_camera = np.array(cam.matrix_world.normalized().inverted())
+
+    return frame_projection_matrix(frame, camera_data.type == 'ORTHO') @ world_to_camera
+
+
+def precompute_projection_hull(obj):
+    """
+    Stores the convex hull vertices of the object (object space) in
+    geometry_cache. Duplicated and interior vertices can never be the
+    extremes of the projection, so only the hull needs to be projected for
+    every sample.
+
+    Must run after the origin is set, since that changes the mesh
+    coordinates.
+    """
+    points = np.unique(get_vertex_coordinates(obj), axis=0)
+
+    hull_mesh = bpy.data.meshes.new("ProjectionHull")
+    hull_mesh.vertices.add(len(points))
+    hull_mesh.vertices.foreach_set('co', points.ravel())
+
+    bm = bmesh.new()
+    bm.from_mesh(hull_mesh)
+    bpy.data.meshes.remove(hull_mesh)
+
+    try:
+        result = bmesh.ops.convex_hull(bm, input=bm.verts[:])
+        hull_points = np.array([
+            element.co[:] for element in result['geom']
+            if isinstance(element, bmesh.types.BMVert)
+        ], dtype=np.float32)
+    except RuntimeError:
+        # flat or degenerated meshes, keep all the unique vertices
+        hull_points = points
+    finally:
+        bm.free()
+
+    if len(hull_points) == 0:
+        hull_points = points
+
+    geometry_cache.setdefault(obj.name, {})['hull'] = hull_points
+    print(
+        f"Projection hull for {obj.name}: {len(hull_points)} of {len(obj.data.vertices)} vertices.")
+
+    return hull_points
+
+
+def get_projection_points(obj):
+    """
+    Returns the cached hull points of the object, or all of its vertices if
+    there is no hull for it (e.g. the occluders).
+    """
+    cached = geometry_cache.get(obj.name)
+    if cached is not None and 'hull' in cached:
+        return cached['hull']
+
+    return get_vertex_coordinates(obj)
+
 
 def get_2d_bounding_box(obj, scene, cam):
     """
     Calculates the 2D bounding box and area of an object.
 
+    All the points are projected at once with numpy, it returns the same
+    values as get_2d_bounding_box_per_vertex. When the object has a cached
+    projection hull only the hull is projected, which gives the same box as
+    long as the object is entirely in front of the camera.
+
     Returns a dictionary {
         'min_x': (normalized 0-1),
         'max_x': (normalized 0-1),
@@ -69,6 +367,20 @@ def get_2d_bounding_box(obj, scene, cam):
     }
     or None if the object is not visible.
     """
+    points = get_projection_points(obj)
+    projection_matrix = get_camera_projection_matrix(scene, cam)
+    x_values, y_values, depth = project_points(
+        points, obj.matrix_world, projection_matrix)
+
+    return bounding_box_from_projection(x_values, y_values, depth)
+
+
+def get_2d_bounding_box_per_vertex(obj, scene, cam):
+    """
+    Reference implementation of get_2d_bounding_box, projects one vertex at a
+    time with world_to_camera_view. Slow on dense meshes, kept to validate the
+    numpy path (see VERIFY_PROJECTION).
+    """
 
     mesh_vertices = [v.co for v in obj.data.vertices]
     matrix_world = obj.matrix_world
@@ -116,6 +428,23 @@ def get_2d_bounding_box(obj, scene, cam):
     }
 
 
+def verify_projection(obj, scene, cam, tolerance=1e-4):
+    """
+    Checks that the numpy projection matches the per-vertex one.
+    """
+    fast_bb = get_2d_bounding_box(obj, scene, cam)
+    reference_bb = get_2d_bounding_box_per_vertex(obj, scene, cam)
+
+    if fast_bb is None or reference_bb is None:
+        assert fast_bb is None and reference_bb is None, \
+            f"Projection mismatch for {obj.name}: {fast_bb} != {reference_bb}"
+        return
+
+    for key, value in reference_bb.items():
+        assert abs(fast_bb[key] - value) <= tolerance, \
+            f"Projection mismatch for {obj.name} on {key}: {fast_bb[key]} != {value}"
+
+
 def denormalize_coord(x1, x2, y1, y2):
     """"
     Denormalize the bounding box coordinates from (0-1) to pixel values based
@@ -165,6 +494,134 @@ def calculate_occlusion(target, occluder, cam, scene):
     # world nodes
 
 
+def precompute_visibility_samples(obj, count=VISIBILITY_RAYS):
+    """
+    Stores a BVH tree of the object and `count` random points on its
+    surface (object space, area weighted) in geometry_cache, so the
+    visibility estimate does not rebuild them on every sample.
+    """
+    mesh = obj.data
+    mesh.calc_loop_triangles()
+
+    triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('vertices', triangles)
+    triangles = triangles.reshape(-1, 3)
+
+    vertices = get_vertex_coordinates(obj)
+    a = vertices[triangles[:, 0]]
+    b = vertices[triangles[:, 1]]
+    c = vertices[triangles[:, 2]]
+    areas = np.linalg.norm(np.cross(b - a, c - a), axis=1).astype(np.float64)
+
+    # the same samples whether the model comes from the cache or not
+    rng = np.random.default_rng(derive_seed(RUN_SEED, obj.get('model_key', obj.name), 'surface'))
+    chosen = rng.choice(len(triangles), size=count, p=areas / areas.sum())
+
+    # uniform barycentric coordinates
+    u = rng.random(count)
+    v = rng.random(count)
+    flip = u + v > 1
+    u[flip] = 1 - u[flip]
+    v[flip] = 1 - v[flip]
+
+    surface_points = a[chosen] + \
+        (b[chosen] - a[chosen]) * u[:, None] + \
+        (c[chosen] - a[chosen]) * v[:, None]
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    cached = geometry_cache.setdefault(obj.name, {})
+    cached['bvh'] = BVHTree.FromObject(obj, depsgraph)
+    cached['surface_points'] = surface_points
+
+
+def get_bvh_tree(obj):
+    """
+    Returns the cached BVH tree (object space) of the object, or builds a new
+    one for objects that change between samples (e.g. the occluders).
+    """
+    cached = geometry_cache.get(obj.name)
+    if cached is not None and 'bvh' in cached:
+        return cached['bvh']
+
+    return BVHTree.FromObject(obj, bpy.context.evaluated_depsgraph_get())
+
+
+def is_ray_blocked(tree, matrix_world_inverted, origin, target):
+    """
+    Checks if anything in the tree is between origin and target, both in
+    world space. The ray is cast in the object space of the tree.
+    """
+    local_origin = matrix_world_inverted @ origin
+    local_target = matrix_world_inverted @ target
+    direction = local_target - local_origin
+    distance = direction.length
+
+    # stop a little before the target so it does not hit its own surface
+    location, _, _, _ = tree.ray_cast(
+        local_origin, direction.normalized(), distance * (1 - 1e-4))
+
+    return location is not None
+
+
+def estimate_visibility(target, occluder, cam, scene, ray_budget=VISIBILITY_RAYS):
+    """
+    Estimates which fraction of the target is visible through the occluder,
+    casting at most `ray_budget` rays from the camera to sampled points on
+    the target surface.
+
+    Only the points inside the frame that are not hidden by the target itself
+    are considered, so the result is the share of the visible surface that
+    the occluder does not cover.
+
+    Returns a tuple (visible_fraction, elapsed_seconds), the visible fraction
+    is between 0.0 (fully occluded) and 1.0 (not occluded).
+    """
+    start = time.perf_counter()
+
+    cached = geometry_cache.get(target.name)
+    if cached is None or 'surface_points' not in cached:
+        precompute_visibility_samples(target, ray_budget)
+        cached = geometry_cache[target.name]
+
+    points = cached['surface_points'][:ray_budget]
+
+    # keep only the points that land inside the frame
+    projection_matrix = get_camera_projection_matrix(scene, cam)
+    x_values, y_values, depth = project_points(
+        points, target.matrix_world, projection_matrix)
+    in_frame = (depth > 0) & (x_values >= 0) & (x_values <= 1) & \
+        (y_values >= 0) & (y_values <= 1)
+
+    matrix_world = np.asarray(target.matrix_world)
+    world_points = points[in_frame] @ matrix_world[:3, :3].T + \
+        matrix_world[:3, 3]
+
+    camera_location = cam.matrix_world.translation
+    target_tree = get_bvh_tree(target)
+    target_inverted = target.matrix_world.inverted()
+    occluder_tree = get_bvh_tree(occluder)
+    occluder_inverted = occluder.matrix_world.inverted()
+
+    surface_visible = 0
+    not_occluded = 0
+
+    for world_point in world_points:
+        world_point = Vector(world_point)
+
+        # the point is on the back side or behind another part of the target
+        if is_ray_blocked(target_tree, target_inverted, camera_location, world_point):
+            continue
+
+        surface_visible += 1
+
+        if not is_ray_blocked(occluder_tree, occluder_inverted, camera_location, world_point):
+            not_occluded += 1
+
+    visible_fraction = not_occluded / surface_visible if surface_visible else 0.0
+
+    return visible_fraction, time.perf_counter() - start
+
+
 def set_obj_to_origin(obj):
     bpy.context.view_layer.objects.active = obj
     bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='BOUNDS')
@@ -172,8 +629,66 @@ def set_obj_to_origin(obj):
     obj.rotation_euler = (0, 0, 0)
 
 
-def create_random_occluder():
-    shape = random.choice(['plane', 'cube', 'sphere', 'cylinder'])
+def normalize_model(obj, scale=MODEL_SCALE):
+    """
+    Same result as set_obj_to_origin plus the scaling, but applied to the
+    mesh itself without operators: the bounds center goes to the origin and
+    the scale is baked in, so the object keeps an identity transform.
+    """
+    coordinates = get_vertex_coordinates(obj)
+    center = (coordinates.min(axis=0) + coordinates.max(axis=0)) / 2
+
+    obj.data.transform(Matrix.Scale(scale, 4) @ Matrix.Translation(-Vector(center)))
+    obj.data.update()
+
+    obj.location = (0, 0, 0)
+    obj.rotation_euler = (0, 0, 0)
+    obj.scale = (1, 1, 1)
+
+
+def load_cached_model(model):
+    """
+    Appends the preprocessed object of the model from the cache library,
+    with its projection hull. Returns None if the model is not in the cache
+    or the source file changed since it was preprocessed.
+    """
+    entry = cache_manifest.read_manifest(MODEL_CACHE_PATH).get(model)
+    if entry is None:
+        return None
+
+    source = os.stat(os.path.join(MODELS_PATH, model))
+    if entry['size'] != source.st_size or entry['mtime'] != source.st_mtime:
+        print(f"{model} changed since it was preprocessed, loading the source file.")
+        return None
+
+    library_path = os.path.join(MODEL_CACHE_PATH, 'library.blend')
+    # appended and not linked, the material values change on every sample
+    with bpy.data.libraries.load(library_path, link=False) as (data_from, data_to):
+        data_to.objects = [entry['object']]
+
+    active_model = data_to.objects[0]
+    scene.collection.objects.link(active_model)
+
+    geometry_cache.setdefault(active_model.name, {})['hull'] = np.array(
+        active_model.data['projection_hull'], dtype=np.float32).reshape(-1, 3)
+
+    return active_model
+
+
+def get_occluder_collection():
+    collection = bpy.data.collections.get('Occluders')
+    if collection is None:
+        collection = bpy.data.collections.new('Occluders')
+        scene.collection.children.link(collection)
+
+    return collection
+
+
+def create_occluder(shape):
+    """
+    Creates an hidden occluder object of the given shape, with its own
+    material and a Track To constraint pointing it to the camera.
+    """
     if shape == 'plane':
         bpy.ops.mesh.primitive_plane_add(size=1)
     elif shape == 'cube':
@@ -183,13 +698,56 @@ def create_random_occluder():
     elif shape == 'cylinder':
         bpy.ops.mesh.primitive_cylinder_add(radius=1, depth=0.5)
     occluder = bpy.context.active_object
-    occluder.name = "Occluder"
+    occluder.name = f"Occluder-{shape}"
+    occluder.hide_render = True
+    occluder.pass_index = OCCLUDER_PASS_INDEX
+
+    # in their own collection, the mask view layer excludes it
+    for collection in occluder.users_collection:
+        collection.objects.unlink(occluder)
+    get_occluder_collection().objects.link(occluder)
 
-    mat_occ = bpy.data.materials.new(name="OccluderMaterial")
+    mat_occ = bpy.data.materials.new(name=f"OccluderMaterial-{shape}")
     occluder.data.materials.append(mat_occ)
     mat_occ.use_nodes = True
-    shader_occ = mat_occ.node_tree.nodes.get("Principled BSDF")
 
+    track_to = occluder.constraints.new(type='TRACK_TO')
+    track_to.target = camera
+    track_to.track_axis = 'TRACK_NEGATIVE_Z'
+    track_to.up_axis = 'UP_Y'
+
+    # the mesh never changes, only the object transform
+    mesh = occluder.data
+    geometry_cache[occluder.name] = {
+        'bvh': BVHTree.FromPolygons(
+            [v.co.copy() for v in mesh.vertices],
+            [p.vertices[:] for p in mesh.polygons]
+        )
+    }
+
+    return occluder
+
+
+def create_occluder_pool():
+    """
+    Builds one occluder per shape, they are reused by every sample of the
+    model instead of creating and removing objects each time.
+    """
+    for shape in OCCLUDER_SHAPES:
+        occluder_pool[shape] = create_occluder(shape)
+
+
+def show_occluder(shape):
+    """
+    Makes the occluder of the given shape the only visible one and
+    randomizes its material.
+    """
+    hide_occluders()
+    occluder = occluder_pool[shape]
+    occluder.hide_render = False
+
+    shader_occ = occluder.data.materials[0].node_tree.nodes.get(
+        "Principled BSDF")
     shader_occ.inputs["Base Color"].default_value = (
         random.random(), random.random(), random.random(), 1)
     shader_occ.inputs["Roughness"].default_value = random.uniform(
@@ -198,51 +756,125 @@ def create_random_occluder():
     return occluder
 
 
-def remove_occluder():
-    objs = bpy.data.objects
-    objs.remove(objs["Occluder"], do_unlink=True)
+def hide_occluders():
+    for occluder in occluder_pool.values():
+        occluder.hide_render = True
 
 
-def camera_positioning():
-    # random camera position
-    # 1. Pick random spherical coordinates
-    # ideally the more furthest distance would rely in the object size,
-    # but for the arms shots it's not
-    trashhold_camera_distance = 100
-    min_camera_distance = max_dimension * 3
-    max_calculated_distance = max_dimension * 30
-    max_camera_distance = max_calculated_distance if max_calculated_distance < trashhold_camera_distance else trashhold_camera_distance
+def remove_occluder_pool():
+    """
+    Removes the pooled occluders with their meshes and materials, so nothing
+    is left behind between models.
+    """
+    for occluder in occluder_pool.values():
+        mesh = occluder.data
+        materials = [mat for mat in mesh.materials if mat is not None]
 
-    distance = random.uniform(
-        min_camera_distance,
-        max_camera_distance
-    )
+        geometry_cache.pop(occluder.name, None)
+        bpy.data.objects.remove(occluder, do_unlink=True)
+        bpy.data.meshes.remove(mesh)
+        for mat in materials:
+            bpy.data.materials.remove(mat)
 
+    occluder_pool.clear()
+
+
+def camera_positioning(pose):
+    """
+    Places the camera at the position chosen by the pose planner.
+    """
     # make sure that the obj always show in the render
-    bpy.data.cameras["Camera"].clip_end = distance + 20
+    bpy.data.cameras["Camera"].clip_end = pose['distance'] + 20
 
-    # Horizontal angle (0-360 deg)
-    phi = random.uniform(0, 2 * math.pi)
-    # Vertical angle (10-80 deg)
-    theta = random.uniform(math.radians(10), math.radians(80))
+    camera.location = pose['camera_location']
+    camera.data.shift_x = pose['shift_x']
+    camera.data.shift_y = pose['shift_y']
 
-    # 2. Convert spherical to (X, Y, Z) for Blender
-    cam_x = distance * math.sin(theta) * math.cos(phi)
-    cam_y = distance * math.sin(theta) * math.sin(phi)
-    cam_z = distance * math.cos(theta)
 
-    # 3. Set the camera's location
-    camera.location = (cam_x, cam_y, cam_z)
-    camera.data.shift_x = random.uniform(-0.3, 0.3)
-    camera.data.shift_y = random.uniform(-0.3, 0.3)
+def get_image_memory(img):
+    """
+    Estimated memory used by the image pixels, in bytes.
+    """
+    width, height = img.size
+    bytes_per_channel = 4 if img.is_float else 1
 
+    return width * height * img.channels * bytes_per_channel
 
-def setup_background_and_randomization(background_node, shader_node):
-    # load random background
-    img_path = os.path.join(
-        BACKGROUND_PATH, random.choice(filered_backgrounds))
-    img = bpy.data.images.load(img_path)
-    env_texture_node.image = img
+
+def background_version(img_path):
+    """
+    Path of the smallest preprocessed version of the background that still
+    has a texel per rendered pixel with the camera and the resolution of
+    the scene, or the background itself if there is none or it changed
+    since it was preprocessed.
+    """
+    entry = background_manifest.get(os.path.basename(img_path))
+    if entry is None:
+        return img_path
+
+    source = os.stat(img_path)
+    if entry['size'] != source.st_size or entry['mtime'] != source.st_mtime:
+        print(f"{img_path} changed since it was preprocessed, loading the source file.")
+        return img_path
+
+    width = hdri_versions.version_width(
+        scene.render.resolution_x, scene.render.resolution_y,
+        camera.data.lens, camera.data.sensor_width)
+    version = hdri_versions.pick_version(entry, width)
+
+    return os.path.join(BACKGROUND_CACHE_PATH, version) if version else img_path
+
+
+def load_background_image(img_path):
+    """
+    Returns the background image from the cache, loading it on a miss.
+    The least recently used images are removed from bpy.data once the
+    cache goes over BACKGROUND_CACHE_MB.
+    """
+    img = background_cache.get(img_path)
+    if img is not None:
+        background_cache.move_to_end(img_path)
+        background_cache_stats['hits'] += 1
+        return img
+
+    background_cache_stats['misses'] += 1
+    img = bpy.data.images.load(background_version(img_path))
+    background_cache[img_path] = img
+
+    budget = BACKGROUND_CACHE_MB * 1024 * 1024
+    # never evict the image that was just loaded
+    while len(background_cache) > 1 and \
+            sum(get_image_memory(cached) for cached in background_cache.values()) > budget:
+        _, evicted = background_cache.popitem(last=False)
+        bpy.data.images.remove(evicted)
+        background_cache_stats['evictions'] += 1
+
+    return img
+
+
+def background_cache_summary():
+    stats = background_cache_stats
+    total = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / total if total else 0.0
+    memory = sum(get_image_memory(img) for img in background_cache.values())
+
+    return (f"Background cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({hit_rate:.0%}), {stats['evictions']} evictions, "
+            f"{len(background_cache)} images, {memory / 1024 / 1024:.0f} MB")
+
+
+def pick_background(seed):
+    """
+    Background of the sample, drawn from its own generator so it can be
+    known before the sample is prepared (batches group samples by image).
+    """
+    background_random = random.Random(derive_seed(seed, 'background'))
+
+    return os.path.join(BACKGROUND_PATH, background_random.choice(filered_backgrounds))
+
+
+def setup_background_and_randomization(background_node, shader_node, img_path):
+    env_texture_node.image = load_background_image(img_path)
 
     # light randomization
     background_node.inputs['Strength'].default_value = random.uniform(
@@ -254,44 +886,354 @@ def setup_background_and_randomization(background_node, shader_node):
         0.3, 0.5)
 
 
-def jitter_camera_occluder_position(occluder):
-    t = random.uniform(0.2, 0.4)
-    base_point_on_line = camera.location * t
+def jitter_camera_occluder_position(occluder, pose):
+    """
+    Places the occluder between the camera and the model, the jittered
+    position is chosen by the pose planner.
+    """
+    occluder.location = pose['occluder_location']
+
+
+def get_occluder_shape_points(shape):
+    """
+    Vertices of the occluder primitives as created by create_occluder,
+    used by the pose planner to project the occluders without creating them.
+    """
+    if shape == 'plane':
+        corners = [-0.5, 0.5]
+        return np.array([(x, y, 0) for x in corners for y in corners])
+
+    if shape == 'cube':
+        corners = [-0.5, 0.5]
+        return np.array([(x, y, z) for x in corners for y in corners for z in corners])
+
+    if shape == 'sphere':
+        # primitive_uv_sphere_add defaults: 32 segments and 16 rings
+        segments = np.linspace(0, 2 * math.pi, 32, endpoint=False)
+        rings = np.linspace(0, math.pi, 17)[1:-1]
+        segment_grid, ring_grid = np.meshgrid(segments, rings)
+        points = np.stack([
+            np.sin(ring_grid) * np.cos(segment_grid),
+            np.sin(ring_grid) * np.sin(segment_grid),
+            np.cos(ring_grid),
+        ], axis=-1).reshape(-1, 3)
+        return np.vstack([points, [(0, 0, 1), (0, 0, -1)]])
+
+    if shape == 'cylinder':
+        # primitive_cylinder_add defaults: 32 vertices
+        angles = np.linspace(0, 2 * math.pi, 32, endpoint=False)
+        circle = np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+        return np.vstack([
+            np.column_stack([circle, np.full(32, depth)])
+            for depth in (-0.25, 0.25)
+        ])
+
+    raise ValueError(f"Unknown occluder shape: {shape}")
+
+
+def euler_to_matrices(rotations):
+    """
+    Converts (N, 3) XYZ euler angles into (N, 3, 3) rotation matrices, the
+    same convention as Object.rotation_euler.
+    """
+    cos_x, cos_y, cos_z = np.cos(rotations).T
+    sin_x, sin_y, sin_z = np.sin(rotations).T
+
+    matrices = np.empty((len(rotations), 3, 3))
+    matrices[:, 0, 0] = cos_y * cos_z
+    matrices[:, 0, 1] = sin_x * sin_y * cos_z - cos_x * sin_z
+    matrices[:, 0, 2] = cos_x * sin_y * cos_z + sin_x * sin_z
+    matrices[:, 1, 0] = cos_y * sin_z
+    matrices[:, 1, 1] = sin_x * sin_y * sin_z + cos_x * cos_z
+    matrices[:, 1, 2] = cos_x * sin_y * sin_z - sin_x * cos_z
+    matrices[:, 2, 0] = -sin_y
+    matrices[:, 2, 1] = sin_x * cos_y
+    matrices[:, 2, 2] = cos_x * cos_y
+
+    return matrices
+
+
+def track_to_matrices(locations, targets):
+    """
+    Rotation matrices (N, 3, 3) of a Track To constraint with
+    TRACK_NEGATIVE_Z and UP_Y, pointing every location to its target.
+    The columns are the right, up and backward axes.
+    """
+    backward = locations - targets
+    backward /= np.linalg.norm(backward, axis=1, keepdims=True)
 
-    cam_right_vec = camera.matrix_world.col[0].xyz
-    cam_up_vec = camera.matrix_world.col[1].xyz
+    right = np.cross([0.0, 0.0, 1.0], backward)
+    right /= np.linalg.norm(right, axis=1, keepdims=True)
+    up = np.cross(backward, right)
 
-    jitter_x_amount = random.uniform(-max_dimension *
-                                     0.7, max_dimension * 0.7)
-    jitter_y_amount = random.uniform(-max_dimension *
-                                     0.7, max_dimension * 0.7)
+    return np.stack([right, up, backward], axis=-1)
 
-    occluder.location = base_point_on_line + \
-        (cam_right_vec * jitter_x_amount) + \
-        (cam_up_vec * jitter_y_amount)
 
+def get_camera_frame(scene, cam):
+    """
+    Frame of the camera without shift, plus how much one unit of
+    shift_x/shift_y moves it. Used to project the candidate poses without
+    touching the scene.
+    """
+    camera_data = cam.data
+    shift_x, shift_y = camera_data.shift_x, camera_data.shift_y
 
-def load_and_merge_previous_data(new_data):
-    prev_data = []
-    try:
-        with open("bb.json", 'r') as f:
-            prev_data = json.load(f)
-            if not isinstance(prev_data, list):
-                prev_data = []
+    camera_data.shift_x, camera_data.shift_y = 0.0, 0.0
+    frame = camera_data.view_frame(scene=scene)
+    camera_data.shift_x, camera_data.shift_y = 1.0, 1.0
+    shifted_frame = camera_data.view_frame(scene=scene)
+    camera_data.shift_x, camera_data.shift_y = shift_x, shift_y
+
+    return {
+        'distance': -frame[0].z,
+        'min_x': frame[2].x,
+        'min_y': frame[1].y,
+        'width': frame[1].x - frame[2].x,
+        'height': frame[0].y - frame[1].y,
+        'shift_unit_x': shifted_frame[2].x - frame[2].x,
+        'shift_unit_y': shifted_frame[1].y - frame[1].y,
+    }
+
+
+def project_candidates(points, rotations, locations, camera_rotations,
+                       camera_locations, frame, shift_x, shift_y):
+    """
+    Projects the same object space points for every candidate pose at once.
+
+    points: (P, 3) or per candidate (N, P, 3), already scaled
+    rotations: (N, 3, 3) object rotations, locations: (N, 3)
+    camera_rotations: (N, 3, 3), camera_locations: (N, 3)
+
+    Returns normalized x, y and the depth, each of shape (N, P).
+    """
+    world = points @ rotations.transpose(0, 2, 1) + locations[:, None, :]
+    local = np.einsum('npi,nij->npj',
+                      world - camera_locations[:, None, :], camera_rotations)
 
-        print(f"Loaded {len(prev_data)} previous bounding boxes.")
+    depth = -local[..., 2]
+    safe_depth = np.where(depth > 0, depth, 1)
 
-    except (FileNotFoundError, json.JSONDecodeError):
-        # This block runs if the file doesn't exist OR is empty/corrupted
-        print("bb.json not found or is empty. Starting a new one.")
-        prev_data = []
+    min_x = frame['min_x'] + shift_x * frame['shift_unit_x']
+    min_y = frame['min_y'] + shift_y * frame['shift_unit_y']
 
-    # --- The rest of your code is fine ---
-    print(f"Adding {len(export_json)} new bounding boxes.")
-    export_json.extend(prev_data)
+    x_values = (local[..., 0] * frame['distance'] / safe_depth -
+                min_x[:, None]) / frame['width']
+    y_values = (local[..., 1] * frame['distance'] / safe_depth -
+                min_y[:, None]) / frame['height']
 
-    with open('bb.json', 'w') as f:
-        json.dump(export_json, f, indent=4)  # Added indent=4 for readability
+    return x_values, y_values, depth
+
+
+def sample_pose_candidates(rng, count, max_dimension):
+    """
+    Draws `count` random camera, model and occluder poses, with the same
+    distributions the per-sample randomization used.
+    """
+    # ideally the more furthest distance would rely in the object size,
+    # but for the arms shots it's not
+    trashhold_camera_distance = 100
+    min_camera_distance = max_dimension * 3
+    max_camera_distance = min(max_dimension * 30, trashhold_camera_distance)
+
+    distance = rng.uniform(min_camera_distance, max_camera_distance, count)
+    # Horizontal angle (0-360 deg)
+    phi = rng.uniform(0, 2 * math.pi, count)
+    # Vertical angle (10-80 deg)
+    theta = rng.uniform(math.radians(10), math.radians(80), count)
+
+    camera_locations = np.column_stack([
+        distance * np.sin(theta) * np.cos(phi),
+        distance * np.sin(theta) * np.sin(phi),
+        distance * np.cos(theta),
+    ])
+
+    has_occluder = np.zeros(count, dtype=bool)
+    if IS_OCLUSSION_ENABLE:
+        has_occluder = rng.uniform(0, 1, count) > 0.5
+
+    return {
+        'distance': distance,
+        'camera_location': camera_locations,
+        'shift_x': rng.uniform(-0.3, 0.3, count),
+        'shift_y': rng.uniform(-0.3, 0.3, count),
+        'rotation': rng.uniform(0, 2 * math.pi, (count, 3)),
+        'has_occluder': has_occluder,
+        'occluder_shape': rng.integers(0, len(OCCLUDER_SHAPES), count),
+        'occluder_t': rng.uniform(0.2, 0.4, count),
+        'occluder_jitter': rng.uniform(-max_dimension * 0.7, max_dimension * 0.7, (count, 2)),
+        'occluder_size': max_dimension * rng.uniform(0.2, 0.7, count),
+    }
+
+
+def plan_poses(model, max_dimension, scene, cam, sample_seeds, candidates=PLANNER_CANDIDATES):
+    """
+    Samples candidate poses in bulk and projects the cached geometry of the
+    model (and of the occluder primitives) analytically, without touching
+    the scene.
+
+    Candidates are rejected when the target box is smaller than MIN_BOX_SIZE,
+    less than MIN_IN_FRAME of it is inside the frame, or the estimated
+    occlusion is outside MIN_OCCLUSION-MAX_OCCLUSION. The occlusion is the
+    share of the target surface samples that fall in the occluder box, the
+    ray cast check still runs once the pose is applied.
+
+    sample_seeds maps the sample index to its seed, every sample draws its
+    own `candidates` poses so the result of a sample does not depend on the
+    others. Returns a dictionary with the first accepted pose of every
+    sample, samples without one are left out.
+    """
+    sample_indices = list(sample_seeds)
+    blocks = [
+        sample_pose_candidates(
+            np.random.default_rng(sample_seeds[index]), candidates, max_dimension)
+        for index in sample_indices
+    ]
+    candidate = {key: np.concatenate([block[key] for block in blocks])
+                 for key in blocks[0]}
+    candidates = len(sample_indices) * candidates
+
+    scale = np.array(model.scale)
+    hull_points = get_projection_points(model)
+    cached = geometry_cache.get(model.name, {})
+    surface_points = cached.get('surface_points', hull_points) * scale
+    hull_points = hull_points * scale
+
+    frame = get_camera_frame(scene, cam)
+    model_locations = np.repeat(
+        np.array(model.location)[None, :], candidates, axis=0)
+    model_rotations = euler_to_matrices(candidate['rotation'])
+    camera_rotations = track_to_matrices(
+        candidate['camera_location'], model_locations)
+
+    # occluder between the camera and the model, jittered on the camera plane
+    occluder_locations = candidate['camera_location'] * candidate['occluder_t'][:, None] + \
+        camera_rotations[:, :, 0] * candidate['occluder_jitter'][:, :1] + \
+        camera_rotations[:, :, 1] * candidate['occluder_jitter'][:, 1:]
+    occluder_rotations = track_to_matrices(
+        occluder_locations, candidate['camera_location'])
+
+    box = np.zeros((candidates, 4))
+    in_frame = np.zeros(candidates)
+    occlusion = np.zeros(candidates)
+
+    # keep the (candidates, points, 3) arrays at a reasonable size
+    chunk = max(1, 2_000_000 // max(len(hull_points), len(surface_points)))
+
+    for start in range(0, candidates, chunk):
+        batch = slice(start, start + chunk)
+        projection_args = (
+            camera_rotations[batch],
+            candidate['camera_location'][batch],
+            frame,
+            candidate['shift_x'][batch],
+            candidate['shift_y'][batch],
+        )
+
+        x_values, y_values, depth = project_candidates(
+            hull_points, model_rotations[batch], model_locations[batch], *projection_args)
+        visible = depth > 0
+        min_x = np.where(visible, x_values, np.inf).min(axis=1)
+        max_x = np.where(visible, x_values, -np.inf).max(axis=1)
+        min_y = np.where(visible, y_values, np.inf).min(axis=1)
+        max_y = np.where(visible, y_values, -np.inf).max(axis=1)
+
+        clamped = np.column_stack([
+            np.clip(min_x, 0, 1), np.clip(max_x, 0, 1),
+            np.clip(min_y, 0, 1), np.clip(max_y, 0, 1),
+        ])
+        full_area = (max_x - min_x) * (max_y - min_y)
+        clamped_area = (clamped[:, 1] - clamped[:, 0]) * \
+            (clamped[:, 3] - clamped[:, 2])
+
+        box[batch] = clamped
+        with np.errstate(invalid='ignore', divide='ignore'):
+            in_frame[batch] = np.where(
+                full_area > 0, clamped_area / full_area, 0)
+
+        surface_x, surface_y, surface_depth = project_candidates(
+            surface_points, model_rotations[batch], model_locations[batch], *projection_args)
+        surface_in_frame = (surface_depth > 0) & \
+            (surface_x >= 0) & (surface_x <= 1) & \
+            (surface_y >= 0) & (surface_y <= 1)
+
+        for shape_index, shape in enumerate(OCCLUDER_SHAPES):
+            selected = np.flatnonzero(
+                candidate['has_occluder'][batch] &
+                (candidate['occluder_shape'][batch] == shape_index)
+            ) + start
+            if not len(selected):
+                continue
+
+            shape_points = get_occluder_shape_points(shape)
+            sizes = candidate['occluder_size'][selected]
+            scaled_points = shape_points[None, :, :] * np.column_stack(
+                [sizes, sizes, np.ones(len(selected))])[:, None, :]
+
+            occ_x, occ_y, occ_depth = project_candidates(
+                scaled_points,
+                occluder_rotations[selected],
+                occluder_locations[selected],
+                camera_rotations[selected],
+                candidate['camera_location'][selected],
+                frame,
+                candidate['shift_x'][selected],
+                candidate['shift_y'][selected],
+            )
+            occ_visible = occ_depth > 0
+            occ_min_x = np.where(occ_visible, occ_x, np.inf).min(axis=1)
+            occ_max_x = np.where(occ_visible, occ_x, -np.inf).max(axis=1)
+            occ_min_y = np.where(occ_visible, occ_y, np.inf).min(axis=1)
+            occ_max_y = np.where(occ_visible, occ_y, -np.inf).max(axis=1)
+
+            local = selected - start
+            covered = surface_in_frame[local] & \
+                (surface_x[local] >= occ_min_x[:, None]) & \
+                (surface_x[local] <= occ_max_x[:, None]) & \
+                (surface_y[local] >= occ_min_y[:, None]) & \
+                (surface_y[local] <= occ_max_y[:, None])
+            in_frame_count = surface_in_frame[local].sum(axis=1)
+            occlusion[selected] = np.where(
+                in_frame_count > 0, covered.sum(axis=1) / np.maximum(in_frame_count, 1), 1)
+
+    box_size = np.minimum(box[:, 1] - box[:, 0], box[:, 3] - box[:, 2])
+    accepted = (box_size >= MIN_BOX_SIZE) & (in_frame >= MIN_IN_FRAME) & \
+        (~candidate['has_occluder'] |
+         ((occlusion >= MIN_OCCLUSION) & (occlusion <= MAX_OCCLUSION)))
+
+    print(
+        f"Pose planner: {accepted.sum()} of {candidates} candidates accepted.")
+
+    poses = {}
+    accepted = accepted.reshape(len(sample_indices), -1)
+    for block, index in enumerate(sample_indices):
+        if not accepted[block].any():
+            continue
+
+        i = block * accepted.shape[1] + int(np.argmax(accepted[block]))
+        has_occluder = bool(candidate['has_occluder'][i])
+        poses[index] = {
+            'distance': float(candidate['distance'][i]),
+            'camera_location': tuple(candidate['camera_location'][i]),
+            'shift_x': float(candidate['shift_x'][i]),
+            'shift_y': float(candidate['shift_y'][i]),
+            'rotation': tuple(candidate['rotation'][i]),
+            'occluder_shape': OCCLUDER_SHAPES[candidate['occluder_shape'][i]] if has_occluder else None,
+            'occluder_location': tuple(occluder_locations[i]),
+            'occluder_size': float(candidate['occluder_size'][i]),
+            'planned_box': tuple(box[i]),
+            'planned_occlusion': float(occlusion[i]),
+        }
+
+    return poses
+
+
+def save_annotation(record):
+    """
+    Appends the record to the annotation log as soon as its render is
+    written, nothing is kept in memory until the end of the run.
+    """
+    annotation_log.append_records(ANNOTATIONS_PATH, [record])
+    annotations_written['count'] += 1
 
 
 background_node = nodes.new(type='ShaderNodeBackground')
@@ -310,14 +1252,235 @@ node_tree.links.new(
 node_tree.links.new(
     background_node.outputs['Background'], output_node.inputs['Surface'])
 
-# list that will be exported to json
-export_json = []
+annotations_written = {'count': 0}
 
-models = [f for f in os.listdir(MODELS_PATH) if f.endswith('.blend')]
-print(f"Found {len(models)} .blend files to process.")
 
-for model in models:
-    print(f"--- Processing file: {model} ---")
+def setup_viewer_node():
+    """
+    Links the render layer to a Viewer node, so the float pixels of every
+    render can be read from the 'Viewer Node' image.
+    """
+    scene.use_nodes = True
+    compositor_nodes = scene.node_tree.nodes
+    render_layers = compositor_nodes.get('Render Layers') or compositor_nodes.new(
+        type='CompositorNodeRLayers')
+    viewer = compositor_nodes.new(type='CompositorNodeViewer')
+    scene.node_tree.links.new(
+        render_layers.outputs['Image'], viewer.inputs['Image'])
+
+
+def read_render_pixels():
+    """
+    Flat RGBA float pixels of the last render, linear and before the view
+    transform, with the image width and height.
+    """
+    viewer_image = bpy.data.images['Viewer Node']
+    width, height = viewer_image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    viewer_image.pixels.foreach_get(pixels)
+
+    return pixels, width, height
+
+
+def add_mask_file_output(name, slot):
+    """
+    File output node writing 8-bit grayscale PNGs to MASKS_PATH without the
+    view transform, so the written values are the pass values.
+    """
+    mask_output = scene.node_tree.nodes.new(type='CompositorNodeOutputFile')
+    mask_output.name = name
+    mask_output.base_path = MASKS_PATH
+    mask_output.file_slots[0].path = slot
+    mask_output.format.file_format = 'PNG'
+    mask_output.format.color_mode = 'BW'
+    mask_output.format.color_depth = '8'
+    mask_output.format.color_management = 'OVERRIDE'
+    mask_output.format.view_settings.view_transform = 'Raw'
+    mask_output.format.view_settings.look = 'None'
+
+    return mask_output
+
+
+def setup_mask_output():
+    """
+    Adds a 'Masks' view layer without the occluders, rendered with a single
+    sample, whose object index pass gives the full mask of the model. The
+    compositor writes it to MASKS_PATH/frame_####.png, moved to the name of
+    the sample after the render.
+    """
+    os.makedirs(MASKS_PATH, exist_ok=True)
+
+    mask_layer = scene.view_layers.new('Masks')
+    mask_layer.samples = 1
+    mask_layer.use_pass_object_index = True
+    mask_layer.cycles.use_denoising = False
+    mask_layer.layer_collection.children[get_occluder_collection().name].exclude = True
+
+    scene.use_nodes = True
+    compositor_nodes = scene.node_tree.nodes
+    mask_layers = compositor_nodes.new(type='CompositorNodeRLayers')
+    mask_layers.name = 'Mask Layers'
+    mask_layers.layer = mask_layer.name
+
+    id_mask = compositor_nodes.new(type='CompositorNodeIDMask')
+    id_mask.index = MODEL_PASS_INDEX
+    id_mask.use_antialiasing = False
+
+    mask_output = add_mask_file_output('Mask Output', 'frame_')
+
+    scene.node_tree.links.new(
+        mask_layers.outputs['IndexOB'], id_mask.inputs['ID value'])
+    scene.node_tree.links.new(
+        id_mask.outputs['Alpha'], mask_output.inputs[0])
+
+
+def setup_instance_output():
+    """
+    Enables the object index pass of the main view layer, where the
+    occluders hide the models, and writes it to MASKS_PATH/instance_####.png
+    with the pass index as the pixel value: 0 for the background, the pass
+    index of every model for its visible pixels and OCCLUDER_PASS_INDEX for
+    the occluder. The pass of the 'Masks' layer, without the occluders, is
+    written the same way to amodal_####.png and only read to measure the
+    occlusion.
+    """
+    render_layer = scene.view_layers[0]
+    render_layer.use_pass_object_index = True
+
+    scene.use_nodes = True
+    compositor_nodes = scene.node_tree.nodes
+    render_layers = compositor_nodes.get('Render Layers') or compositor_nodes.new(
+        type='CompositorNodeRLayers')
+    render_layers.layer = render_layer.name
+
+    # the 8-bit file maps [0, 1] to [0, 255]
+    to_byte = compositor_nodes.new(type='CompositorNodeMath')
+    to_byte.operation = 'DIVIDE'
+    to_byte.inputs[1].default_value = 255
+
+    instance_output = add_mask_file_output('Instance Output', 'instance_')
+
+    scene.node_tree.links.new(
+        render_layers.outputs['IndexOB'], to_byte.inputs[0])
+    scene.node_tree.links.new(
+        to_byte.outputs['Value'], instance_output.inputs[0])
+
+    amodal_to_byte = compositor_nodes.new(type='CompositorNodeMath')
+    amodal_to_byte.operation = 'DIVIDE'
+    amodal_to_byte.inputs[1].default_value = 255
+
+    amodal_output = add_mask_file_output('Amodal Output', 'amodal_')
+
+    scene.node_tree.links.new(
+        compositor_nodes['Mask Layers'].outputs['IndexOB'], amodal_to_byte.inputs[0])
+    scene.node_tree.links.new(
+        amodal_to_byte.outputs['Value'], amodal_output.inputs[0])
+
+
+def read_mask_image(path):
+    """
+    (height, width) uint8 values of an 8-bit grayscale mask, first row at
+    the top.
+    """
+    image = bpy.data.images.load(path)
+    image.colorspace_settings.name = 'Non-Color'
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+
+    # blender images start at the bottom row
+    values = pixels.reshape(height, width, 4)[::-1, :, 0]
+    return np.rint(values * 255).astype(np.uint8)
+
+
+def measure_instance(instance, instances, amodal):
+    """
+    Adds the tight box of the visible pixels of the instance, their count
+    and the occlusion measured against its full mask to the instance.
+    """
+    visible = instances == instance['instance_index']
+    full_pixels = int((amodal == instance['instance_index']).sum())
+    visible_pixels = int(visible.sum())
+
+    # None for a model hidden by the occluder, like the background samples
+    box = masks.tight_box(visible) or (None,) * 4
+    for key, value in zip(('min_x', 'max_x', 'min_y', 'max_y'), box):
+        instance[f'visible_{key}'] = None if value is None else float(value)
+    instance['visible_pixels'] = visible_pixels
+    instance['occlusion'] = 1 - visible_pixels / full_pixels if full_pixels else None
+
+
+def measure_masks(record, amodal_path):
+    """
+    Measures the model of the record and every other model of the render.
+    """
+    instances = read_mask_image(record['instance_mask_path'])
+    amodal = read_mask_image(amodal_path)
+
+    for instance in [record] + record.get('objects', []):
+        measure_instance(instance, instances, amodal)
+
+
+def collect_masks(record, frame):
+    """
+    Moves the masks written for the frame to the mask paths of the record,
+    then measures them for the tight labels.
+    """
+    if 'mask_path' in record:
+        os.replace(os.path.join(MASKS_PATH, f'frame_{frame:04d}.png'),
+                   record['mask_path'])
+    if 'instance_mask_path' in record:
+        os.replace(os.path.join(MASKS_PATH, f'instance_{frame:04d}.png'),
+                   record['instance_mask_path'])
+        amodal_path = os.path.join(MASKS_PATH, f'amodal_{frame:04d}.png')
+        measure_masks(record, amodal_path)
+        os.remove(amodal_path)
+
+
+if MASK_OUTPUT:
+    setup_mask_output()
+if TIGHT_LABELS:
+    setup_instance_output()
+
+encoder_pool = None
+if args.async_encode:
+    setup_viewer_node()
+    encoder_pool = image_encoder.EncoderPool(IMAGE_FORMAT, args.compression)
+# (future, record) of the images still being encoded
+pending_writes = []
+
+
+def blender_gauges():
+    """
+    Datablock counts and background cache size for the telemetry, read only
+    when the metrics are written. A steady growth between models means
+    something is not freed.
+    """
+    gauges = [
+        ('blender_datablocks', {'type': name}, len(getattr(bpy.data, name)))
+        for name in ('objects', 'meshes', 'materials', 'images', 'node_groups', 'libraries',
+                     'actions')
+    ]
+    gauges.append(('background_cache_bytes', {},
+                   sum(get_image_memory(img) for img in background_cache.values())))
+    gauges += [('background_cache_total', {'result': name}, count)
+               for name, count in background_cache_stats.items()]
+
+    return gauges
+
+
+telemetry = telemetry_module.Telemetry(
+    task_queue.worker_path('metrics.prom') if task_queue else args.metrics,
+    task_queue.worker_path('telemetry.jsonl') if task_queue else args.telemetry_log,
+    gauges=blender_gauges)
+
+
+def append_model(model):
+    """
+    Appends the first mesh of the source .blend file to the scene, or returns
+    None if the file has no mesh.
+    """
     filepath = os.path.join(MODELS_PATH, model)
 
     # load the current blender file
@@ -333,7 +1496,7 @@ for model in models:
 
     if not appended_objects:
         print(f"No MESH objects found in {model}. Skipping.")
-        continue
+        return None
 
     # TODO: implement logic fot when we have more then one model per file => Assembly file
     active_model = appended_objects[0]
@@ -341,23 +1504,80 @@ for model in models:
         print(
             f"Warning: File has {len(appended_objects)} objects. Only processing {active_model.name}.")
 
-    print(f"Processing object: {active_model.name}")
+    return active_model
 
-    # set the active object
-    bpy.context.view_layer.objects.active = active_model
 
-    # set origin to geometry center and the scale
-    set_obj_to_origin(active_model)
-    active_model.scale = (0.066, 0.066, 0.066)
+def model_key(model):
+    """
+    Name of the model in the records and the file names: the stem of its
+    file. The object names are not stable, the cached objects are renamed
+    and blender adds a suffix to objects sharing a name.
+    """
+    return os.path.splitext(model)[0]
+
+
+def load_instance(model, pass_index):
+    """
+    Loads the model from the preprocessed cache or, if it is not there, from
+    its .blend file with the origin at the geometry center and scaled, and
+    computes its per-model caches.
+
+    Returns a tuple (obj, max_dimension, shader_node), or None if the file
+    has no mesh.
+    """
+    obj = load_cached_model(model)
+    from_cache = obj is not None
+
+    if not from_cache:
+        obj = append_model(model)
+        if obj is None:
+            return None
+
+    obj.pass_index = pass_index
+    obj['model_key'] = model_key(model)
+
+    if not from_cache:
+        # set origin to geometry center and the scale
+        set_obj_to_origin(obj)
+        obj.scale = (MODEL_SCALE, MODEL_SCALE, MODEL_SCALE)
 
     bpy.context.view_layer.update()  # Make sure dimensions are calculated
-    object_dimens = active_model.dimensions
+    object_dimens = obj.dimensions
     max_dimension = max(object_dimens)
 
+    if not from_cache:
+        # only the hull vertices can define the 2D bounding box
+        precompute_projection_hull(obj)
+    # surface samples are used by the pose planner and the ray casts
+    precompute_visibility_samples(obj)
+
     # get material that should be already applied manually
-    mat = active_model.material_slots[0].material
+    mat = obj.material_slots[0].material
     mat.use_nodes = True
 
+    # nodes
+    shader_node = mat.node_tree.nodes.get("Principled BSDF")
+
+    return obj, max_dimension, shader_node
+
+
+def load_model(model):
+    """
+    Loads the model of the task with load_instance, the camera tracks it.
+
+    Returns a tuple (active_model, max_dimension, shader_node), or None if
+    the file has no mesh.
+    """
+    loaded = load_instance(model, MODEL_PASS_INDEX)
+    if loaded is None:
+        return None
+    active_model = loaded[0]
+
+    print(f"Processing object: {active_model.name}")
+
+    # set the active object
+    bpy.context.view_layer.objects.active = active_model
+
     # initial setup of the camera
     camera.constraints.clear()  # remove any existing constraints on the
     camera.constraints.new(type='TRACK_TO')
@@ -365,92 +1585,513 @@ for model in models:
     camera.constraints['Track To'].track_axis = 'TRACK_NEGATIVE_Z'
     camera.constraints['Track To'].up_axis = 'UP_Y'
 
-    # nodes
-    shader_node = mat.node_tree.nodes.get("Principled BSDF")
-    index = 0
+    if IS_OCLUSSION_ENABLE:
+        create_occluder_pool()
 
-    while index < SAMPLES_NUMBER:
-        # occluder setup
-        occluder = None
-        shader_occ = None
-        # TODO: it's always the same occluder per model
-        if IS_OCLUSSION_ENABLE:
-            occluder = create_random_occluder()
+    return loaded
 
-        # setup background and lighting randomization
-        setup_background_and_randomization(background_node, shader_node)
-        # setup the camera position rotation
-        camera_positioning()
 
-        occluder.hide_render = True
-        # occluder randomization
-        if IS_OCLUSSION_ENABLE:
-            randomChangeOclusion = random.uniform(0, 1)
+def load_companions(model):
+    """
+    Loads MODELS_PER_IMAGE - 1 other models of the library for the task of
+    `model`, drawn with its seed so a resumed task places the same ones.
+    They stay hidden until compose_sample places them.
+    """
+    others = sorted(other for other in os.listdir(MODELS_PATH)
+                    if other.endswith('.blend') and other != model)
+    chosen = random.Random(derive_seed(RUN_SEED, model, 'companions')).sample(
+        others, min(MODELS_PER_IMAGE - 1, len(others)))
 
-            if randomChangeOclusion > 0.5:
-                occluder.hide_render = False
-                jitter_camera_occluder_position(occluder=occluder)
+    for position, other in enumerate(chosen):
+        loaded = load_instance(other, COMPANION_PASS_INDEX + position)
+        if loaded is None:
+            continue
+        loaded[0].hide_render = True
+        companions.append(loaded[0])
 
-                for c in occluder.constraints:
-                    occluder.constraints.remove(c)
+    print(f"Placing {[companion['model_key'] for companion in companions]} around the model.")
 
-                track_to = occluder.constraints.new(type='TRACK_TO')
-                track_to.target = camera
-                track_to.track_axis = 'TRACK_NEGATIVE_Z'
-                track_to.up_axis = 'UP_Y'
 
-                occ_size = max_dimension * \
-                    random.uniform(0.2, 0.7)
-                occluder.scale = (occ_size, occ_size, 1)
+def unload_companions():
+    for companion in companions:
+        geometry_cache.pop(companion.name, None)
+        bpy.data.objects.remove(companion, do_unlink=True)
+    companions.clear()
 
-        print(
-            {f'Generating images, current: {index} of {SAMPLES_NUMBER} from  {model}'})
-        # rotate the model randomly
-        active_model.rotation_euler.x = random.uniform(0, 2 * math.pi)
-        active_model.rotation_euler.y = random.uniform(0, 2 * math.pi)
-        active_model.rotation_euler.z = random.uniform(0, 2 * math.pi)
-        mapping_node.inputs['Rotation'].default_value[2] = random.uniform(
-            0, math.pi * 2)
 
-        # update the matrix_world from the last shot
-        bpy.context.view_layer.update()
+def unload_model(active_model):
+    remove_occluder_pool()
+    geometry_cache.pop(active_model.name, None)
+    bpy.data.objects.remove(active_model, do_unlink=True)
+
+
+def prepare_sample(active_model, shader_node, pose, seed, frame=None):
+    """
+    Applies the planned pose and the seeded randomization of one sample to
+    the scene. With a frame, every randomized value is also keyframed on it
+    for the batch render.
+
+    Returns the visible occluder, or None.
+    """
+    # everything random in the sample comes from its seed
+    random.seed(seed)
+
+    # occluder setup
+    occluder = None
+    if pose['occluder_shape'] is not None:
+        occluder = show_occluder(pose['occluder_shape'])
+        jitter_camera_occluder_position(occluder=occluder, pose=pose)
+        occluder.scale = (pose['occluder_size'], pose['occluder_size'], 1)
+
+    # setup background and lighting randomization
+    setup_background_and_randomization(
+        background_node, shader_node, pick_background(seed))
+    # setup the camera position rotation
+    camera_positioning(pose)
+
+    # rotate the model as planned
+    active_model.rotation_euler = pose['rotation']
+    mapping_node.inputs['Rotation'].default_value[2] = random.uniform(
+        0, math.pi * 2)
+
+    if frame is not None:
+        # the keys have to exist before the update evaluates the animation
+        scene.frame_current = frame
+        keyframe_sample(frame, active_model, shader_node)
+
+    # update the matrix_world from the last shot
+    bpy.context.view_layer.update()
+
+    return occluder
+
+
+def get_keyframed_properties(active_model, shader_node):
+    """
+    (owner, property) pairs of everything prepare_sample randomizes.
+    """
+    properties = [
+        (camera, 'location'),
+        (camera.data, 'shift_x'),
+        (camera.data, 'shift_y'),
+        (camera.data, 'clip_end'),
+        (active_model, 'rotation_euler'),
+        (mapping_node.inputs['Rotation'], 'default_value'),
+        (background_node.inputs['Strength'], 'default_value'),
+        (shader_node.inputs['Subsurface Weight'], 'default_value'),
+        (shader_node.inputs['Roughness'], 'default_value'),
+    ]
+
+    for companion in companions:
+        properties += [
+            (companion, 'hide_render'),
+            (companion, 'location'),
+            (companion, 'rotation_euler'),
+        ]
+
+    for occluder in occluder_pool.values():
+        shader_occ = occluder.data.materials[0].node_tree.nodes.get(
+            "Principled BSDF")
+        properties += [
+            (occluder, 'hide_render'),
+            (occluder, 'location'),
+            (occluder, 'scale'),
+            (shader_occ.inputs['Base Color'], 'default_value'),
+            (shader_occ.inputs['Roughness'], 'default_value'),
+        ]
+
+    return properties
+
+
+def keyframe_sample(frame, active_model, shader_node):
+    # a rejected sample is overwritten by the next one on the same frame
+    for owner, data_path in get_keyframed_properties(active_model, shader_node):
+        owner.keyframe_insert(data_path, frame=frame)
+
+
+def clear_sample_keyframes(active_model, shader_node):
+    """
+    Removes the batch animation, sockets are animated through their node
+    tree.
+    """
+    animated = {owner.id_data for owner, _ in get_keyframed_properties(
+        active_model, shader_node)}
+    actions = {datablock.animation_data.action for datablock in animated
+               if datablock.animation_data is not None and datablock.animation_data.action is not None}
+    for datablock in animated:
+        datablock.animation_data_clear()
+    # clearing only unlinks the actions, every batch would leave its own
+    for action in actions:
+        bpy.data.actions.remove(action)
+
+
+def render_batch(batch, active_model, shader_node):
+    """
+    Renders the keyframed samples of the batch, frame 1 to len(batch), with
+    a single animation render, then moves every frame to its sample file and
+    saves its annotation. Only transforms and shader values change
+    between frames, so persistent data keeps the scene synced, the BVH and
+    the textures between them.
+    """
+    scene.frame_start = 1
+    scene.frame_end = len(batch)
+    scene.render.use_persistent_data = True
+    scene.render.filepath = os.path.join(RENDERS_PATH, 'batch', 'frame_')
+
+    # the image is not animated, and a rejected attempt prepared after the
+    # last sample of the batch may have loaded another one
+    background = batch[0]['background']
+    assert all(sample['background'] == background for sample in batch), \
+        f"The samples of a batch use different backgrounds: {[sample['background'] for sample in batch]}"
+    env_texture_node.image = load_background_image(background)
+
+    bpy.context.view_layer.objects.active = active_model
+    start = time.perf_counter()
+    with telemetry.stage('render_batch'):
+        bpy.ops.render.render(animation=True)
+    elapsed = time.perf_counter() - start
+
+    for frame, sample in enumerate(batch, start=1):
+        os.replace(scene.render.frame_path(frame=frame),
+                   sample['record']['file_path'])
+        collect_masks(sample['record'], frame)
+        save_annotation(sample['record'])
+
+    print(f"Rendered a batch of {len(batch)} frames in {elapsed:.1f} s "
+          f"({elapsed / len(batch):.2f} s/image)")
+
+    clear_sample_keyframes(active_model, shader_node)
+    scene.render.use_persistent_data = False
+
+    return elapsed
+
+
+def check_sample(active_model, occluder):
+    """
+    Computes the bounding box of the prepared sample and checks the
+    occlusion. Returns the bounding box, or None if the sample is rejected.
+    """
+    if VERIFY_PROJECTION:
+        verify_projection(active_model, scene, camera)
+        if occluder is not None:
+            verify_projection(occluder, scene, camera)
+
+    active_model_coord = get_2d_bounding_box(
+        cam=camera, obj=active_model, scene=scene)
+
+    # the planner already filtered the pose, this should not happen
+    if active_model_coord is None:
+        telemetry.reject('no_bounding_box')
+        return None
+
+    occlusion_percentage = 0.0
+
+    if occluder is not None:
+        occlusion_percentage = estimate_occlusion(active_model, occluder)
+
+        # if occlusion is too high, skip this render
+        if occlusion_percentage > MAX_OCCLUSION:
+            telemetry.reject('occlusion')
+            return None
 
-        active_model_coord = get_2d_bounding_box(
-            cam=camera, obj=active_model, scene=scene)
+    return active_model_coord, occlusion_percentage
 
-        denorm_coord_values = denormalize_coord(
-            active_model_coord["min_x"],
-            active_model_coord["max_x"],
-            active_model_coord["min_y"],
-            active_model_coord["max_y"]
+
+def estimate_occlusion(target, occluder):
+    """
+    Fraction of the target hidden by the occluder, with OCCLUSION_METHOD.
+    """
+    if OCCLUSION_METHOD == 'raycast':
+        visible_fraction, elapsed = estimate_visibility(
+            target=target,
+            occluder=occluder,
+            cam=camera,
+            scene=scene
         )
+        print(
+            f"Visibility estimate: {visible_fraction:.2f} in {elapsed * 1000:.2f} ms")
+        return 1 - visible_fraction
+
+    return calculate_occlusion(
+        target=target,
+        occluder=occluder,
+        cam=camera,
+        scene=scene
+    )
 
-        occlusion_percentage = 0.0
 
-        if IS_OCLUSSION_ENABLE and occluder.hide_render == False:
-            occlusion_percentage = calculate_occlusion(
-                target=active_model,
-                occluder=occluder,
-                cam=camera,
-                scene=scene
-            )
+def instance_record(obj, box, occlusion):
+    # an object appended twice is renamed with a .001 suffix, the key is not
+    return {
+        "model_name": obj['model_key'],
+        "instance_index": obj.pass_index,
+        "min_x": box["min_x"],
+        "max_x": box["max_x"],
+        "min_y": box["min_y"],
+        "max_y": box["max_y"],
+        "estimated_occlusion": occlusion,
+    }
 
-            # if occlusion is too high, skip this render
-            if occlusion_percentage > 0.55:
-                remove_occluder()
-                continue
 
-        index += 1
+def boxes_overlap(boxes, box, margin=0.0):
+    """
+    Which rows of the (N, 4) array of (min_x, max_x, min_y, max_y) overlap
+    the box grown by `margin`.
+    """
+    return ((boxes[:, 0] < box[1] + margin) & (boxes[:, 1] > box[0] - margin) &
+            (boxes[:, 2] < box[3] + margin) & (boxes[:, 3] > box[2] - margin))
 
-        width = denorm_coord_values["max_x"] - denorm_coord_values["min_x"]
-        height = denorm_coord_values["max_y"] - denorm_coord_values["min_y"]
 
-        file_name = f"{active_model.name}-{uuid.uuid4()}.png"
-        file_path = f"{RENDERS_PATH}/{file_name}"
+def place_companion(companion, taken_boxes, rng, camera_frame, camera_matrix):
+    """
+    Projects COMPANION_CANDIDATES random placements of the companion at
+    once, on rays through the frame at about the model distance, and moves
+    it to the first one entirely in frame whose box is clear of the taken
+    ones. Returns False if none is.
+    """
+    count = COMPANION_CANDIDATES
+    camera_rotation = camera_matrix[:3, :3]
+    camera_location = camera_matrix[:3, 3]
+    shift_x = np.full(count, camera.data.shift_x)
+    shift_y = np.full(count, camera.data.shift_y)
+
+    # the model is at the origin
+    depth = np.linalg.norm(camera_location) * rng.uniform(0.7, 1.3, count)
+    frame_x = camera_frame['min_x'] + shift_x * camera_frame['shift_unit_x'] + \
+        rng.uniform(0, 1, count) * camera_frame['width']
+    frame_y = camera_frame['min_y'] + shift_y * camera_frame['shift_unit_y'] + \
+        rng.uniform(0, 1, count) * camera_frame['height']
+    local = np.stack([frame_x * depth / camera_frame['distance'],
+                      frame_y * depth / camera_frame['distance'],
+                      -depth], axis=-1)
+    locations = local @ camera_rotation.T + camera_location
+    rotations = rng.uniform(0, 2 * math.pi, (count, 3))
+
+    points = get_projection_points(companion) * np.array(companion.scale)
+    x_values, y_values, depths = project_candidates(
+        points, euler_to_matrices(rotations), locations,
+        np.repeat(camera_rotation[None], count, axis=0),
+        np.repeat(camera_location[None], count, axis=0),
+        camera_frame, shift_x, shift_y)
+
+    boxes = np.stack([x_values.min(axis=1), x_values.max(axis=1),
+                      y_values.min(axis=1), y_values.max(axis=1)], axis=-1)
+    valid = ((depths > 0).all(axis=1) &
+             (boxes[:, 0] >= 0) & (boxes[:, 1] <= 1) &
+             (boxes[:, 2] >= 0) & (boxes[:, 3] <= 1) &
+             (np.minimum(boxes[:, 1] - boxes[:, 0], boxes[:, 3] - boxes[:, 2]) >= MIN_BOX_SIZE))
+    for box in taken_boxes:
+        valid &= ~boxes_overlap(boxes, box, COMPANION_MARGIN)
+
+    chosen = np.flatnonzero(valid)
+    if not len(chosen):
+        return False
+
+    companion.location = locations[chosen[0]]
+    companion.rotation_euler = rotations[chosen[0]]
+    companion.hide_render = False
+    taken_boxes.append(boxes[chosen[0]])
+
+    return True
+
+
+def compose_sample(active_model_coord, occluder, seed, frame=None):
+    """
+    Places the other models of the task around the prepared sample. The
+    boxes do not overlap, so the models never intersect or hide each other
+    and only the occluder can. A model without a free placement, or hidden
+    beyond MAX_OCCLUSION, is left out of the render.
+
+    Returns the instance records of the placed models.
+    """
+    rng = np.random.default_rng(derive_seed(seed, 'compose'))
+    camera_frame = get_camera_frame(scene, camera)
+    camera_matrix = np.array(camera.matrix_world)
+    taken_boxes = [[active_model_coord[key] for key in ('min_x', 'max_x', 'min_y', 'max_y')]]
+
+    placed = []
+    for companion in companions:
+        companion.hide_render = True
+        if place_companion(companion, taken_boxes, rng, camera_frame, camera_matrix):
+            placed.append(companion)
+
+    if frame is not None:
+        keyframe_companions(frame)
+    bpy.context.view_layer.update()
+
+    instances = []
+    for companion in placed:
+        box = get_2d_bounding_box(companion, scene, camera)
+        occlusion = estimate_occlusion(companion, occluder) if occluder is not None else 0.0
+        if box is None or occlusion > MAX_OCCLUSION:
+            telemetry.reject('companion')
+            companion.hide_render = True
+            continue
+        instances.append(instance_record(companion, box, occlusion))
+
+    if frame is not None:
+        keyframe_companions(frame)
+
+    return instances
+
+
+def keyframe_companions(frame):
+    for companion in companions:
+        for data_path in ('hide_render', 'location', 'rotation_euler'):
+            companion.keyframe_insert(data_path, frame=frame)
+
+
+def render_sample(file_path):
+    bpy.context.scene.render.filepath = file_path
+    bpy.ops.render.render(write_still=True)
 
-        bpy.context.scene.render.filepath = file_path
-        bpy.context.view_layer.objects.active = active_model
-        bpy.ops.render.render(write_still=True)
+
+def save_written_annotations(wait=False):
+    """
+    Saves the annotations of the images the encoder pool has written, with
+    wait all of them.
+    """
+    still_pending = []
+    for future, record in pending_writes:
+        if wait or future.done():
+            # raises the error of a failed write
+            future.result()
+            save_annotation(record)
+        else:
+            still_pending.append((future, record))
+
+    pending_writes[:] = still_pending
+
+
+def output_sample(record):
+    """
+    Renders the sample to its file path and saves its annotation once the
+    image is written. With the encoder pool the render pixels are queued and
+    this returns right after the render.
+    """
+    if encoder_pool is None:
+        render_sample(record['file_path'])
+        collect_masks(record, scene.frame_current)
+        save_annotation(record)
+        return
+
+    bpy.ops.render.render()
+    collect_masks(record, scene.frame_current)
+    future = encoder_pool.submit(*read_render_pixels(), record['file_path'])
+    pending_writes.append((future, record))
+    save_written_annotations()
+
+
+def lease_lost(task_id):
+    """
+    True if another worker took the queue task over, its remaining samples
+    are left to that worker.
+    """
+    if task_id is None:
+        return False
+
+    task_queue.heartbeat_if_due()
+    if not task_queue.has_lost(task_id):
+        return False
+
+    print(f"--- Lost the lease of {task_id}, stopping it. ---")
+    return True
+
+
+def render_model_task(task, finished_seeds, task_id=None):
+    """
+    Renders the samples [start, end) of one model, skipping the finished
+    ones. A queue task stops when its lease is lost.
+    """
+    model = task['model']
+    sample_seeds = {
+        index: derive_seed(RUN_SEED, model, index)
+        for index in range(task['start'], task['end'])
+    }
+    pending = [index for index, seed in sample_seeds.items()
+               if seed not in finished_seeds]
+    if not pending:
+        print(f"--- All the samples of {model} are rendered. Skipping. ---")
+        return
+
+    print(f"--- Processing file: {model} ---")
+    loaded = load_model(model)
+    if loaded is None:
+        return
+    active_model, max_dimension, shader_node = loaded
+    if MODELS_PER_IMAGE > 1:
+        load_companions(model)
+
+    attempts = dict.fromkeys(pending, 0)
+    poses = {}
+    batch = []
+
+    if BATCH_SIZE:
+        # a batch shares one background image, group the samples by it
+        pending.sort(key=lambda i: pick_background(
+            derive_seed(sample_seeds[i], 0)))
+
+    while pending:
+        if lease_lost(task_id):
+            # the samples keyframed for the batch are not rendered
+            if batch:
+                clear_sample_keyframes(active_model, shader_node)
+                batch = []
+            break
+
+        index = pending[0]
+
+        if index not in poses:
+            # a new attempt draws different candidates for the same sample
+            with telemetry.stage('plan'):
+                poses = plan_poses(
+                    active_model, max_dimension, scene, camera,
+                    {i: derive_seed(sample_seeds[i], attempts[i])
+                     for i in pending[:PLANNER_BATCH]}
+                )
+
+        pose = poses.pop(index, None)
+        if pose is None:
+            telemetry.reject('planner')
+            attempts[index] += 1
+            if attempts[index] >= MAX_PLANNER_ATTEMPTS:
+                print(
+                    f"No pose passed the planner filters for sample {index} of {model}. Skipping.")
+                pending.pop(0)
+            continue
+
+        print(
+            {f'Generating images, current: {index} of {task["end"]} from  {model}'})
+        seed = derive_seed(sample_seeds[index], attempts[index])
+
+        frame = None
+        if BATCH_SIZE:
+            if batch and pick_background(seed) != batch[-1]['background']:
+                render_batch(batch, active_model, shader_node)
+                batch = []
+            frame = len(batch) + 1
+
+        with telemetry.stage('prepare'):
+            occluder = prepare_sample(
+                active_model, shader_node, pose, seed, frame)
+        with telemetry.stage('check'):
+            checked = check_sample(active_model, occluder)
+
+        if checked is None:
+            hide_occluders()
+            attempts[index] += 1
+            continue
+
+        pending.pop(0)
+        active_model_coord, occlusion = checked
+
+        instances = []
+        if companions:
+            with telemetry.stage('compose'):
+                instances = compose_sample(active_model_coord, occluder, seed, frame)
+
+        file_name = sample_file_name(
+            active_model['model_key'], sample_seeds[index], IMAGE_FORMAT)
+        file_path = f"{RENDERS_PATH}/{file_name}"
 
         background_data = {
             "min_x": active_model_coord["min_x"],
@@ -459,59 +2100,207 @@ for model in models:
             "max_y": active_model_coord["max_y"],
             "file_path": file_path,
             "file_name": file_name,
-            "model_name": active_model.name,
+            "model_name": active_model['model_key'],
         }
+        if companions:
+            background_data["objects"] = [
+                instance_record(active_model, active_model_coord, occlusion)] + instances
+        if MASK_OUTPUT:
+            background_data["mask_path"] = f"{MASKS_PATH}/{os.path.splitext(file_name)[0]}.png"
+        if TIGHT_LABELS:
+            background_data["instance_mask_path"] = \
+                f"{MASKS_PATH}/{os.path.splitext(file_name)[0]}-instance.png"
+            background_data["instance_index"] = MODEL_PASS_INDEX
+
+        if BATCH_SIZE:
+            batch.append({
+                'record': background_data,
+                'background': pick_background(seed),
+            })
+            if len(batch) == BATCH_SIZE:
+                render_batch(batch, active_model, shader_node)
+                batch = []
+        else:
+            bpy.context.view_layer.objects.active = active_model
+            start = time.perf_counter()
+            with telemetry.stage('render'):
+                output_sample(background_data)
+            print(f"Rendered in {time.perf_counter() - start:.2f} s")
+
+        telemetry.sample_done(file_name)
+
+        hide_occluders()
+
+    if batch:
+        render_batch(batch, active_model, shader_node)
+
+    unload_companions()
+    unload_model(active_model)
+    print(background_cache_summary())
+
+
+def render_background_task(background_task, finished_seeds, task_id=None):
+    """
+    Generate pure background images so we prevent false positives during
+    training.
+    """
+    # there is no model to mask
+    mute_mask_outputs(True)
+
+    for background_sample in range(background_task['start'], background_task['end']):
+        if lease_lost(task_id):
+            break
+        seed = derive_seed(RUN_SEED, 'background', background_sample)
+        if seed in finished_seeds:
+            continue
+        random.seed(seed)
+
+        camera.constraints.clear()
+        # Random rotation for the camera in all axes
+        camera.rotation_euler[0] = random.uniform(
+            0, 2 * math.pi)  # X rotation
+        camera.rotation_euler[1] = random.uniform(
+            0, 2 * math.pi)  # Y rotation
+        camera.rotation_euler[2] = random.uniform(
+            0, 2 * math.pi)  # Z rotation
+
+        # load random background
+        img_path = os.path.join(
+            BACKGROUND_PATH, random.choice(filered_backgrounds))
+        env_texture_node.image = load_background_image(img_path)
+
+        # light randomization
+        background_node.inputs['Strength'].default_value = random.uniform(
+            0.8, 2.5)
 
-        # print(bb_data)
-        export_json.append(background_data)
+        # update the matrix_world from the last shot
+        bpy.context.view_layer.update()
 
-        # Also delete any other leftover meshes from the append
-        if IS_OCLUSSION_ENABLE:
-            remove_occluder()
+        file_name = sample_file_name("background", seed, IMAGE_FORMAT)
+        file_path = f"{RENDERS_PATH}/{file_name}"
 
-    bpy.data.objects.remove(active_model, do_unlink=True)
+        background_data = {
+            "file_path": file_path,
+            "file_name": file_name,
+            "model_name": "background",
+            "min_x": None,
+            "max_x": None,
+            "min_y": None,
+            "max_y": None,
+        }
 
+        with telemetry.stage('render'):
+            output_sample(background_data)
+        telemetry.sample_done(file_name)
 
-# Generate pure background images so we prevent false positives during training
-for background_sample in range(0, BACKGROUND_SAMPLES):
-    camera.constraints.clear()
-    # Random rotation for the camera in all axes
-    camera.rotation_euler[0] = random.uniform(0, 2 * math.pi)  # X rotation
-    camera.rotation_euler[1] = random.uniform(0, 2 * math.pi)  # Y rotation
-    camera.rotation_euler[2] = random.uniform(0, 2 * math.pi)  # Z rotation
+    # queued model tasks can follow
+    mute_mask_outputs(False)
 
-    # load random background
-    img_path = os.path.join(
-        BACKGROUND_PATH, random.choice(filered_backgrounds))
-    img = bpy.data.images.load(img_path)
-    env_texture_node.image = img
 
-    # light randomization
-    background_node.inputs['Strength'].default_value = random.uniform(
-        0.8, 2.5)
+def mute_mask_outputs(mute):
+    names = []
+    if MASK_OUTPUT:
+        names.append('Mask Output')
+    if TIGHT_LABELS:
+        names += ['Instance Output', 'Amodal Output']
 
-    # update the matrix_world from the last shot
-    bpy.context.view_layer.update()
+    for name in names:
+        scene.node_tree.nodes[name].mute = mute
 
-    file_name = f"background-{uuid.uuid4()}.png"
-    file_path = f"{RENDERS_PATH}/{file_name}"
 
-    bpy.context.scene.render.filepath = file_path
-    bpy.ops.render.render(write_still=True)
+def count_pending(tasks, background_task, finished_seeds):
+    return sum(
+        derive_seed(RUN_SEED, task['model'], index) not in finished_seeds
+        for task in tasks for index in range(task['start'], task['end'])
+    ) + sum(
+        derive_seed(RUN_SEED, 'background', index) not in finished_seeds
+        for index in range(background_task['start'], background_task['end'])
+    )
 
-    background_data = {
-        "file_path": file_path,
-        "file_name": file_name,
-        "model_name": "background",
-        "min_x": None,
-        "max_x": None,
-        "min_y": None,
-        "max_y": None,
-    }
 
-    export_json.append(background_data)
+def queue_heartbeat(*_):
+    task_queue.heartbeat_if_due()
+
+
+def render_queue_tasks():
+    """
+    Renders the tasks leased from the shared queue until every one is done.
+    The samples any worker finished, also one that crashed in the middle of
+    the task, are read from all the worker logs and skipped.
+    """
+    no_background = {'start': 0, 'end': 0}
+    # the heartbeat thread waits while blender renders, touch the leases
+    # between the frames of a batch too
+    bpy.app.handlers.render_post.append(queue_heartbeat)
+
+    for task_id, task in task_queue.leased_tasks():
+        finished_seeds = load_finished_seeds(
+            [ANNOTATIONS_PATH] + args.finished_log + task_queue.annotation_logs())
+        print(f"--- Leased {task_id} from {args.queue} ---")
+
+        if task['kind'] == 'background':
+            telemetry.expected_samples = telemetry.samples + count_pending(
+                [], task, finished_seeds)
+            render_background_task(task, finished_seeds, task_id)
+        else:
+            telemetry.expected_samples = telemetry.samples + count_pending(
+                [task], no_background, finished_seeds)
+            render_model_task(task, finished_seeds, task_id)
+
+        # the task is only done once its annotations are saved
+        if encoder_pool is not None:
+            save_written_annotations(wait=True)
+
+
+def main():
+    if task_queue is not None:
+        render_queue_tasks()
+        if encoder_pool is not None:
+            encoder_pool.close()
+        print(f"Added {annotations_written['count']} bounding boxes to {ANNOTATIONS_PATH}.")
+        telemetry.report(force=True)
+        print("------- finished -------")
+        return
+
+    models = [f for f in os.listdir(MODELS_PATH) if f.endswith('.blend')]
+    print(f"Found {len(models)} .blend files to process.")
+
+    # each task renders the samples [start, end) of one model
+    if args.shard:
+        with open(args.shard) as f:
+            shard = json.load(f)
+        tasks = shard['tasks']
+        background_task = shard['background']
+    else:
+        tasks = [{'model': model, 'start': 0, 'end': SAMPLES_NUMBER}
+                 for model in models]
+        background_task = {'start': 0, 'end': BACKGROUND_SAMPLES}
+
+    # samples rendered by a previous run are skipped
+    finished_seeds = load_finished_seeds(
+        [ANNOTATIONS_PATH] + args.finished_log)
+    print(f"Found {len(finished_seeds)} samples already rendered.")
+
+    telemetry.expected_samples = count_pending(
+        tasks, background_task, finished_seeds)
+
+    for task in tasks:
+        render_model_task(task, finished_seeds)
+
+    render_background_task(background_task, finished_seeds)
+
+    if encoder_pool is not None:
+        save_written_annotations(wait=True)
+        encoder_pool.close()
+
+    print(
+        f"Added {annotations_written['count']} bounding boxes to {ANNOTATIONS_PATH}.")
 
+    print(background_cache_summary())
+    telemetry.report(force=True)
+    print("------- finished -------")
 
-load_and_merge_previous_data(export_json)
 
-print("------- finished -------")
+# other scripts import this module to reuse the scene setup and the helpers
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+# blender does not add the script folder to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import auto_render  # noqa: E402
+
+BENCHMARK_PATH = './benchmark/batch'
+
+
+def parse_args():
+    """
+    Arguments given after `--` on the blender command line, e.g.
+    blender -b --python benchmark_batch.py -- --samples 16
+    """
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+
+    parser = argparse.ArgumentParser(
+        prog='benchmark_batch.py',
+        description='Renders the same seeded samples one still at a time and as one batch.')
+    parser.add_argument('--model', default=None,
+                        help='.blend file in the models folder, the first one if not set')
+    parser.add_argument('--samples', type=int, default=16)
+    parser.add_argument('--output', default=BENCHMARK_PATH)
+
+    return parser.parse_known_args(argv)[0]
+
+
+def make_record(active_model, seed, mode, output):
+    file_name = auto_render.sample_file_name(active_model.name, seed)
+    return {
+        'file_path': os.path.join(output, mode, file_name),
+        'file_name': file_name,
+        'model_name': active_model.name,
+    }
+
+
+def main():
+    args = parse_args()
+    os.makedirs(os.path.join(args.output, 'still'), exist_ok=True)
+    os.makedirs(os.path.join(args.output, 'batch'), exist_ok=True)
+    # keep the benchmark out of the dataset
+    auto_render.RENDERS_PATH = args.output
+    auto_render.ANNOTATIONS_PATH = os.path.join(
+        args.output, 'annotations.jsonl')
+
+    models = sorted(f for f in os.listdir(auto_render.MODELS_PATH)
+                    if f.endswith('.blend'))
+    model = args.model or models[0]
+    active_model, max_dimension, shader_node = auto_render.load_model(model)
+
+    sample_seeds = {
+        index: auto_render.derive_seed('batch-benchmark', model, index)
+        for index in range(args.samples)
+    }
+    poses = auto_render.plan_poses(
+        active_model, max_dimension, auto_render.scene, auto_render.camera, sample_seeds)
+
+    # a batch shares one background, use the same one for the stills
+    background = auto_render.pick_background(next(iter(sample_seeds.values())))
+    auto_render.pick_background = lambda seed: background
+
+    start = time.perf_counter()
+    for index, pose in poses.items():
+        auto_render.prepare_sample(
+            active_model, shader_node, pose, sample_seeds[index])
+        record = make_record(active_model, sample_seeds[index], 'still', args.output)
+        auto_render.render_sample(record['file_path'])
+        auto_render.hide_occluders()
+    still_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = []
+    for frame, (index, pose) in enumerate(poses.items(), start=1):
+        auto_render.prepare_sample(
+            active_model, shader_node, pose, sample_seeds[index], frame)
+        batch.append({
+            'record': make_record(active_model, sample_seeds[index], 'batch', args.output),
+            'background': background,
+        })
+        auto_render.hide_occluders()
+    auto_render.render_batch(batch, active_model, shader_node)
+    batch_time = time.perf_counter() - start
+
+    report = {
+        'model': model,
+        'samples': len(poses),
+        'still_seconds_per_image': still_time / len(poses),
+        'batch_seconds_per_image': batch_time / len(poses),
+        'speedup': still_time / batch_time,
+    }
+    with open(os.path.join(args.output, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f"Per still: {report['still_seconds_per_image']:.2f} s/image")
+    print(f"Batch:     {report['batch_seconds_per_image']:.2f} s/image")
+    print(f"Speedup:   {report['speedup']:.2f}x")
+
+    auto_render.unload_model(active_model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+# blender does not add the script folder to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import auto_render  # noqa: E402
+
+BENCHMARK_PATH = './benchmark/quality'
+
+
+def parse_args():
+    """
+    Arguments given after `--` on the blender command line, e.g.
+    blender -b --python benchmark_quality.py -- --samples 8 --max-rmse 0.02
+    """
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+
+    parser = argparse.ArgumentParser(
+        prog='benchmark_quality.py',
+        description='Renders the same seeded samples with every quality profile and compares them with the reference.')
+    parser.add_argument('--model', default=None,
+                        help='.blend file in the models folder, the first one if not set')
+    parser.add_argument('--samples', type=int, default=8)
+    parser.add_argument('--profiles', nargs='+',
+                        default=[name for name in auto_render.QUALITY_PROFILES if name != 'reference'])
+    parser.add_argument('--reference', default='reference')
+    parser.add_argument('--max-rmse', type=float, default=0.02,
+                        help='largest mean RMSE (0-1) against the reference to consider a profile good enough')
+    parser.add_argument('--output', default=BENCHMARK_PATH)
+
+    return parser.parse_known_args(argv)[0]
+
+
+def load_pixels(path):
+    """
+    Reads the RGB pixels of a rendered PNG as a float array (0-1).
+    """
+    img = bpy.data.images.load(path)
+    width, height = img.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    img.pixels.foreach_get(pixels)
+    bpy.data.images.remove(img)
+
+    return pixels.reshape(height, width, 4)[..., :3]
+
+
+def render_profile(profile, samples, active_model, shader_node, output):
+    """
+    Renders every (seed, pose) sample with the profile, returns the image
+    paths and the seconds per image.
+    """
+    auto_render.apply_quality_profile(auto_render.scene, profile)
+    os.makedirs(os.path.join(output, profile), exist_ok=True)
+
+    paths = []
+    elapsed = 0.0
+    for seed, pose in samples:
+        auto_render.prepare_sample(active_model, shader_node, pose, seed)
+
+        path = os.path.join(output, profile, f'{seed:016x}.png')
+        start = time.perf_counter()
+        auto_render.render_sample(path)
+        elapsed += time.perf_counter() - start
+
+        auto_render.hide_occluders()
+        paths.append(path)
+
+    return paths, elapsed / len(samples)
+
+
+def main():
+    args = parse_args()
+    scene = auto_render.scene
+    # the comparison is meant for the CPU render boxes
+    scene.cycles.device = 'CPU'
+
+    models = sorted(f for f in os.listdir(auto_render.MODELS_PATH)
+                    if f.endswith('.blend'))
+    model = args.model or models[0]
+    active_model, max_dimension, shader_node = auto_render.load_model(model)
+
+    # fixed seeds, every run of the benchmark renders the same images
+    sample_seeds = {
+        index: auto_render.derive_seed('quality-benchmark', model, index)
+        for index in range(args.samples)
+    }
+    poses = auto_render.plan_poses(
+        active_model, max_dimension, scene, auto_render.camera, sample_seeds)
+    samples = [(sample_seeds[index], pose) for index, pose in poses.items()]
+    print(f"Benchmarking {len(samples)} samples of {model}.")
+
+    # warm up, so the first profile does not pay for loading the kernels
+    auto_render.apply_quality_profile(scene, args.profiles[0])
+    first_seed, first_pose = samples[0]
+    auto_render.prepare_sample(
+        active_model, shader_node, first_pose, first_seed)
+    auto_render.render_sample(os.path.join(args.output, 'warmup.png'))
+
+    reference_paths, reference_time = render_profile(
+        args.reference, samples, active_model, shader_node, args.output)
+    reference_pixels = [load_pixels(path) for path in reference_paths]
+
+    results = {}
+    for profile in args.profiles:
+        paths, seconds_per_image = render_profile(
+            profile, samples, active_model, shader_node, args.output)
+
+        errors = [
+            np.sqrt(np.mean((load_pixels(path) - reference) ** 2))
+            for path, reference in zip(paths, reference_pixels)
+        ]
+        rmse = float(np.mean(errors))
+        results[profile] = {
+            'seconds_per_image': seconds_per_image,
+            'rmse': rmse,
+            'psnr': 20 * math.log10(1 / rmse) if rmse > 0 else math.inf,
+        }
+
+    good_enough = [profile for profile in results
+                   if results[profile]['rmse'] <= args.max_rmse]
+    cheapest = min(good_enough, key=lambda profile: results[profile]['seconds_per_image'],
+                   default=None)
+
+    report = {
+        'model': model,
+        'samples': len(samples),
+        'reference': {'profile': args.reference, 'seconds_per_image': reference_time},
+        'profiles': results,
+        'max_rmse': args.max_rmse,
+        'cheapest_within_tolerance': cheapest,
+    }
+    with open(os.path.join(args.output, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f"{'profile':<12}{'s/image':>10}{'rmse':>10}{'psnr':>10}")
+    print(f"{args.reference:<12}{reference_time:>10.2f}")
+    for profile, result in results.items():
+        print(f"{profile:<12}{result['seconds_per_image']:>10.2f}"
+              f"{result['rmse']:>10.4f}{result['psnr']:>10.1f}")
+    print(f"Cheapest profile within {args.max_rmse} RMSE: {cheapest}")
+
+    auto_render.unload_model(active_model)
+
+
+if __name__ == "__main__":
+    main()
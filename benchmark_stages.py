@@ -0,0 +1,212 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+# blender does not add the script folder to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import auto_render  # noqa: E402
+from synthetic_models import create_bumpy_sphere  # noqa: E402
+
+BENCHMARK_PATH = './benchmark/stages'
+
+
+def parse_args():
+    """
+    Arguments given after `--` on the blender command line, e.g.
+    blender -b --python benchmark_stages.py -- --vertices 10000 100000 --samples 1 8
+    """
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+
+    parser = argparse.ArgumentParser(
+        prog='benchmark_stages.py',
+        description='Times every stage of auto_render.py on synthetic models and a procedural HDRI.')
+    parser.add_argument('--vertices', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='vertex counts of the synthetic models')
+    parser.add_argument('--samples', type=int, nargs='+', default=[1, 8],
+                        help='samples rendered per model')
+    parser.add_argument('--quality', default='draft',
+                        choices=list(auto_render.QUALITY_PROFILES))
+    parser.add_argument('--output', default=BENCHMARK_PATH)
+
+    return parser.parse_known_args(argv)[0]
+
+
+def create_synthetic_model(path, vertices):
+    """
+    Writes a .blend file with a bumpy sphere of about `vertices` vertices and
+    a material, shaped like a real part: most vertices are not on the hull.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    mesh = create_bumpy_sphere(name, max(8, round(math.sqrt(2 * vertices))))
+
+    material = bpy.data.materials.new(f'{name}-material')
+    material.use_nodes = True
+    mesh.materials.append(material)
+
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.data.libraries.write(path, {obj}, fake_user=True)
+
+    bpy.data.objects.remove(obj)
+    bpy.data.meshes.remove(mesh)
+    bpy.data.materials.remove(material)
+
+
+def create_procedural_hdri(path, width=256, height=128):
+    """
+    Writes a small equirectangular .exr with a sky gradient and a sun.
+    """
+    elevation = np.linspace(-math.pi / 2, math.pi / 2, height)[:, None]
+    azimuth = np.linspace(-math.pi, math.pi, width)[None, :]
+
+    sky = np.clip(np.sin(elevation), 0, 1) * 0.8 + 0.2
+    sun = 50 * np.exp(-((azimuth - 0.5) ** 2 + (elevation - 0.6) ** 2) / 0.01)
+
+    # blender images start at the bottom row
+    pixels = np.ones((height, width, 4), dtype=np.float32)
+    pixels[..., 0] = sky * 0.6 + sun
+    pixels[..., 1] = sky * 0.75 + sun
+    pixels[..., 2] = sky + sun
+
+    image = bpy.data.images.new('BenchmarkSky', width, height, alpha=True, float_buffer=True)
+    image.pixels.foreach_set(pixels.ravel())
+    image.filepath_raw = path
+    image.file_format = 'OPEN_EXR'
+    image.save()
+    bpy.data.images.remove(image)
+
+
+def timed(stages, name, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    stages.setdefault(name, []).append(time.perf_counter() - start)
+
+    return result
+
+
+def summarize(stages):
+    return {
+        name: {
+            'count': len(times),
+            'total': sum(times),
+            'mean': sum(times) / len(times),
+            'min': min(times),
+            'max': max(times),
+        }
+        for name, times in stages.items()
+    }
+
+
+def benchmark_model(model, samples, output):
+    """
+    Runs every stage of auto_render.py for the model and `samples` samples,
+    returns the seconds of every call of every stage.
+    """
+    scene = auto_render.scene
+    camera = auto_render.camera
+    stages = {}
+
+    # loading and normalizing on their own, then the whole load_model
+    obj = timed(stages, 'model_load', auto_render.append_model, model)
+    timed(stages, 'origin_scale', auto_render.set_obj_to_origin, obj)
+    bpy.data.objects.remove(obj, do_unlink=True)
+
+    obj = auto_render.append_model(model)
+    timed(stages, 'normalize_model', auto_render.normalize_model, obj)
+    bpy.data.objects.remove(obj, do_unlink=True)
+
+    active_model, max_dimension, shader_node = timed(
+        stages, 'load_model', auto_render.load_model, model)
+
+    sample_seeds = {
+        index: auto_render.derive_seed('stage-benchmark', model, index)
+        for index in range(samples)
+    }
+    poses = timed(stages, 'pose_sampling', auto_render.plan_poses,
+                  active_model, max_dimension, scene, camera, sample_seeds)
+
+    for index, pose in poses.items():
+        occluder = timed(stages, 'prepare_sample', auto_render.prepare_sample,
+                         active_model, shader_node, pose, sample_seeds[index])
+
+        timed(stages, 'get_2d_bounding_box', auto_render.get_2d_bounding_box,
+              active_model, scene, camera)
+        timed(stages, 'get_2d_bounding_box_per_vertex',
+              auto_render.get_2d_bounding_box_per_vertex, active_model, scene, camera)
+
+        if occluder is not None:
+            timed(stages, 'calculate_occlusion', auto_render.calculate_occlusion,
+                  active_model, occluder, camera, scene)
+            timed(stages, 'estimate_visibility', auto_render.estimate_visibility,
+                  active_model, occluder, camera, scene)
+
+        timed(stages, 'render', bpy.ops.render.render)
+        timed(stages, 'write', bpy.data.images['Render Result'].save_render,
+              os.path.join(output, 'renders', f'{model}-{index}.png'))
+
+        auto_render.hide_occluders()
+
+    auto_render.unload_model(active_model)
+
+    return stages
+
+
+def main():
+    args = parse_args()
+    scene = auto_render.scene
+    # comparable numbers between runs, always on the CPU
+    scene.cycles.device = 'CPU'
+    auto_render.apply_quality_profile(scene, args.quality)
+
+    models_path = os.path.join(args.output, 'models')
+    backgrounds_path = os.path.join(args.output, 'backgrounds')
+    for path in (models_path, backgrounds_path, os.path.join(args.output, 'renders')):
+        os.makedirs(path, exist_ok=True)
+
+    # the synthetic assets replace the dataset ones, the cache is skipped
+    create_procedural_hdri(os.path.join(backgrounds_path, 'sky.exr'))
+    auto_render.BACKGROUND_PATH = backgrounds_path
+    auto_render.filered_backgrounds[:] = ['sky.exr']
+    auto_render.MODELS_PATH = models_path
+    auto_render.MODEL_CACHE_PATH = os.path.join(args.output, 'no-cache')
+    auto_render.background_manifest.clear()
+
+    results = []
+    for vertices in args.vertices:
+        model = f'synthetic-{vertices}.blend'
+        create_synthetic_model(os.path.join(models_path, model), vertices)
+
+        for samples in args.samples:
+            print(f"Benchmarking {model} with {samples} samples.")
+            stages = benchmark_model(model, samples, args.output)
+            results.append({
+                'vertices': vertices,
+                'samples': samples,
+                'stages': summarize(stages),
+            })
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'blender': bpy.app.version_string,
+        'quality': args.quality,
+        'device': scene.cycles.device,
+        'threads': scene.render.threads,
+        'resolution': [scene.render.resolution_x, scene.render.resolution_y],
+        'results': results,
+    }
+    with open(os.path.join(args.output, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+    for result in results:
+        print(f"{result['vertices']} vertices, {result['samples']} samples")
+        for name, stage in result['stages'].items():
+            print(f"    {name:<32}{stage['mean'] * 1000:>10.2f} ms x {stage['count']}")
+
+
+if __name__ == "__main__":
+    main()
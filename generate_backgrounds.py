@@ -0,0 +1,249 @@
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+from multiprocessing import Pool
+
+import numpy as np
+import OpenEXR
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+import annotation_log  # noqa: E402
+from image_encoder import PNG_COMPRESSION, agx_look, write_image  # noqa: E402
+
+BACKGROUND_PATH = './backgrounds'
+RENDERS_PATH = './renders'
+ANNOTATIONS_PATH = 'annotations.jsonl'
+BACKGROUND_SAMPLES = 2
+X_RES = 640
+Y_RES = 480
+# default blender camera
+LENS = 50
+SENSOR_WIDTH = 36
+# samples per pixel side, averaged before the look transform
+SUPERSAMPLE = 2
+# backgrounds kept in memory by every worker
+HDRI_CACHE_SIZE = 2
+
+hdri_cache = OrderedDict()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Generates the background-only samples by projecting the HDRIs, without rendering.')
+    parser.add_argument('--samples', type=int, default=BACKGROUND_SAMPLES)
+    parser.add_argument('--start', type=int, default=0,
+                        help='first background sample index')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0,
+                        help='run seed, the same as auto_render.py gives the same file names')
+    parser.add_argument('--renders-path', default=RENDERS_PATH)
+    parser.add_argument('--annotations', default=ANNOTATIONS_PATH)
+    parser.add_argument('--lens', type=float, default=LENS)
+    parser.add_argument('--sensor-width', type=float, default=SENSOR_WIDTH)
+    parser.add_argument('--image-format', choices=['png', 'webp'], default='png')
+    parser.add_argument('--compression', type=int, default=PNG_COMPRESSION,
+                        help='PNG zlib level, 0-9')
+
+    return parser.parse_args()
+
+
+def list_backgrounds():
+    return sorted(f for f in os.listdir(BACKGROUND_PATH) if f.endswith('.exr'))
+
+
+def load_hdri(path):
+    """
+    Reads the RGB channels of the equirectangular .exr as a float32 array,
+    first row at the top. The last backgrounds are cached, tasks are sorted
+    by background so every worker loads each one only a few times.
+    """
+    if path in hdri_cache:
+        hdri_cache.move_to_end(path)
+        return hdri_cache[path]
+
+    with OpenEXR.File(path) as f:
+        channels = f.channels()
+        if 'RGBA' in channels or 'RGB' in channels:
+            pixels = channels.get('RGBA', channels.get('RGB')).pixels[..., :3]
+        else:
+            pixels = np.stack([channels[name].pixels for name in 'RGB'], axis=-1)
+
+    image = np.ascontiguousarray(pixels, dtype=np.float32)
+
+    hdri_cache[path] = image
+    while len(hdri_cache) > HDRI_CACHE_SIZE:
+        hdri_cache.popitem(last=False)
+
+    return image
+
+
+def euler_to_matrix(rotation):
+    """
+    Rotation matrix of a blender XYZ euler.
+    """
+    x, y, z = rotation
+    rotation_x = np.array([[1, 0, 0], [0, math.cos(x), -math.sin(x)], [0, math.sin(x), math.cos(x)]])
+    rotation_y = np.array([[math.cos(y), 0, math.sin(y)], [0, 1, 0], [-math.sin(y), 0, math.cos(y)]])
+    rotation_z = np.array([[math.cos(z), -math.sin(z), 0], [math.sin(z), math.cos(z), 0], [0, 0, 1]])
+
+    return rotation_z @ rotation_y @ rotation_x
+
+
+@lru_cache(maxsize=4)
+def camera_rays(width, height, lens, sensor_width, supersample):
+    """
+    Camera space view direction of every (sub)pixel, shape (height *
+    supersample, width * supersample, 3). A blender camera looks down its -Z
+    axis with +Y up, and the sensor width matches the larger side of the
+    image (sensor fit auto).
+    """
+    pixel_size = sensor_width / lens / max(width, height)
+    columns = (np.arange(width * supersample) + 0.5) / supersample - width / 2
+    rows = (np.arange(height * supersample) + 0.5) / supersample - height / 2
+
+    x, y = np.meshgrid(columns * pixel_size, -rows * pixel_size)
+    rays = np.stack([x, y, -np.ones_like(x)], axis=-1)
+    rays /= np.linalg.norm(rays, axis=-1, keepdims=True)
+
+    return rays.astype(np.float32)
+
+
+def camera_directions(rotation, width, height, lens, sensor_width, supersample=SUPERSAMPLE):
+    """
+    World space view directions of a camera with the given XYZ euler
+    rotation.
+    """
+    rays = camera_rays(width, height, lens, sensor_width, supersample)
+
+    return rays @ euler_to_matrix(rotation).T.astype(np.float32)
+
+
+def sample_equirect(image, directions):
+    """
+    Bilinear lookup of the directions in the equirectangular image, with the
+    same mapping as the Environment Texture node.
+    """
+    height, width = image.shape[:2]
+    u = 0.5 - np.arctan2(directions[..., 1], directions[..., 0]) / (2 * np.pi)
+    v = 0.5 + np.arcsin(np.clip(directions[..., 2], -1, 1)) / np.pi
+
+    x = u * width - 0.5
+    y = (1 - v) * height - 0.5
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = (x - x0)[..., None]
+    fy = (y - y0)[..., None]
+
+    # the image wraps around horizontally, the poles are clamped
+    x0 = x0.astype(np.int64) % width
+    x1 = (x0 + 1) % width
+    y1 = np.clip(y0 + 1, 0, height - 1).astype(np.int64)
+    y0 = np.clip(y0, 0, height - 1).astype(np.int64)
+
+    top = image[y0, x0] * (1 - fx) + image[y0, x1] * fx
+    bottom = image[y1, x0] * (1 - fx) + image[y1, x1] * fx
+
+    return top * (1 - fy) + bottom * fy
+
+
+def plan_background_sample(run_seed, index, backgrounds):
+    """
+    Random camera rotation, background and strength of the sample, drawn in
+    the same order as auto_render.py.
+    """
+    seed = annotation_log.derive_seed(run_seed, 'background', index)
+    sample_random = random.Random(seed)
+
+    rotation = [sample_random.uniform(0, 2 * math.pi) for _ in range(3)]
+    background = sample_random.choice(backgrounds)
+    strength = sample_random.uniform(0.8, 2.5)
+
+    return {'seed': seed, 'rotation': rotation, 'background': background, 'strength': strength}
+
+
+def generate_background(sample, renders_path, lens, sensor_width,
+                        image_format='png', compression=PNG_COMPRESSION):
+    """
+    Projects the background of the sample into the camera and writes the
+    image. Returns the annotation record.
+    """
+    image = load_hdri(os.path.join(BACKGROUND_PATH, sample['background']))
+    directions = camera_directions(
+        sample['rotation'], X_RES, Y_RES, lens, sensor_width)
+
+    radiance = sample_equirect(image, directions) * sample['strength']
+    # box filter of the subpixels, like the pixel filter of the render
+    radiance = radiance.reshape(Y_RES, SUPERSAMPLE, X_RES, SUPERSAMPLE, 3).mean(axis=(1, 3))
+
+    pixels = np.round(agx_look(radiance) * 255).astype(np.uint8)
+
+    file_name = annotation_log.sample_file_name("background", sample['seed'], image_format)
+    file_path = f"{renders_path}/{file_name}"
+    write_image(file_path, pixels, image_format, compression)
+
+    return {
+        "file_path": file_path,
+        "file_name": file_name,
+        "model_name": "background",
+        "min_x": None,
+        "max_x": None,
+        "min_y": None,
+        "max_y": None,
+    }
+
+
+def generate_backgrounds(start, end, run_seed, workers, renders_path=RENDERS_PATH,
+                         annotations_path=ANNOTATIONS_PATH, lens=LENS, sensor_width=SENSOR_WIDTH,
+                         image_format='png', compression=PNG_COMPRESSION):
+    """
+    Generates the background samples [start, end) in a process pool,
+    skipping the ones already in the annotation log. The records are
+    appended by this process as the images are written.
+
+    Returns the number of images written.
+    """
+    os.makedirs(renders_path, exist_ok=True)
+    backgrounds = list_backgrounds()
+    finished_seeds = annotation_log.load_finished_seeds([annotations_path])
+
+    samples = [plan_background_sample(run_seed, index, backgrounds)
+               for index in range(start, end)]
+    samples = [sample for sample in samples if sample['seed'] not in finished_seeds]
+    # neighbour tasks share the background, so the worker cache is hit
+    samples.sort(key=lambda sample: sample['background'])
+
+    task = partial(generate_background, renders_path=renders_path,
+                   lens=lens, sensor_width=sensor_width,
+                   image_format=image_format, compression=compression)
+    chunk = max(1, len(samples) // (workers * 4))
+
+    written = 0
+    with Pool(workers) as pool:
+        for record in pool.imap_unordered(task, samples, chunksize=chunk):
+            annotation_log.append_records(annotations_path, [record], fsync=False)
+            written += 1
+
+    return written
+
+
+def __main__():
+    args = parse_args()
+
+    start = time.perf_counter()
+    written = generate_backgrounds(
+        args.start, args.start + args.samples, args.seed, args.workers,
+        args.renders_path, args.annotations, args.lens, args.sensor_width,
+        args.image_format, args.compression)
+    elapsed = time.perf_counter() - start
+
+    print(f"{written} background images in {elapsed:.1f} s "
+          f"({written / max(elapsed, 1e-9):.1f} images/s) appended to {args.annotations}.")
+
+
+if __name__ == "__main__":
+    __main__()
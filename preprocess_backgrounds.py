@@ -0,0 +1,193 @@
+import argparse
+import os
+import sys
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import OpenEXR
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+import atomic_file  # noqa: E402
+import cache_manifest  # noqa: E402
+import hdri_versions  # noqa: E402
+from generate_backgrounds import (  # noqa: E402
+    BACKGROUND_PATH, LENS, SENSOR_WIDTH, X_RES, Y_RES, hdri_cache, load_hdri)
+
+BACKGROUND_CACHE_PATH = './backgrounds/cache'
+# rows or columns resampled at once, bounds the float64 copy of the image
+BLOCK_SIZE = 256
+# a full size background takes a few GB, keep the pool small
+WORKERS = 2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Writes downsampled half float versions of the backgrounds for the render resolutions.')
+    parser.add_argument('--resolutions', nargs='+', default=[f'{X_RES}x{Y_RES}'],
+                        help='render resolutions to prepare versions for, e.g. 640x480 1280x960')
+    parser.add_argument('--lens', type=float, default=LENS)
+    parser.add_argument('--sensor-width', type=float, default=SENSOR_WIDTH)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--force', action='store_true',
+                        help='process every background, even the unchanged ones')
+
+    return parser.parse_args()
+
+
+def area_resize_axis(image, size, axis):
+    """
+    Resamples one axis of the image to `size` with an exact box filter:
+    every output texel is the mean of the input texels it covers, read from
+    the cumulative sum at its fractional edges.
+    """
+    image = np.moveaxis(image, axis, 0).astype(np.float64)
+    length = len(image)
+
+    cumulative = np.concatenate([np.zeros_like(image[:1]), np.cumsum(image, axis=0)])
+    edges = np.linspace(0, length, size + 1)
+    index = np.minimum(edges.astype(int), length - 1)
+    fraction = (edges - index).reshape(-1, *[1] * (image.ndim - 1))
+    at_edges = cumulative[index] + fraction * (cumulative[index + 1] - cumulative[index])
+
+    resized = (at_edges[1:] - at_edges[:-1]) / (length / size)
+    return np.moveaxis(resized.astype(np.float32), 0, axis)
+
+
+def area_resize(image, width, height):
+    """
+    Box filtered (height, width, 3) version of the image, resampled in
+    blocks so the float64 sums stay small.
+    """
+    narrow = np.concatenate([
+        area_resize_axis(image[start:start + BLOCK_SIZE], width, axis=1)
+        for start in range(0, len(image), BLOCK_SIZE)
+    ])
+
+    return np.concatenate([
+        area_resize_axis(narrow[:, start:start + BLOCK_SIZE], height, axis=0)
+        for start in range(0, width, BLOCK_SIZE)
+    ], axis=1)
+
+
+def write_exr(path, pixels):
+    """
+    Half float RGB .exr with ZIP compression, much faster to load than the
+    usual PIZ and half the size of full float.
+    """
+    header = {'compression': OpenEXR.ZIP_COMPRESSION, 'type': OpenEXR.scanlineimage}
+    # the sun of an HDRI can be brighter than the largest half float, keep
+    # it as bright as possible instead of inf
+    half_max = np.finfo(np.float16).max
+    channels = {'RGB': np.clip(pixels, -half_max, half_max).astype(np.float16)}
+
+    with atomic_file.temporary_path(path) as temporary_path, \
+            OpenEXR.File(header, channels) as f:
+        f.write(temporary_path)
+
+
+def preprocess_background(background, widths):
+    """
+    Writes a version of the background for every width smaller than its
+    own. Returns its manifest entry.
+    """
+    path = os.path.join(BACKGROUND_PATH, background)
+    fingerprint = cache_manifest.file_fingerprint(path)
+    image = load_hdri(path)
+    height, width = image.shape[:2]
+
+    versions = {}
+    for version in sorted(widths):
+        if version >= width:
+            # the source is used as it is
+            continue
+        file_name = f'{os.path.splitext(background)[0]}-{version}.exr'
+        write_exr(os.path.join(BACKGROUND_CACHE_PATH, file_name),
+                  area_resize(image, version, version // 2))
+        versions[str(version)] = file_name
+    # every background is read once, do not keep it
+    hdri_cache.pop(path, None)
+
+    return background, {**fingerprint, 'width': width, 'height': height, 'versions': versions}
+
+
+def is_unchanged(entry, path, widths):
+    """
+    Size and mtime first, the hash only when a file was touched.
+    """
+    if entry is None or not all(str(width) in entry['versions'] or width >= entry['width']
+                                for width in widths):
+        return False
+
+    stat = os.stat(path)
+    if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return True
+
+    return entry['sha256'] == cache_manifest.file_fingerprint(path)['sha256']
+
+
+def merge_entry(entry, new_entry):
+    """
+    New manifest entry of a preprocessed background, the versions of other
+    widths made from the same source are kept.
+    """
+    if entry is None or entry['sha256'] != new_entry['sha256']:
+        return new_entry
+
+    return {**new_entry, 'versions': {**entry['versions'], **new_entry['versions']}}
+
+
+def update_versions(widths, workers, force=False):
+    """
+    Writes the versions for `widths` of the backgrounds that miss one or
+    changed, and merges them into the manifest: the versions of other widths
+    stay for the runs at other resolutions. Returns the backgrounds preprocessed and the ones
+    unchanged.
+    """
+    os.makedirs(BACKGROUND_CACHE_PATH, exist_ok=True)
+    manifest = cache_manifest.read_manifest(BACKGROUND_CACHE_PATH)
+    backgrounds = sorted(f for f in os.listdir(BACKGROUND_PATH) if f.endswith('.exr'))
+
+    pending = []
+    unchanged = []
+    for background in backgrounds:
+        entry = manifest.get(background)
+        path = os.path.join(BACKGROUND_PATH, background)
+        if not force and is_unchanged(entry, path, widths):
+            # the mtime of a touched file is updated
+            stat = os.stat(path)
+            manifest[background] = {**entry, 'size': stat.st_size, 'mtime': stat.st_mtime}
+            unchanged.append(background)
+        else:
+            pending.append(background)
+
+    with Pool(workers) as pool:
+        task = partial(preprocess_background, widths=widths)
+        for background, entry in pool.imap_unordered(task, pending):
+            manifest[background] = merge_entry(manifest.get(background), entry)
+            print(f"Preprocessed {background} ({entry['width']}x{entry['height']}) "
+                  f"to widths {sorted(int(version) for version in entry['versions'])}.")
+
+    cache_manifest.write_manifest(BACKGROUND_CACHE_PATH, manifest)
+
+    return pending, unchanged
+
+
+def __main__():
+    args = parse_args()
+
+    widths = set()
+    for resolution in args.resolutions:
+        width, height = (int(value) for value in resolution.split('x'))
+        widths.add(hdri_versions.version_width(width, height, args.lens, args.sensor_width))
+
+    start = time.perf_counter()
+    pending, unchanged = update_versions(widths, args.workers, args.force)
+
+    print(f"{len(pending)} backgrounds preprocessed and {len(unchanged)} unchanged "
+          f"in {time.perf_counter() - start:.1f} s, versions {sorted(widths)} in {BACKGROUND_CACHE_PATH}.")
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,148 @@
+import argparse
+import os
+import sys
+import time
+
+import bpy
+
+# blender does not add the script folder to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+import auto_render  # noqa: E402
+from atomic_file import temporary_path  # noqa: E402
+from cache_manifest import file_fingerprint, read_manifest, write_manifest  # noqa: E402
+
+
+def parse_args():
+    """
+    Arguments given after `--` on the blender command line, e.g.
+    blender -b --python preprocess_models.py -- --force
+    """
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+
+    parser = argparse.ArgumentParser(
+        prog='preprocess_models.py',
+        description='Normalizes every model once and stores them in a single library file used by auto_render.py.')
+    parser.add_argument('--force', action='store_true',
+                        help='preprocess every model, even the unchanged ones')
+
+    return parser.parse_known_args(argv)[0]
+
+
+def is_unchanged(entry, fingerprint):
+    return entry is not None and entry['sha256'] == fingerprint['sha256']
+
+
+def check_material(obj, model):
+    """
+    auto_render.py randomizes the Principled BSDF of the first material slot,
+    the model cannot be used without it.
+    """
+    if not obj.material_slots or obj.material_slots[0].material is None:
+        print(f"{model} has no material in the first slot. Skipping.")
+        return False
+
+    material = obj.material_slots[0].material
+    material.use_nodes = True
+    if material.node_tree.nodes.get("Principled BSDF") is None:
+        print(f"{model} material has no Principled BSDF node. Skipping.")
+        return False
+
+    return True
+
+
+def preprocess_model(model):
+    """
+    Appends the model and normalizes it: origin at the bounds center and
+    scale applied to the mesh, with the projection hull stored as a mesh
+    property. Returns the object or None if the model can not be used.
+    """
+    obj = auto_render.append_model(model)
+    if obj is None:
+        return None
+
+    if not check_material(obj, model):
+        bpy.data.objects.remove(obj, do_unlink=True)
+        return None
+
+    # the source files usually share the object names
+    name = os.path.splitext(model)[0]
+    obj.name = name
+    obj.data.name = name
+
+    auto_render.normalize_model(obj)
+
+    auto_render.precompute_projection_hull(obj)
+    hull = auto_render.geometry_cache.pop(obj.name)['hull']
+    obj.data['projection_hull'] = hull.ravel().tolist()
+    obj['source_model'] = model
+
+    return obj
+
+
+def load_cached_objects(library_path, names):
+    """
+    Appends the objects of the previous library, so the unchanged models are
+    written again without being processed.
+    """
+    if not names or not os.path.exists(library_path):
+        return []
+
+    with bpy.data.libraries.load(library_path, link=False) as (data_from, data_to):
+        data_to.objects = [name for name in data_from.objects if name in names]
+
+    return [obj for obj in data_to.objects if obj is not None]
+
+
+def main():
+    args = parse_args()
+    cache_path = auto_render.MODEL_CACHE_PATH
+    library_path = os.path.join(cache_path, 'library.blend')
+    os.makedirs(cache_path, exist_ok=True)
+
+    manifest = {} if args.force else read_manifest(cache_path)
+    models = sorted(f for f in os.listdir(auto_render.MODELS_PATH)
+                    if f.endswith('.blend'))
+
+    start = time.perf_counter()
+    new_manifest = {}
+    unchanged = {}
+    objects = []
+    for model in models:
+        fingerprint = file_fingerprint(os.path.join(auto_render.MODELS_PATH, model))
+        entry = manifest.get(model)
+
+        if is_unchanged(entry, fingerprint):
+            unchanged[entry['object']] = model
+            new_manifest[model] = {**entry, **fingerprint}
+            continue
+
+        obj = preprocess_model(model)
+        if obj is None:
+            continue
+
+        objects.append(obj)
+        new_manifest[model] = {'object': obj.name, **fingerprint}
+        print(f"Preprocessed {model} as {obj.name}.")
+
+    cached_objects = load_cached_objects(library_path, set(unchanged))
+    if len(cached_objects) < len(unchanged):
+        # the library is missing objects, run again to process them
+        found = {obj.name for obj in cached_objects}
+        for name, model in unchanged.items():
+            if name not in found:
+                print(f"{name} is missing from {library_path}, run again to preprocess {model}.")
+                new_manifest.pop(model)
+
+    with temporary_path(library_path) as temporary_library:
+        bpy.data.libraries.write(
+            temporary_library, set(objects + cached_objects), fake_user=True)
+
+    write_manifest(cache_path, new_manifest)
+
+    print(f"{len(objects)} models preprocessed and {len(cached_objects)} unchanged "
+          f"in {time.perf_counter() - start:.1f} s, library in {library_path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+import annotation_log  # noqa: E402
+import generate_backgrounds  # noqa: E402
+import work_queue  # noqa: E402
+
+MODELS_PATH = "./models"
+RENDERS_PATH = './renders'
+ANNOTATIONS_PATH = 'annotations.jsonl'
+WORK_PATH = './shards'
+SAMPLES_NUMBER = 10
+BACKGROUND_SAMPLES = int(SAMPLES_NUMBER*0.25)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Runs auto_render.py in several headless blender workers and merges the results.')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='render threads per worker, by default the cores are split between the workers')
+    parser.add_argument('--samples', type=int, default=SAMPLES_NUMBER,
+                        help='samples per model')
+    parser.add_argument('--background-samples', type=int,
+                        default=BACKGROUND_SAMPLES)
+    parser.add_argument('--chunk', type=int, default=0,
+                        help='samples per task, by default a model is split evenly between the workers')
+    parser.add_argument('--blender', default='blender')
+    parser.add_argument('--scene', default=None,
+                        help='.blend file with the camera and world, the factory startup scene if not set')
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='run seed, rerunning with the same seed only renders the missing samples')
+    parser.add_argument('--work-path', default=WORK_PATH)
+    parser.add_argument('--queue', default=None,
+                        help='shared work queue directory, workers of other nodes can join with '
+                             'auto_render.py --queue')
+    parser.add_argument('--async-encode', action='store_true',
+                        help='encode the images in separate processes while the workers render')
+    parser.add_argument('--masks', action='store_true',
+                        help='also write the object mask of every sample')
+    parser.add_argument('--tight-labels', action='store_true',
+                        help='also record the visible box and occlusion from the rendered masks')
+    parser.add_argument('--models-per-image', type=int, default=1,
+                        help='models placed in every render, each with its own box')
+    parser.add_argument('--image-format', choices=['png', 'webp'], default='png')
+    parser.add_argument('--render-backgrounds', action='store_true',
+                        help='render the background samples with cycles instead of projecting the HDRIs')
+
+    return parser.parse_args()
+
+
+def split_tasks(models, samples, workers, chunk):
+    """
+    Splits every model in (model, start, end) ranges of `chunk` samples and
+    spreads them over the workers, always giving the next range to the worker
+    with less samples. Consecutive ranges of the same model are merged, so a
+    worker loads each model only once.
+    """
+    chunk = chunk or math.ceil(samples / workers)
+    shards = [[] for _ in range(workers)]
+    loads = [0] * workers
+
+    for model in models:
+        for start in range(0, samples, chunk):
+            end = min(start + chunk, samples)
+            worker = loads.index(min(loads))
+            tasks = shards[worker]
+
+            if tasks and tasks[-1]['model'] == model and tasks[-1]['end'] == start:
+                tasks[-1]['end'] = end
+            else:
+                tasks.append({'model': model, 'start': start, 'end': end})
+            loads[worker] += end - start
+
+    return shards
+
+
+def launch_worker(args, worker, tasks, background_task, threads):
+    worker_path = os.path.join(args.work_path, f'worker-{worker}')
+    os.makedirs(os.path.join(worker_path, 'renders'), exist_ok=True)
+
+    if args.queue:
+        # the queue workers write straight to the shared folders
+        task_arguments = ['--queue', args.queue, '--renders-path', RENDERS_PATH]
+    else:
+        shard_path = os.path.join(worker_path, 'shard.json')
+        with open(shard_path, 'w') as f:
+            json.dump({'tasks': tasks, 'background': background_task}, f)
+        task_arguments = ['--shard', shard_path,
+                          '--renders-path', os.path.join(worker_path, 'renders')]
+
+    command = [args.blender, '-b']
+    if args.scene:
+        command.append(args.scene)
+    command += [
+        '--python', 'auto_render.py', '--',
+        *task_arguments,
+        '--annotations', os.path.join(worker_path, 'annotations.jsonl'),
+        '--metrics', os.path.join(worker_path, 'metrics.prom'),
+        '--telemetry-log', os.path.join(worker_path, 'telemetry.jsonl'),
+        '--threads', str(threads),
+        '--seed', str(args.seed),
+        # samples merged by a previous run are not rendered again
+        '--finished-log', ANNOTATIONS_PATH,
+    ]
+    if args.cpu:
+        command.append('--cpu')
+    if args.async_encode:
+        command.append('--async-encode')
+    if args.masks:
+        command.append('--masks')
+    if args.tight_labels:
+        command.append('--tight-labels')
+    command += ['--models-per-image', str(args.models_per_image)]
+    command += ['--image-format', args.image_format]
+
+    log = open(os.path.join(worker_path, 'worker.log'), 'w')
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+    return process, log, worker_path
+
+
+def move_output(source, destination):
+    """
+    Moves a file of the worker, already moved if the source is gone and the
+    destination is there. Returns False if neither exists.
+    """
+    if os.path.exists(source):
+        shutil.move(source, destination)
+        return True
+
+    return os.path.exists(destination)
+
+
+def merge_worker(worker_path):
+    """
+    Moves the worker renders into RENDERS_PATH and appends its annotations,
+    with the updated file paths, to ANNOTATIONS_PATH. Running it again after
+    an interruption finishes the merge: moved files are found at their new
+    path and the records already in ANNOTATIONS_PATH are not appended again.
+    The worker renders and log are removed once the append is on disk.
+    Returns the records appended.
+    """
+    log_path = os.path.join(worker_path, 'annotations.jsonl')
+    records = []
+
+    for record in annotation_log.read_records(log_path):
+        file_path = f"{RENDERS_PATH}/{record['file_name']}"
+        moved = move_output(record['file_path'], file_path)
+        record['file_path'] = file_path
+
+        for key in ('mask_path', 'instance_mask_path'):
+            if key in record:
+                mask_path = f"{RENDERS_PATH}/masks/{os.path.basename(record[key])}"
+                moved = move_output(record[key], mask_path) and moved
+                record[key] = mask_path
+
+        if moved:
+            records.append(record)
+        else:
+            print(f"{record['file_name']} of {worker_path} is missing, not merged.")
+
+    records = annotation_log.append_new_records(ANNOTATIONS_PATH, records)
+
+    # every record is in ANNOTATIONS_PATH now, a second merge has nothing to add
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    shutil.rmtree(os.path.join(worker_path, 'renders'), ignore_errors=True)
+
+    return records
+
+
+def __main__():
+    args = parse_args()
+    threads = args.threads or max(1, os.cpu_count() // args.workers)
+
+    models = [f for f in os.listdir(MODELS_PATH) if f.endswith('.blend')]
+    shards = split_tasks(models, args.samples, args.workers, args.chunk)
+    # disjoint background sample ranges, so their seeds never repeat
+    rendered_backgrounds = args.background_samples if args.render_backgrounds else 0
+    background_chunk = math.ceil(rendered_backgrounds / args.workers)
+    background_shards = [
+        {
+            'start': min(worker * background_chunk, rendered_backgrounds),
+            'end': min((worker + 1) * background_chunk, rendered_backgrounds),
+        }
+        for worker in range(args.workers)
+    ]
+
+    print(f"Rendering {len(models)} models x {args.samples} samples with "
+          f"{args.workers} workers of {threads} threads.")
+
+    queue = None
+    if args.queue:
+        queue = work_queue.WorkQueue(args.queue)
+        added = queue.create(work_queue.plan_tasks(
+            models, args.samples, args.chunk or work_queue.CHUNK, rendered_backgrounds),
+            {'seed': args.seed})
+        print(f"Added {added} tasks to the queue in {args.queue}: {queue.status()}")
+
+    start = time.perf_counter()
+    workers = [
+        launch_worker(args, worker, tasks,
+                      background_shards[worker], threads)
+        for worker, tasks in enumerate(shards)
+    ]
+
+    os.makedirs(os.path.join(RENDERS_PATH, 'masks'), exist_ok=True)
+    merged = 0
+    if not args.render_backgrounds:
+        # no render needed, done while the workers render the models
+        generated = generate_backgrounds.generate_backgrounds(
+            0, args.background_samples, args.seed, args.workers, RENDERS_PATH, ANNOTATIONS_PATH,
+            image_format=args.image_format)
+        print(f"{generated} background images projected from the HDRIs.")
+
+    for worker, (process, log, worker_path) in enumerate(workers):
+        return_code = process.wait()
+        log.close()
+        records = merge_worker(worker_path)
+        merged += len(records)
+
+        status = 'finished' if return_code == 0 else f'failed ({return_code})'
+        print(f"Worker {worker} {status}: {len(records)} images, "
+              f"log in {worker_path}/worker.log")
+
+    if queue is not None:
+        # workers of other nodes may still hold tasks, merge once all are done
+        if queue.is_finished():
+            merged += work_queue.merge_logs(queue, ANNOTATIONS_PATH)
+        else:
+            print(f"Tasks left in {args.queue}: {queue.status()}, merge them later with "
+                  f"python utils/work_queue.py merge {args.queue}")
+
+    elapsed = time.perf_counter() - start
+    exported = annotation_log.export_bb_json([ANNOTATIONS_PATH])
+
+    print(f"{merged} images in {elapsed:.1f} s "
+          f"({merged / elapsed * 60:.1f} images/min) merged into {ANNOTATIONS_PATH}, "
+          f"{exported} bounding boxes exported to {annotation_log.BB_PATH}.")
+
+
+if __name__ == "__main__":
+    __main__()
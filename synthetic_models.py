@@ -0,0 +1,26 @@
+import bmesh
+import bpy
+import numpy as np
+
+
+def create_bumpy_sphere(name, segments, stretch=(1.0, 1.0, 1.0)):
+    """
+    Mesh of a bumpy uv sphere with `segments` segments around, shaped like a
+    real part: most vertices are not on the hull. `stretch` scales the axes
+    before the bumps, so that no rotation leaves the outline unchanged.
+    """
+    mesh = bpy.data.meshes.new(name)
+    bm = bmesh.new()
+    bmesh.ops.create_uvsphere(bm, u_segments=segments,
+                              v_segments=segments // 2, radius=1.0)
+    bm.to_mesh(mesh)
+    bm.free()
+
+    coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', coordinates)
+    coordinates = coordinates.reshape(-1, 3) * np.asarray(stretch, dtype=np.float32)
+    bumps = 1 + 0.3 * np.prod(np.sin(5 * coordinates), axis=1)
+    mesh.vertices.foreach_set('co', (coordinates * bumps[:, None]).ravel())
+    mesh.update()
+
+    return mesh
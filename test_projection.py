@@ -0,0 +1,113 @@
+import math
+import os
+import sys
+
+import bpy
+import numpy as np
+
+# blender does not add the script folder to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import auto_render  # noqa: E402
+from synthetic_models import create_bumpy_sphere  # noqa: E402
+
+# random poses checked for every camera setup
+POSES = 40
+# (shift_x, shift_y) of the camera lens
+LENS_SHIFTS = [(0.0, 0.0), (0.3, -0.15), (-0.45, 0.35)]
+# landscape and portrait, the sensor fit changes with the larger side
+RESOLUTIONS = [(640, 480), (480, 640)]
+ORTHO_SCALE = 8.0
+TOLERANCE = 1e-4
+
+
+def create_test_object(name='ProjectionTest', segments=48):
+    """
+    Bumpy uneven sphere linked to the scene, so every rotation moves the
+    extreme vertices.
+    """
+    obj = bpy.data.objects.new(name, create_bumpy_sphere(name, segments, stretch=(1.0, 0.6, 1.4)))
+    auto_render.scene.collection.objects.link(obj)
+
+    return obj
+
+
+def random_poses(rng, count):
+    """
+    (location, rotation) in front of the camera at (0, -8, 0) looking along
+    +y, some of them partly out of the frame so the box is clamped, and one
+    behind the camera.
+    """
+    for _ in range(count):
+        location = (rng.uniform(-4, 4), rng.uniform(-4, 4), rng.uniform(-3, 3))
+        yield location, tuple(rng.uniform(0, 2 * math.pi, 3))
+
+    yield (0.0, -14.0, 0.0), (0.0, 0.0, 0.0)
+
+
+def camera_setups(scene, camera):
+    """
+    Sets up the camera for every case in turn and yields its name.
+    """
+    for camera_type in ('PERSP', 'ORTHO'):
+        for resolution_x, resolution_y in RESOLUTIONS:
+            for shift_x, shift_y in LENS_SHIFTS:
+                camera.data.type = camera_type
+                camera.data.ortho_scale = ORTHO_SCALE
+                camera.data.shift_x = shift_x
+                camera.data.shift_y = shift_y
+                scene.render.resolution_x = resolution_x
+                scene.render.resolution_y = resolution_y
+
+                yield (f'{camera_type} {resolution_x}x{resolution_y} '
+                       f'shift ({shift_x}, {shift_y})')
+
+
+def check_poses(obj, rng, label):
+    """
+    Compares get_2d_bounding_box with the per-vertex reference for random
+    poses of the object, returns the number of checks and of mismatches.
+    """
+    checks = failures = 0
+    for location, rotation in random_poses(rng, POSES):
+        obj.location = location
+        obj.rotation_euler = rotation
+        bpy.context.view_layer.update()
+
+        checks += 1
+        try:
+            auto_render.verify_projection(obj, auto_render.scene, auto_render.camera, TOLERANCE)
+        except AssertionError as error:
+            failures += 1
+            print(f"{label}: {error}")
+
+    return checks, failures
+
+
+def main():
+    scene = auto_render.scene
+    camera = auto_render.camera
+    camera.constraints.clear()
+    camera.location = (0.0, -8.0, 0.0)
+    camera.rotation_euler = (math.pi / 2, 0.0, 0.0)
+
+    obj = create_test_object()
+    rng = np.random.default_rng(0)
+
+    checks = failures = 0
+    # every vertex first, then only the cached convex hull
+    for use_hull in (False, True):
+        if use_hull:
+            auto_render.precompute_projection_hull(obj)
+        for label in camera_setups(scene, camera):
+            case_checks, case_failures = check_poses(
+                obj, rng, f"{label}{' hull' if use_hull else ''}")
+            checks += case_checks
+            failures += case_failures
+
+    print(f"{checks - failures} of {checks} bounding boxes match the per-vertex projection.")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from conftest import ROOT
+
+BLENDER = shutil.which('blender')
+
+# imports a benchmark and auto_render with the argv of the benchmark, prints
+# what both parsed
+PARSE_SCRIPT = '''
+import json
+import sys
+
+sys.path.append({root!r})
+import {benchmark}
+import auto_render
+
+print('PARSED ' + json.dumps({{
+    'model': {benchmark}.parse_args().model,
+    'models_per_image': auto_render.parse_args().models_per_image,
+}}))
+'''
+
+
+@pytest.mark.skipif(BLENDER is None, reason='needs blender on the path')
+@pytest.mark.parametrize('benchmark', ['benchmark_batch', 'benchmark_quality'])
+def test_benchmark_flags_are_not_abbreviations(tmp_path, benchmark):
+    script = tmp_path / 'parse.py'
+    script.write_text(PARSE_SCRIPT.format(root=ROOT, benchmark=benchmark))
+
+    result = subprocess.run(
+        [BLENDER, '-b', '--python-exit-code', '1', '--python', str(script),
+         '--', '--model', 'gun.blend', '--samples', '4'],
+        cwd=ROOT, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    parsed = next(line for line in result.stdout.splitlines() if line.startswith('PARSED '))
+    assert json.loads(parsed[len('PARSED '):]) == {'model': 'gun.blend', 'models_per_image': 1}
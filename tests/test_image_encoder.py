@@ -0,0 +1,73 @@
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_encoder
+from conftest import ROOT
+
+
+def random_render(rng, width=32, height=24):
+    return rng.uniform(0, 4, width * height * 4).astype(np.float32)
+
+
+def test_pool_writes_the_display_image(tmp_path):
+    rng = np.random.default_rng(0)
+    renders = [random_render(rng) for _ in range(6)]
+
+    pool = image_encoder.EncoderPool(processes=2, queue_depth=3)
+    try:
+        futures = [pool.submit(pixels, 32, 24, str(tmp_path / f'{index}.png'))
+                   for index, pixels in enumerate(renders)]
+        for future in futures:
+            future.result(timeout=60)
+    finally:
+        pool.close()
+
+    for index, pixels in enumerate(renders):
+        with Image.open(tmp_path / f'{index}.png') as image:
+            written = np.asarray(image)
+        np.testing.assert_array_equal(written, image_encoder.render_to_display(pixels, 32, 24))
+
+
+def test_pool_reports_a_failed_write(tmp_path):
+    pool = image_encoder.EncoderPool(processes=1)
+    try:
+        future = pool.submit(random_render(np.random.default_rng(0)), 32, 24,
+                             str(tmp_path / 'missing' / 'render.png'))
+        with pytest.raises(RuntimeError, match='FileNotFoundError'):
+            future.result(timeout=60)
+    finally:
+        pool.close()
+
+
+def test_pool_does_not_import_the_main_script(tmp_path):
+    """
+    Inside blender the __main__ module is auto_render.py, which only imports
+    with bpy. A main script that fails outside of its own process stands
+    for it.
+    """
+    script = tmp_path / 'render_script.py'
+    script.write_text(textwrap.dedent(f'''
+        import sys
+        sys.path.append({ROOT + '/utils'!r})
+        import blender_only  # noqa: F401
+        import numpy as np
+        import image_encoder
+
+        pool = image_encoder.EncoderPool(processes=1)
+        pixels = np.ones(8 * 6 * 4, dtype=np.float32)
+        pool.submit(pixels, 8, 6, {str(tmp_path / 'render.png')!r}).result(timeout=60)
+        pool.close()
+    '''))
+    runner = (
+        'import runpy, sys, types\n'
+        "sys.modules['blender_only'] = types.ModuleType('blender_only')\n"
+        f"runpy.run_path({str(script)!r}, run_name='__main__')\n"
+    )
+
+    subprocess.run([sys.executable, '-c', runner], check=True, timeout=120)
+    assert (tmp_path / 'render.png').exists()
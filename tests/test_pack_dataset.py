@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+import pack_dataset
+
+
+def write_split(path, split, count):
+    for folder in ('images', 'labels'):
+        os.makedirs(path / folder / split, exist_ok=True)
+    for index in range(count):
+        Image.fromarray(np.full((4, 4, 3), index, dtype=np.uint8)).save(
+            path / 'images' / split / f'{index}.png')
+        (path / 'labels' / split / f'{index}.txt').write_text(f'0 0.5 0.5 0.{index + 1} 0.1')
+
+
+def test_repack_leaves_no_stale_shard(tmp_path, monkeypatch):
+    monkeypatch.setattr(pack_dataset, 'OUT_IMAGE_PATH', str(tmp_path / 'images'))
+    monkeypatch.setattr(pack_dataset, 'OUT_LABEL_PATH', str(tmp_path / 'labels'))
+    output = tmp_path / 'packed'
+
+    write_split(tmp_path, 'train', 5)
+    # one sample per shard
+    assert len(pack_dataset.pack_split('train', str(output), 1, with_array=True)['shards']) == 5
+
+    for index in (3, 4):
+        os.remove(tmp_path / 'images' / 'train' / f'{index}.png')
+    meta = pack_dataset.pack_split('train', str(output), 1, with_array=True)
+
+    assert os.listdir(output) == ['train']
+    assert sorted(name for name in os.listdir(output / 'train') if name.endswith('.tar')) == meta['shards']
+    dataset = pack_dataset.PackedDataset(str(output / 'train'))
+    assert len(dataset) == 3
+    assert dataset[2][1] == '0 0.5 0.5 0.3 0.1'
+    assert (dataset[2][0] == 2).all()
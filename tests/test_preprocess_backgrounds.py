@@ -0,0 +1,63 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+OpenEXR = pytest.importorskip('OpenEXR')
+import preprocess_backgrounds  # noqa: E402
+
+
+@pytest.fixture
+def backgrounds(tmp_path, monkeypatch):
+    background_path = tmp_path / 'backgrounds'
+    cache_path = background_path / 'cache'
+    os.makedirs(background_path)
+    monkeypatch.setattr(preprocess_backgrounds, 'BACKGROUND_PATH', str(background_path))
+    monkeypatch.setattr(preprocess_backgrounds, 'BACKGROUND_CACHE_PATH', str(cache_path))
+
+    rng = np.random.default_rng(0)
+    for name in ('sky.exr', 'studio.exr'):
+        pixels = rng.uniform(0, 2, (128, 256, 3)).astype(np.float32)
+        header = {'compression': OpenEXR.ZIP_COMPRESSION, 'type': OpenEXR.scanlineimage}
+        with OpenEXR.File(header, {'RGB': pixels}) as f:
+            f.write(str(background_path / name))
+
+    return cache_path
+
+
+def read_manifest(cache_path):
+    with open(cache_path / 'manifest.json') as f:
+        return json.load(f)
+
+
+def test_versions_of_other_widths_are_kept(backgrounds):
+    pending, _ = preprocess_backgrounds.update_versions({64}, workers=1)
+    assert pending == ['sky.exr', 'studio.exr']
+
+    pending, _ = preprocess_backgrounds.update_versions({128}, workers=1)
+    assert pending == ['sky.exr', 'studio.exr']
+    manifest = read_manifest(backgrounds)
+    for background in ('sky', 'studio'):
+        assert manifest[f'{background}.exr']['versions'] == {
+            '64': f'{background}-64.exr', '128': f'{background}-128.exr'}
+
+    # every width is there, nothing to rebuild
+    pending, unchanged = preprocess_backgrounds.update_versions({64, 128}, workers=1)
+    assert pending == []
+    assert unchanged == ['sky.exr', 'studio.exr']
+
+
+def test_changed_background_drops_its_old_versions(backgrounds):
+    preprocess_backgrounds.update_versions({64}, workers=1)
+
+    sky = os.path.join(preprocess_backgrounds.BACKGROUND_PATH, 'sky.exr')
+    header = {'compression': OpenEXR.ZIP_COMPRESSION, 'type': OpenEXR.scanlineimage}
+    with OpenEXR.File(header, {'RGB': np.ones((128, 256, 3), dtype=np.float32)}) as f:
+        f.write(sky)
+    pending, _ = preprocess_backgrounds.update_versions({128}, workers=1)
+
+    assert pending == ['sky.exr', 'studio.exr']
+    manifest = read_manifest(backgrounds)
+    assert manifest['sky.exr']['versions'] == {'128': 'sky-128.exr'}
+    assert set(manifest['studio.exr']['versions']) == {'64', '128'}
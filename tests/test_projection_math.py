@@ -0,0 +1,147 @@
+import math
+
+import numpy as np
+import pytest
+
+from projection import bounding_box_from_projection, frame_projection_matrix, project_points
+
+LENS = 50.0
+SENSOR_WIDTH = 36.0
+ORTHO_SCALE = 8.0
+LENS_SHIFTS = [(0.0, 0.0), (0.3, -0.15), (-0.45, 0.35)]
+RESOLUTIONS = [(640, 480), (480, 640)]
+POSES = 40
+TOLERANCE = 1e-6
+
+
+def view_frame(width, height, shift_x, shift_y, orthographic):
+    """
+    Corners of the view frame of a blender camera with sensor fit auto, in
+    the order of Camera.view_frame: top right, bottom right, bottom left,
+    top left.
+    """
+    if orthographic:
+        size, depth = ORTHO_SCALE, -1.0
+    else:
+        size, depth = SENSOR_WIDTH / LENS, -1.0
+
+    # the sensor matches the larger side, the shift is relative to it
+    half_x = size / 2 * min(1.0, width / height)
+    half_y = size / 2 * min(1.0, height / width)
+    center_x, center_y = shift_x * size, shift_y * size
+
+    return np.array([
+        [center_x + half_x, center_y + half_y, depth],
+        [center_x + half_x, center_y - half_y, depth],
+        [center_x - half_x, center_y - half_y, depth],
+        [center_x - half_x, center_y + half_y, depth],
+    ])
+
+
+def world_to_camera_view(frame, orthographic, camera_world, point):
+    """
+    Port of bpy_extras.object_utils.world_to_camera_view for one point.
+    """
+    co_local = np.linalg.inv(camera_world) @ np.append(point, 1.0)
+    z = -co_local[2]
+
+    corners = [np.array(corner) for corner in frame[:3]]
+    if not orthographic:
+        if z == 0.0:
+            return np.array([0.5, 0.5, 0.0])
+        corners = [-(corner / (corner[2] / z)) for corner in corners]
+
+    min_x, max_x = corners[2][0], corners[1][0]
+    min_y, max_y = corners[1][1], corners[0][1]
+
+    return np.array([(co_local[0] - min_x) / (max_x - min_x),
+                     (co_local[1] - min_y) / (max_y - min_y),
+                     z])
+
+
+def per_vertex_box(points, matrix_world, frame, orthographic, camera_world):
+    """
+    The loop of get_2d_bounding_box_per_vertex over world_to_camera_view.
+    """
+    coordinates = [
+        world_to_camera_view(frame, orthographic, camera_world, (matrix_world @ np.append(point, 1.0))[:3])
+        for point in points
+    ]
+    visible = [coordinate for coordinate in coordinates if coordinate[2] > 0]
+    if not visible:
+        return None
+
+    box_min_x = max(0.0, min(coordinate[0] for coordinate in visible))
+    box_max_x = min(1.0, max(coordinate[0] for coordinate in visible))
+    box_min_y = max(0.0, min(coordinate[1] for coordinate in visible))
+    box_max_y = min(1.0, max(coordinate[1] for coordinate in visible))
+    if (box_max_x - box_min_x) * (box_max_y - box_min_y) <= 0:
+        return None
+
+    return {'min_x': box_min_x, 'max_x': box_max_x, 'min_y': box_min_y, 'max_y': box_max_y}
+
+
+def euler_matrix(rotation):
+    """
+    Rotation matrix of blender XYZ euler angles.
+    """
+    x, y, z = rotation
+    rx = np.array([[1, 0, 0], [0, math.cos(x), -math.sin(x)], [0, math.sin(x), math.cos(x)]])
+    ry = np.array([[math.cos(y), 0, math.sin(y)], [0, 1, 0], [-math.sin(y), 0, math.cos(y)]])
+    rz = np.array([[math.cos(z), -math.sin(z), 0], [math.sin(z), math.cos(z), 0], [0, 0, 1]])
+
+    return rz @ ry @ rx
+
+
+def transform(rotation, location):
+    matrix = np.eye(4)
+    matrix[:3, :3] = euler_matrix(rotation)
+    matrix[:3, 3] = location
+    return matrix
+
+
+def bumpy_points(rng, count=500):
+    """
+    Points of an uneven bumpy sphere, like the synthetic models.
+    """
+    directions = rng.normal(size=(count, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    directions *= (1.0, 0.6, 1.4)
+    bumps = 1 + 0.3 * np.prod(np.sin(5 * directions), axis=1)
+
+    return (directions * bumps[:, None]).astype(np.float32)
+
+
+def random_poses(rng, count):
+    """
+    Poses in front of the camera at (0, -8, 0) looking along +y, some partly
+    out of the frame, one partly behind the camera and one behind it.
+    """
+    for _ in range(count):
+        yield (rng.uniform(0, 2 * math.pi, 3),
+               (rng.uniform(-4, 4), rng.uniform(-4, 4), rng.uniform(-3, 3)))
+    yield (0.0, 0.0, 0.0), (0.0, -8.0, 0.0)
+    yield (0.0, 0.0, 0.0), (0.0, -14.0, 0.0)
+
+
+@pytest.mark.parametrize('orthographic', [False, True])
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+@pytest.mark.parametrize('shift', LENS_SHIFTS)
+def test_vectorized_box_matches_per_vertex(orthographic, resolution, shift):
+    rng = np.random.default_rng(0)
+    points = bumpy_points(rng)
+    frame = view_frame(*resolution, *shift, orthographic)
+    camera_world = transform((math.pi / 2, 0.0, 0.0), (0.0, -8.0, 0.0))
+    projection_matrix = frame_projection_matrix(frame, orthographic) @ np.linalg.inv(camera_world)
+
+    for rotation, location in random_poses(rng, POSES):
+        matrix_world = transform(rotation, location)
+        box = bounding_box_from_projection(*project_points(points, matrix_world, projection_matrix))
+        reference = per_vertex_box(points, matrix_world, frame, orthographic, camera_world)
+
+        if reference is None:
+            assert box is None
+            continue
+        assert box is not None
+        for key, value in reference.items():
+            assert box[key] == pytest.approx(value, abs=TOLERANCE)
@@ -0,0 +1,77 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip('OpenEXR')
+import annotation_log  # noqa: E402
+import render_driver  # noqa: E402
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    renders_path = tmp_path / 'renders'
+    os.makedirs(renders_path / 'masks')
+    monkeypatch.setattr(render_driver, 'RENDERS_PATH', str(renders_path))
+    monkeypatch.setattr(render_driver, 'ANNOTATIONS_PATH', str(tmp_path / 'annotations.jsonl'))
+
+    worker_path = tmp_path / 'worker-0'
+    os.makedirs(worker_path / 'renders' / 'masks')
+    records = []
+    for index in range(4):
+        file_name = f'model-{index:016x}.png'
+        record = {
+            'file_name': file_name,
+            'file_path': str(worker_path / 'renders' / file_name),
+            'mask_path': str(worker_path / 'renders' / 'masks' / file_name),
+        }
+        for path in (record['file_path'], record['mask_path']):
+            with open(path, 'w') as f:
+                f.write(file_name)
+        records.append(record)
+    annotation_log.append_records(str(worker_path / 'annotations.jsonl'), records)
+
+    return worker_path, records
+
+
+def merged_names():
+    return [record['file_name'] for record in annotation_log.read_records(render_driver.ANNOTATIONS_PATH)]
+
+
+def test_interrupted_merge_is_finished_once(worker):
+    worker_path, records = worker
+    # the first merge moved two images and appended one record before it stopped
+    moved = []
+    for record in records[:2]:
+        moved.append({
+            **record,
+            'file_path': os.path.join(render_driver.RENDERS_PATH, record['file_name']),
+            'mask_path': os.path.join(render_driver.RENDERS_PATH, 'masks', record['file_name']),
+        })
+        os.replace(record['file_path'], moved[-1]['file_path'])
+        os.replace(record['mask_path'], moved[-1]['mask_path'])
+    annotation_log.append_records(render_driver.ANNOTATIONS_PATH, moved[:1])
+
+    appended = render_driver.merge_worker(str(worker_path))
+
+    assert [record['file_name'] for record in appended] == [record['file_name'] for record in records[1:]]
+    assert merged_names() == [record['file_name'] for record in records]
+    for record in annotation_log.read_records(render_driver.ANNOTATIONS_PATH):
+        with open(record['file_path']) as f:
+            assert f.read() == record['file_name']
+        assert os.path.exists(record['mask_path'])
+    assert not os.path.exists(worker_path / 'annotations.jsonl')
+
+    assert render_driver.merge_worker(str(worker_path)) == []
+    assert merged_names() == [record['file_name'] for record in records]
+
+
+def test_missing_image_is_not_merged(worker):
+    worker_path, records = worker
+    os.remove(records[3]['file_path'])
+
+    render_driver.merge_worker(str(worker_path))
+
+    assert merged_names() == [record['file_name'] for record in records[:3]]
+    with open(render_driver.ANNOTATIONS_PATH) as f:
+        assert all(json.loads(line)['file_path'].startswith(render_driver.RENDERS_PATH) for line in f)
@@ -0,0 +1,124 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+import work_queue
+from conftest import ROOT
+
+LEASE_SECONDS = 1.0
+HEARTBEAT_SECONDS = 0.2
+
+
+@pytest.fixture(autouse=True)
+def short_poll(monkeypatch):
+    monkeypatch.setattr(work_queue, 'POLL_SECONDS', 0.1)
+
+
+def make_queue(path, worker):
+    return work_queue.WorkQueue(str(path), worker=worker, lease_seconds=LEASE_SECONDS,
+                                heartbeat_seconds=HEARTBEAT_SECONDS)
+
+
+def create_tasks(queue, models=('a.blend', 'b.blend'), samples=20):
+    tasks = work_queue.plan_tasks(models, samples, chunk=10)
+    queue.create(tasks, {'seed': 0})
+    return [task_id for task_id, _ in tasks]
+
+
+def expire(queue, task_id):
+    past = time.time() - 10 * LEASE_SECONDS
+    os.utime(queue.lease_path(task_id), (past, past))
+
+
+def done_by(queue, task_id):
+    return work_queue.read_json(queue.done_path(task_id))['worker']
+
+
+def test_killed_worker_task_is_finished_once(tmp_path):
+    task_ids = create_tasks(make_queue(tmp_path, 'creator'))
+
+    crashing = subprocess.Popen([sys.executable, '-c', textwrap.dedent(f'''
+        import sys
+        import time
+        sys.path.append({os.path.join(ROOT, 'utils')!r})
+        import work_queue
+
+        queue = work_queue.WorkQueue({str(tmp_path)!r}, worker='crashing',
+                                     lease_seconds={LEASE_SECONDS}, heartbeat_seconds={HEARTBEAT_SECONDS})
+        for task_id, task in queue.leased_tasks():
+            print(task_id, flush=True)
+            time.sleep(60)
+    ''')], stdout=subprocess.PIPE, text=True)
+    crashed_task = crashing.stdout.readline().strip()
+    # its heartbeat kept the lease alive until now
+    time.sleep(2 * LEASE_SECONDS)
+    crashing.send_signal(signal.SIGKILL)
+    crashing.wait()
+
+    survivor = make_queue(tmp_path, 'survivor')
+    finished = [task_id for task_id, _ in survivor.leased_tasks()]
+
+    assert crashed_task in task_ids
+    assert sorted(finished) == sorted(task_ids)
+    assert all(done_by(survivor, task_id) == 'survivor' for task_id in task_ids)
+    assert survivor.status() == {'done': len(task_ids), 'leased': 0, 'expired': 0, 'pending': 0}
+
+
+def test_stale_worker_cannot_commit(tmp_path):
+    stale = make_queue(tmp_path, 'stale')
+    create_tasks(stale, models=('a.blend',), samples=10)
+
+    tasks = stale.leased_tasks(wait=False)
+    task_id, _ = next(tasks)
+    # the worker stalls longer than the lease, another one takes over
+    stale.stop_heartbeat()
+    expire(stale, task_id)
+    fresh = make_queue(tmp_path, 'fresh')
+    assert fresh.try_lease(task_id)
+
+    assert stale.heartbeat() == [task_id]
+    assert stale.has_lost(task_id)
+    # asking for the next task does not mark the lost one done
+    assert list(tasks) == []
+    assert not stale.is_done(task_id)
+    assert fresh.holds(task_id)
+
+    fresh.release(task_id, done=True)
+    assert done_by(fresh, task_id) == 'fresh'
+
+
+def test_live_lease_is_not_taken_over(tmp_path, monkeypatch):
+    first = make_queue(tmp_path, 'first')
+    task_ids = create_tasks(first, models=('a.blend',), samples=10)
+    task_id = task_ids[0]
+    assert first.try_lease(task_id)
+
+    # the lease looked expired to the second worker, which is renewed
+    # before it renames the file
+    second = make_queue(tmp_path, 'second')
+    monkeypatch.setattr(second, 'lease_age', lambda _: 10 * LEASE_SECONDS)
+
+    assert not second.try_lease(task_id)
+    assert first.holds(task_id)
+    assert os.listdir(os.path.join(tmp_path, 'leases')) == [f'{task_id}.lease']
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    first = make_queue(tmp_path, 'first')
+    task_id = create_tasks(first, models=('a.blend',), samples=10)[0]
+    assert first.try_lease(task_id)
+    expire(first, task_id)
+
+    second = make_queue(tmp_path, 'second')
+    assert second.try_lease(task_id)
+    assert second.holds(task_id)
+    assert not first.holds(task_id)
+
+    # the old holder giving it back leaves the new lease alone
+    first.release(task_id)
+    assert second.holds(task_id)
@@ -0,0 +1,159 @@
+import argparse
+import hashlib
+import json
+import os
+
+import atomic_file
+
+LOG_PATH = 'annotations.jsonl'
+BB_PATH = 'bb.json'
+IMAGE_EXTENSIONS = ('.png', '.webp')
+
+
+def ends_with_newline(path):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+    except (FileNotFoundError, OSError):
+        # missing or empty file
+        return True
+
+
+def append_records(path, records, fsync=True):
+    """
+    Appends the records to the log, one json object per line. With fsync the
+    records are on disk when this returns, so a crash loses at most the
+    sample that was being rendered.
+    """
+    # a crash can leave half a line, never glue a new record to it
+    start_with_newline = not ends_with_newline(path)
+
+    with open(path, 'a') as f:
+        if start_with_newline:
+            f.write('\n')
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+
+
+def append_new_records(path, records):
+    """
+    Appends the records whose file name is not in the log yet, so merging a
+    log again after an interruption adds nothing twice. Returns the records
+    appended.
+    """
+    merged = {record['file_name'] for record in read_records(path)}
+    new_records = []
+    for record in records:
+        if record['file_name'] not in merged:
+            merged.add(record['file_name'])
+            new_records.append(record)
+    append_records(path, new_records)
+
+    return new_records
+
+
+def read_records(path):
+    """
+    Yields the records of the log. A line cut by a crash in the middle of a
+    write is skipped.
+    """
+    try:
+        with open(path) as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping broken record at {path}:{line_number}")
+    except FileNotFoundError:
+        return
+
+
+def read_bb_json(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+    return data if isinstance(data, list) else []
+
+
+def derive_seed(*parts):
+    """
+    Stable 64 bits seed from the given parts, the same in every process and
+    run (unlike hash()).
+    """
+    key = ':'.join(str(part) for part in parts).encode()
+
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'little')
+
+
+def sample_file_name(name, seed, extension='png'):
+    return f"{name}-{seed:016x}.{extension}"
+
+
+def label_file_name(file_name):
+    return os.path.splitext(file_name)[0] + '.txt'
+
+
+def load_finished_seeds(log_paths):
+    """
+    Seeds of the samples that have both an annotation and an image, read
+    back from their file names.
+    """
+    finished = set()
+    for log_path in log_paths:
+        for record in read_records(log_path):
+            if os.path.exists(record['file_path']):
+                seed = os.path.splitext(record['file_name'])[0].rsplit('-', 1)[-1]
+                finished.add(int(seed, 16))
+
+    return finished
+
+
+def export_bb_json(log_paths, output=BB_PATH, include_existing=True):
+    """
+    Writes the records of the logs to `output` with the bb.json schema used
+    by create_labels.py and debug_bb.py. Records are unique by file name, the
+    last one wins, so exporting again is safe.
+
+    Returns the number of records written.
+    """
+    records = {}
+
+    if include_existing:
+        for record in read_bb_json(output):
+            records[record['file_name']] = record
+
+    for log_path in log_paths:
+        for record in read_records(log_path):
+            records[record['file_name']] = record
+
+    atomic_file.write_json(output, list(records.values()), indent=4)
+
+    return len(records)
+
+
+def __main__():
+    parser = argparse.ArgumentParser(
+        description='Exports the append-only annotation logs to bb.json.')
+    parser.add_argument('logs', nargs='*', default=[LOG_PATH])
+    parser.add_argument('--output', default=BB_PATH)
+    parser.add_argument('--replace', action='store_true',
+                        help='ignore the records already in the output file')
+    args = parser.parse_args()
+
+    count = export_bb_json(args.logs, args.output,
+                           include_existing=not args.replace)
+    print(f"Exported {count} bounding boxes to {args.output}.")
+
+
+if __name__ == "__main__":
+    __main__()
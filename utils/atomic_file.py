@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+
+@contextmanager
+def temporary_path(path):
+    """
+    Path to write the new version of `path` to. It replaces `path` once the
+    block is done and is removed if the block raises, so a crash never
+    leaves half a file and a reader, also on another node, never sees one.
+    """
+    temporary = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        yield temporary
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+        raise
+
+    os.replace(temporary, path)
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    with temporary_path(path) as temporary:
+        with open(temporary, mode) as f:
+            yield f
+
+
+@contextmanager
+def temporary_directory(path):
+    """
+    Folder to write the new version of the folder `path` to. It replaces
+    `path` with nothing of the old version left once the block is done, and
+    is removed if the block raises.
+    """
+    temporary = f'{path}.{uuid.uuid4().hex}.tmp'
+    os.makedirs(temporary)
+    try:
+        yield temporary
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+
+    # a folder can not replace another one, move the old one away first
+    old = f'{path}.{uuid.uuid4().hex}.old'
+    try:
+        os.rename(path, old)
+    except FileNotFoundError:
+        old = None
+    os.rename(temporary, path)
+    if old is not None:
+        shutil.rmtree(old)
+
+
+def write_json(path, data, indent=None):
+    with atomic_open(path) as f:
+        json.dump(data, f, indent=indent)
@@ -0,0 +1,38 @@
+import hashlib
+import json
+import os
+
+import atomic_file
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_fingerprint(path):
+    """
+    Size, modification time and sha256 of the file. Size and mtime are
+    enough to check a source quickly, the hash avoids processing again a
+    file that was only touched.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256.hexdigest()}
+
+
+def read_manifest(cache_path):
+    """
+    Entries by source file name of the cache in `cache_path`, empty if
+    there is no manifest yet.
+    """
+    try:
+        with open(os.path.join(cache_path, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_manifest(cache_path, manifest):
+    atomic_file.write_json(os.path.join(cache_path, MANIFEST_NAME), manifest, indent=4)
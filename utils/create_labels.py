@@ -1,28 +1,221 @@
+import argparse
+import hashlib
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+from PIL import Image
+
+import annotation_log
+import atomic_file
+import masks
+
+LABELS_PATH = './labels'
+# content hash of every label written, to skip the unchanged ones
+HASHES_PATH = f'{LABELS_PATH}/hashes.json'
+# records converted at once
+BATCH_SIZE = 4096
+WRITE_THREADS = 8
+# record keys of the normalized corners of every box kind
+BOX_KEYS = {
+    'projected': ('min_x', 'max_x', 'min_y', 'max_y'),
+    # tight box of the visible pixels, written by auto_render.py --tight-labels
+    'visible': ('visible_min_x', 'visible_max_x', 'visible_min_y', 'visible_max_y'),
+}
+
+
+def read_hashes():
+    try:
+        with open(HASHES_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_hashes(hashes):
+    atomic_file.write_json(HASHES_PATH, hashes)
+
+
+def read_batches(records, size=BATCH_SIZE):
+    """
+    Groups the record stream in lists of `size`. Within a batch the last
+    record of a file name wins, like in bb.json.
+    """
+    records = iter(records)
+    while True:
+        batch = {record['file_name']: record for record in islice(records, size)}
+        if not batch:
+            return
+        yield list(batch.values())
+
+
+def yolo_boxes(records, box='projected'):
+    """
+    Converts the normalized corners of the records to YOLO (center x,
+    center y, width, height) rows, with y from the top of the image. The
+    rows of background records and of records without that box are NaN.
+    """
+    keys = BOX_KEYS[box]
+    corners = np.array([
+        [record.get(key) for key in keys]
+        if record['model_name'] != 'background' else [np.nan] * 4
+        for record in records
+    ], dtype=np.float64).reshape(-1, 4)
+    min_x, max_x, min_y, max_y = corners.T
+
+    width = max_x - min_x
+    heigth = max_y - min_y
+    center_x = max_x - width / 2
+    center_y = 1 - (max_y - heigth / 2)
+
+    return np.stack([center_x, center_y, width, heigth], axis=-1)
+
+
+def record_instances(record):
+    """
+    The objects of a render with several models, or the record itself.
+    """
+    return record.get('objects', [record])
+
+
+def record_polygons(record):
+    """
+    Outline of the visible pixels of every instance of the record from the
+    instance mask, an empty list for a hidden one. None without an instance
+    mask.
+    """
+    if 'instance_mask_path' not in record:
+        return None
+
+    with Image.open(record['instance_mask_path']) as image:
+        instances = np.asarray(image.convert('L'))
+
+    return [masks.mask_polygon(instances == instance['instance_index'])
+            for instance in record_instances(record)]
+
+
+def box_polygon(center_x, center_y, width, heigth):
+    left, right = center_x - width / 2, center_x + width / 2
+    top, bottom = center_y - heigth / 2, center_y + heigth / 2
+
+    return [left, top, left, bottom, right, bottom, right, top]
+
+
+def label_contents(records, classes, box='projected', segmentation=False, executor=None):
+    """
+    One YOLO detection label per record with a line per instance, or with
+    `segmentation` polygon lines from the instance mask, the box corners
+    where there is none.
+    """
+    instances = [(position, instance)
+                 for position, record in enumerate(records)
+                 if record['model_name'] != 'background'
+                 for instance in record_instances(record)]
+    boxes = yolo_boxes([instance for _, instance in instances], box).tolist()
+
+    polygons = {}
+    if segmentation:
+        # decoding the masks is most of the work
+        for record, record_polygon in zip(records, (executor.map if executor else map)(
+                record_polygons, records)):
+            for instance, polygon in zip(record_instances(record), record_polygon or []):
+                polygons[id(instance)] = polygon
+
+    lines = [[] for _ in records]
+    for (position, instance), yolo_box in zip(instances, boxes):
+        if np.isnan(yolo_box).any():
+            continue
+
+        model_class = classes[instance['model_name']]
+        if not segmentation:
+            center_x, center_y, width, heigth = yolo_box
+            lines[position].append(f'{model_class} {center_x} {center_y} {width} {heigth}')
+            continue
+
+        polygon = polygons.get(id(instance))
+        if polygon is None:
+            polygon = box_polygon(*yolo_box)
+        if polygon:
+            lines[position].append(f'{model_class} {" ".join(map(str, polygon))}')
+
+    return ['\n'.join(record_lines) for record_lines in lines]
+
+
+def write_label(item):
+    label_path, content = item
+    with open(label_path, 'w') as f:
+        f.write(content)
+
+
+def write_labels(records, classes, hashes, existing_labels, executor,
+                 box='projected', segmentation=False):
+    """
+    Writes the labels of the records whose content changed or whose file is
+    missing. Returns the number of labels written.
+    """
+    contents = label_contents(records, classes, box, segmentation, executor)
+
+    pending = []
+    for record, content in zip(records, contents):
+        label_name = annotation_log.label_file_name(record['file_name'])
+        content_hash = hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
+
+        if hashes.get(label_name) == content_hash and label_name in existing_labels:
+            continue
+
+        hashes[label_name] = content_hash
+        pending.append((f'{LABELS_PATH}/{label_name}', content))
+
+    # wait for the batch, a later record of the same file must be written last
+    list(executor.map(write_label, pending))
+
+    return len(pending)
 
 
 def __main__():
+    parser = argparse.ArgumentParser(
+        description='Writes the YOLO label of every annotation, skipping the unchanged ones.')
+    parser.add_argument('logs', nargs='*', default=[annotation_log.LOG_PATH])
+    parser.add_argument('--bb-json', default=None,
+                        help='read the records from a bb.json file instead of the logs')
+    parser.add_argument('--force', action='store_true',
+                        help='write every label')
+    parser.add_argument('--box', default='projected', choices=list(BOX_KEYS),
+                        help='projected model box or tight box of its visible pixels')
+    parser.add_argument('--segmentation', action='store_true',
+                        help='write polygon labels from the instance masks')
+    args = parser.parse_args()
+
     with open("classes.json") as f:
         classes = json.load(f)
 
-    with open("bb.json") as f:
-        data = json.load(f)
+    if args.bb_json:
+        records = annotation_log.read_bb_json(args.bb_json)
+    else:
+        records = (record for log_path in args.logs
+                   for record in annotation_log.read_records(log_path))
+
+    os.makedirs(LABELS_PATH, exist_ok=True)
+    hashes = {} if args.force else read_hashes()
+    existing_labels = set(os.listdir(LABELS_PATH))
 
-    for item in data:
-        if item['model_name'] != 'background':
-            width = item['max_x'] - item['min_x']
-            heigth = item['max_y'] - item['min_y']
-            center_x = item['max_x'] - width / 2
-            center_y = 1 - (item['max_y'] - heigth / 2)
-            model_name = item['model_name']
+    start = time.perf_counter()
+    total = 0
+    written = 0
+    with ThreadPoolExecutor(WRITE_THREADS) as executor:
+        for batch in read_batches(records):
+            written += write_labels(batch, classes, hashes, existing_labels,
+                                    executor, args.box, args.segmentation)
+            total += len(batch)
 
-            model_class = classes[model_name]
-            export_string = f'{model_class} {center_x} {center_y} {width} {heigth}'
+    write_hashes(hashes)
 
-        else:
-            export_string = ""
+    print(f"{written} labels written and {total - written} unchanged skipped "
+          f"in {time.perf_counter() - start:.1f} s.")
 
-        print(export_string)
 
-        with open(f'./labels/{item['file_name'].replace("png", "txt")}', 'w') as f:
-            f.write(export_string)
+if __name__ == "__main__":
+    __main__()
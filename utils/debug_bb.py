@@ -1,87 +1,263 @@
-﻿import json
+﻿import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
 import matplotlib.patches as ptc
 import matplotlib.pyplot as plt
-from PIL import Image
+from PIL import Image, ImageDraw
 from matplotlib.widgets import Slider
 
-with open("bb.json") as f:
-    data = json.load(f)
+import annotation_log
+
+# the viewer shows downscaled images, much faster to load and draw, half the
+# 640x480 renders is still enough to check a box
+THUMBNAIL_SIZE = (320, 240)
+THUMBNAIL_CACHE_SIZE = 256
+# neighbours loaded in the background on each side of the current index
+PREFETCH = 8
+PREFETCH_THREADS = 4
+
+CONTACT_SHEETS_PATH = './debug/contact_sheets'
+GRID = 8
+CELL_SIZE = (240, 180)
+
+
+def read_data(path):
+    """
+    Records of bb.json, or of an annotations.jsonl log.
+    """
+    if path.endswith('.jsonl'):
+        return list(annotation_log.read_records(path))
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_thumbnail(file_path, size):
+    with Image.open(file_path) as im:
+        im = im.convert('RGB')
+        im.thumbnail(size, reducing_gap=2.0)
+        return im
+
+
+def box_rectangle(render, width, height):
+    """
+    (x, y, width, height) of the box in pixels from the top of the image,
+    None for background renders.
+    """
+    if render["min_x"] is None:
+        return None
+
+    x = render["min_x"] * width
+    y = (1 - render["max_y"]) * height
+    box_width = (render["max_x"] - render["min_x"]) * width
+    box_height = (render["max_y"] - render["min_y"]) * height
+
+    return x, y, box_width, box_height
+
+
+def box_rectangles(render, width, height):
+    """
+    Rectangles of every model of the render, see box_rectangle.
+    """
+    boxes = (box_rectangle(instance, width, height)
+             for instance in render.get("objects", [render]))
+    return [box for box in boxes if box is not None]
+
+
+class ThumbnailCache:
+    """
+    LRU cache of the viewer thumbnails. get() also queues the neighbours of
+    the index on a thread pool, so scrolling finds them already loaded.
+    """
+
+    def __init__(self, data, size=THUMBNAIL_SIZE, capacity=THUMBNAIL_CACHE_SIZE):
+        self.data = data
+        self.size = size
+        self.capacity = capacity
+        self.thumbnails = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(PREFETCH_THREADS)
+
+    def load(self, index):
+        thumbnail = load_thumbnail(self.data[index]["file_path"], self.size)
+
+        with self.lock:
+            self.thumbnails[index] = thumbnail
+            self.loading.pop(index, None)
+            while len(self.thumbnails) > self.capacity:
+                self.thumbnails.popitem(last=False)
+
+        return thumbnail
+
+    def request(self, index):
+        with self.lock:
+            if index in self.thumbnails:
+                self.thumbnails.move_to_end(index)
+                return None
+            if index not in self.loading:
+                self.loading[index] = self.executor.submit(self.load, index)
+            return self.loading[index]
+
+    def get(self, index):
+        future = self.request(index)
+
+        # nearest first, the slider usually moves by one
+        for distance in range(1, PREFETCH + 1):
+            for neighbour in (index + distance, index - distance):
+                if 0 <= neighbour < len(self.data):
+                    self.request(neighbour)
+
+        if future is not None:
+            return future.result()
+        with self.lock:
+            return self.thumbnails[index]
+
+
+def view(data):
+    cache = ThumbnailCache(data)
+
+    # --- Create the Figure and Main Axes ---
+    fig, ax = plt.subplots()
+    # Adjust the plot to make room for the slider
+    plt.subplots_adjust(bottom=0.25)
+
+    # the artists are created once and only updated when the slider moves
+    image_artist = None
+    rects = []
+
+    def update(slider_val):
+        nonlocal image_artist
+        # Get the integer index from the slider
+        index = int(slider_val)
+        render = data[index]
+
+        try:
+            im = cache.get(index)
+
+            if image_artist is None:
+                image_artist = ax.imshow(im, origin='lower')
+            else:
+                image_artist.set_data(im)
+                image_artist.set_extent((-0.5, im.width - 0.5, -0.5, im.height - 0.5))
+
+            boxes = box_rectangles(render, im.width, im.height)
+            while len(rects) < len(boxes):
+                rects.append(ax.add_patch(ptc.Rectangle(
+                    (0, 0), 0, 0, linewidth=1, edgecolor='r', facecolor="none")))
+            for position, rect in enumerate(rects):
+                rect.set_visible(position < len(boxes))
+                if position < len(boxes):
+                    rect.set_bounds(*boxes[position])
 
+            ax.set_title(f"Image Index: {index}")
 
-# Assuming 'data' is your list of render dictionaries
-# data = [...]
+        except FileNotFoundError:
+            ax.set_title(f"Image Index: {index} (File Not Found)")
+        except Exception as e:
+            ax.set_title(f"Image Index: {index} (Error)")
+            print(f"Error processing index {index}: {e}")
 
-# --- Create the Figure and Main Axes ---
-fig, ax = plt.subplots()
-# Adjust the plot to make room for the slider
-plt.subplots_adjust(bottom=0.25)
+        # Redraw the figure
+        fig.canvas.draw_idle()
 
-# --- Define the Update Function ---
-# This function will run every time the slider value changes
+    # --- Create the Slider Widget ---
+    # Define the axes for the slider [left, bottom, width, height]
+    ax_slider = plt.axes([0.25, 0.1, 0.65, 0.03])
 
+    slider = Slider(
+        ax=ax_slider,
+        label='Image Index',
+        valmin=0,                  # Start index
+        valmax=len(data) - 1,      # End index
+        valinit=0,                 # Starting index
+        valstep=1                  # Move one index at a time (integer steps)
+    )
+    slider.on_changed(update)
 
-def update(slider_val):
-    # Get the integer index from the slider
-    index = int(slider_val)
-    render = data[index]
+    # Call update() once manually to show the initial image
+    update(0)
+    plt.show()
 
-    # Clear the axes to draw the new image
-    ax.clear()
 
-    try:
-        im = Image.open(render["file_path"])
+def render_contact_sheet(page):
+    """
+    Draws the renders of the page in a GRID x GRID mosaic with their boxes
+    and index, and saves it. Returns the number of renders drawn.
+    """
+    number, start, renders, output = page
+    cell_width, cell_height = CELL_SIZE
+    sheet = Image.new('RGB', (GRID * cell_width, GRID * cell_height))
+    draw = ImageDraw.Draw(sheet)
+    drawn = 0
 
-        res_x = im.width
-        res_y = im.height
+    for position, render in enumerate(renders):
+        left = position % GRID * cell_width
+        top = position // GRID * cell_height
 
-        ax.imshow(im, origin='lower')
+        try:
+            thumbnail = load_thumbnail(render["file_path"], CELL_SIZE)
+        except FileNotFoundError:
+            draw.text((left + 4, top + 4), f"{start + position} not found", fill='red')
+            continue
 
-        min_x_norm = render["min_x"]
-        max_x_norm = render["max_x"]
-        min_y_norm = render["min_y"]
-        max_y_norm = render["max_y"]
+        sheet.paste(thumbnail, (left, top))
+        for x, y, width, height in box_rectangles(render, thumbnail.width, thumbnail.height):
+            draw.rectangle((left + x, top + y, left + x + width, top + y + height),
+                           outline='red')
+        draw.text((left + 4, top + 4), str(start + position), fill='yellow')
+        drawn += 1
 
-        x = min_x_norm * res_x
-        y = (1 - max_y_norm) * res_y
-        width = (max_x_norm - min_x_norm) * res_x
-        height = (max_y_norm - min_y_norm) * res_y
+    sheet.save(os.path.join(output, f'page-{number:05d}.jpg'), quality=85)
+    return drawn
 
-        rect = ptc.Rectangle((x, y), width, height, linewidth=1,
-                             edgecolor='r', facecolor="none")
 
-        ax.add_patch(rect)
-        ax.set_title(f"Image Index: {index}")
+def contact_sheets(data, output, workers):
+    os.makedirs(output, exist_ok=True)
+    per_page = GRID * GRID
+    pages = [
+        (number, start, data[start:start + per_page], output)
+        for number, start in enumerate(range(0, len(data), per_page))
+    ]
 
-    except FileNotFoundError:
-        ax.set_title(f"Image Index: {index} (File Not Found)")
-    except Exception as e:
-        ax.set_title(f"Image Index: {index} (Error)")
-        print(f"Error processing index {index}: {e}")
+    start = time.perf_counter()
+    drawn = 0
+    with Pool(workers) as pool:
+        for count in pool.imap_unordered(render_contact_sheet, pages):
+            drawn += count
+    elapsed = time.perf_counter() - start
 
-    # Redraw the figure
-    fig.canvas.draw_idle()
+    print(f"{drawn} renders in {len(pages)} contact sheets in {output}, "
+          f"{elapsed:.1f} s ({drawn / max(elapsed, 1e-9) * 60:.0f} renders/min).")
 
 
-# --- Create the Slider Widget ---
-# Define the axes for the slider [left, bottom, width, height]
-ax_slider = plt.axes([0.25, 0.1, 0.65, 0.03])
+def __main__():
+    parser = argparse.ArgumentParser(
+        description='Shows the bounding boxes of the renders, or draws them in contact sheets.')
+    parser.add_argument('input', nargs='?', default=annotation_log.BB_PATH,
+                        help='bb.json or an annotations.jsonl log')
+    parser.add_argument('--contact-sheets', action='store_true',
+                        help=f'write {GRID}x{GRID} mosaics instead of opening the viewer')
+    parser.add_argument('--output', default=CONTACT_SHEETS_PATH)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
 
-# Create the slider
-slider = Slider(
-    ax=ax_slider,
-    label='Image Index',
-    valmin=0,                  # Start index
-    valmax=len(data) - 1,      # End index
-    valinit=0,                 # Starting index
-    valstep=1                  # Move one index at a time (integer steps)
-)
+    data = read_data(args.input)
+    if not data:
+        sys.exit(f"No records in {args.input}.")
 
-# --- Connect the Slider to the Update Function ---
-slider.on_changed(update)
+    if args.contact_sheets:
+        contact_sheets(data, args.output, args.workers)
+    else:
+        view(data)
 
-# --- Show the First Image ---
-# Call update() once manually to show the initial image
-update(0)
 
-# --- Show the Interactive Window ---
-plt.show()
+if __name__ == "__main__":
+    __main__()
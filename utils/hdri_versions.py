@@ -0,0 +1,43 @@
+import math
+
+# texels of the equirectangular image per rendered pixel, the pixel filter
+# of the render blurs more than the bilinear lookup of the texture
+TEXELS_PER_PIXEL = 1.0
+# widths are rounded up to a multiple of this, close cameras share a version
+WIDTH_STEP = 512
+
+
+def horizontal_fov(width, height, lens, sensor_width):
+    """
+    Horizontal field of view in radians of a blender camera with sensor fit
+    auto: the sensor width matches the larger side of the image.
+    """
+    half_width = sensor_width / 2 / lens
+    if width < height:
+        half_width *= width / height
+
+    return 2 * math.atan(half_width)
+
+
+def version_width(width, height, lens, sensor_width):
+    """
+    Width of the equirectangular image whose texels are about the size of
+    the pixels of a `width` x `height` render with the given camera.
+    """
+    fov = horizontal_fov(width, height, lens, sensor_width)
+    texels = width * TEXELS_PER_PIXEL * 2 * math.pi / fov
+
+    return math.ceil(texels / WIDTH_STEP) * WIDTH_STEP
+
+
+def pick_version(entry, width):
+    """
+    File name of the smallest version of the manifest entry that is at
+    least `width` wide, None if the source is the best there is.
+    """
+    widths = sorted(int(version) for version in entry['versions'])
+    for version in widths:
+        if version >= width:
+            return entry['versions'][str(version)]
+
+    return None
@@ -0,0 +1,246 @@
+import json
+import math
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+# AgX base, the polynomial fit of the sigmoid from the minimal AgX
+# implementation, with matrices for row vectors
+AGX_INSET = np.array([
+    [0.842479062253094, 0.0423282422610123, 0.0423756549057051],
+    [0.0784335999999992, 0.878468636469772, 0.0784336],
+    [0.0792237451477643, 0.0791661274605434, 0.879142973793104],
+], dtype=np.float32)
+AGX_OUTSET = np.array([
+    [1.19687900512017, -0.0528968517574562, -0.0529716355144438],
+    [-0.0980208811401368, 1.15190312990417, -0.0980434501171241],
+    [-0.0990297440797205, -0.0989611768448433, 1.15107367264116],
+], dtype=np.float32)
+AGX_MIN_EV = -12.47393
+AGX_MAX_EV = 4.026069
+# 'AgX - High Contrast' look, contrast around middle grey in the log encoding
+LOOK_CONTRAST = 1.2
+MIDDLE_GREY = (math.log2(0.18) - AGX_MIN_EV) / (AGX_MAX_EV - AGX_MIN_EV)
+
+IMAGE_FORMATS = ('png', 'webp')
+# zlib level of the PNG files, 1 is much faster and only a bit larger than 6
+PNG_COMPRESSION = 6
+WEBP_QUALITY = 90
+ENCODE_PROCESSES = 4
+# python of the encoder processes, the bundled one in blender 2.91 and later
+ENCODER_PYTHON = sys.executable
+# renders waiting to be encoded before the next render blocks
+ENCODE_QUEUE = 8
+
+
+def agx_look(radiance):
+    """
+    Approximation of the 'AgX' view transform with the 'High Contrast' look,
+    from linear scene radiance to display encoded values (0-1).
+    """
+    encoded = np.maximum(radiance, 1e-10) @ AGX_INSET
+    encoded = (np.clip(np.log2(np.maximum(encoded, 1e-10)), AGX_MIN_EV, AGX_MAX_EV)
+               - AGX_MIN_EV) / (AGX_MAX_EV - AGX_MIN_EV)
+    encoded = np.clip(MIDDLE_GREY + (encoded - MIDDLE_GREY) * LOOK_CONTRAST, 0, 1)
+
+    x2 = encoded * encoded
+    x4 = x2 * x2
+    display = (15.5 * x4 * x2 - 40.14 * x4 * encoded + 31.96 * x4
+               - 6.868 * x2 * encoded + 0.4298 * x2 + 0.1191 * encoded - 0.00232)
+
+    return np.clip(display @ AGX_OUTSET, 0, 1)
+
+
+def render_to_display(pixels, width, height):
+    """
+    Flat RGBA float pixels of a blender image (linear, first row at the
+    bottom) to a (height, width, 3) uint8 display image, first row at the
+    top.
+    """
+    radiance = pixels.reshape(height, width, 4)[::-1, :, :3]
+
+    return np.round(agx_look(radiance) * 255).astype(np.uint8)
+
+
+def png_chunk(tag, data):
+    return (struct.pack('>I', len(data)) + tag + data
+            + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+
+def encode_png(pixels, compression=PNG_COMPRESSION):
+    """
+    PNG bytes of a (height, width, 3 or 4) uint8 image. Only NumPy and zlib,
+    so it also runs in the Python of blender, and zlib releases the GIL
+    while compressing.
+    """
+    height, width, channels = pixels.shape
+    color_type = {3: 2, 4: 6}[channels]
+
+    # 'up' filter on every row, the difference with the row above
+    rows = pixels.reshape(height, width * channels)
+    filtered = np.empty((height, width * channels + 1), dtype=np.uint8)
+    filtered[:, 0] = 2
+    filtered[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+
+    header = struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n'
+            + png_chunk(b'IHDR', header)
+            + png_chunk(b'IDAT', zlib.compress(filtered.tobytes(), compression))
+            + png_chunk(b'IEND', b''))
+
+
+def write_image(path, pixels, image_format='png', compression=PNG_COMPRESSION):
+    """
+    Writes the uint8 image as PNG, or as WebP (lossless when quality is 100)
+    which needs Pillow.
+    """
+    if image_format == 'webp':
+        from PIL import Image
+
+        Image.fromarray(pixels).save(
+            path, 'WEBP', lossless=WEBP_QUALITY >= 100, quality=WEBP_QUALITY)
+        return
+
+    with open(path, 'wb') as f:
+        f.write(encode_png(pixels, compression))
+
+
+def encode_render(pixels, width, height, path, image_format, compression):
+    write_image(path, render_to_display(pixels, width, height),
+                image_format, compression)
+
+
+class EncoderProcess:
+    """
+    A `python image_encoder.py` process fed through its stdin. Every job is
+    a json line with the .npy file of the pixels, the process answers each
+    one with a json line once the image is written, in order.
+    """
+
+    def __init__(self, python=ENCODER_PYTHON):
+        self.process = subprocess.Popen(
+            [python, os.path.abspath(__file__)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        # futures of the jobs sent and not answered yet
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self.read_replies, daemon=True)
+        self.reader.start()
+
+    def send(self, job, future):
+        with self.lock:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Encoder process exited with code {self.process.returncode}.")
+            self.pending.append(future)
+            try:
+                self.process.stdin.write(json.dumps(job) + '\n')
+            except OSError:
+                self.pending.remove(future)
+                raise
+
+    def read_replies(self):
+        for line in self.process.stdout:
+            reply = json.loads(line)
+            with self.lock:
+                future = self.pending.popleft()
+            if reply['error'] is None:
+                future.set_result(reply['path'])
+            else:
+                future.set_exception(RuntimeError(reply['error']))
+
+        # the process exited, the jobs it did not answer are lost
+        self.process.wait()
+        with self.lock:
+            lost = list(self.pending)
+            self.pending.clear()
+        for future in lost:
+            future.set_exception(RuntimeError(
+                f"Encoder process exited with code {self.process.returncode}."))
+
+    def close(self):
+        self.process.stdin.close()
+        self.reader.join()
+
+
+class EncoderPool:
+    """
+    Encodes and writes renders in separate python processes: blender holds
+    the GIL while it renders, so threads would only encode between two
+    renders. The processes run this file and never import the script of
+    blender, which a multiprocessing child would do to find its __main__.
+    The pixels go through .npy files in a spool folder, the pipes only
+    carry one line per image. submit() blocks only when `queue_depth`
+    renders are already waiting, so a slow disk can not fill the memory
+    with float buffers.
+    """
+
+    def __init__(self, image_format='png', compression=PNG_COMPRESSION,
+                 processes=ENCODE_PROCESSES, queue_depth=ENCODE_QUEUE,
+                 python=ENCODER_PYTHON):
+        self.image_format = image_format
+        self.compression = compression
+        self.spool = tempfile.mkdtemp(prefix='encoder-')
+        self.processes = [EncoderProcess(python) for _ in range(processes)]
+        self.slots = threading.BoundedSemaphore(queue_depth)
+
+    def submit(self, pixels, width, height, path):
+        """
+        Queues the flat RGBA float pixels of a render to be written to
+        `path`, returns the future of the write.
+        """
+        self.slots.acquire()
+        future = Future()
+        future.add_done_callback(lambda _: self.slots.release())
+
+        pixels_path = os.path.join(self.spool, f'{uuid.uuid4().hex}.npy')
+        np.save(pixels_path, pixels)
+        job = {
+            'pixels': pixels_path, 'width': width, 'height': height, 'path': path,
+            'image_format': self.image_format, 'compression': self.compression,
+        }
+        try:
+            min(self.processes, key=lambda process: len(process.pending)).send(job, future)
+        except (RuntimeError, OSError) as error:
+            future.set_exception(error)
+
+        return future
+
+    def close(self):
+        for process in self.processes:
+            process.close()
+        shutil.rmtree(self.spool, ignore_errors=True)
+
+
+def __main__():
+    """
+    Encoder process of EncoderPool, one job per line of stdin.
+    """
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            encode_render(np.load(job['pixels']), job['width'], job['height'],
+                          job['path'], job['image_format'], job['compression'])
+            error = None
+        except Exception as exception:
+            error = f'{job["path"]}: {type(exception).__name__}: {exception}'
+        finally:
+            if os.path.exists(job['pixels']):
+                os.remove(job['pixels'])
+
+        sys.stdout.write(json.dumps({'path': job['path'], 'error': error}) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    __main__()
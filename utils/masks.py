@@ -0,0 +1,53 @@
+import numpy as np
+
+# rows sampled along the mask for the segmentation polygon
+POLYGON_ROWS = 32
+
+
+def tight_box(mask):
+    """
+    Tight box of a boolean (height, width) mask, first row at the top, with
+    the annotation conventions: normalized (min_x, max_x, min_y, max_y) with
+    y from the bottom. None for an empty mask.
+    """
+    height, width = mask.shape
+    columns = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not len(columns):
+        return None
+
+    return (
+        columns[0] / width,
+        (columns[-1] + 1) / width,
+        1 - (rows[-1] + 1) / height,
+        1 - rows[0] / height,
+    )
+
+
+def mask_polygon(mask, rows=POLYGON_ROWS):
+    """
+    Outline of a boolean (height, width) mask as a flat list of normalized
+    (x, y) points, y from the top as in the YOLO labels. The leftmost and
+    rightmost pixels of `rows` rows are joined down the left side and back
+    up the right one, so holes and bays on a row are filled. Empty list for
+    an empty mask.
+    """
+    height, width = mask.shape
+    filled = np.flatnonzero(mask.any(axis=1))
+    if not len(filled):
+        return []
+
+    sampled = np.unique(np.linspace(filled[0], filled[-1], rows).round().astype(int))
+    sampled = sampled[mask[sampled].any(axis=1)]
+    left = mask[sampled].argmax(axis=1)
+    right = width - mask[sampled, ::-1].argmax(axis=1)
+
+    # pixel edges, the last row is closed at its bottom edge
+    y = sampled / height
+    y[-1] = (sampled[-1] + 1) / height
+    points = np.concatenate([
+        np.stack([left / width, y], axis=-1),
+        np.stack([right / width, y], axis=-1)[::-1],
+    ])
+
+    return points.ravel().tolist()
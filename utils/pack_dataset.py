@@ -0,0 +1,203 @@
+import argparse
+import io
+import json
+import mmap
+import os
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import atomic_file
+from annotation_log import IMAGE_EXTENSIONS, label_file_name
+from segmentate import OUT_IMAGE_PATH, OUT_LABEL_PATH
+
+PACKED_PATH = './YOLO/packed'
+SPLITS = ('train', 'val')
+# a new shard is started once the current one reaches this size
+SHARD_SIZE_MB = 1024
+DECODE_THREADS = 8
+# index columns, byte offsets inside the shard
+SHARD, IMAGE_OFFSET, IMAGE_SIZE, LABEL_OFFSET, LABEL_SIZE = range(5)
+
+
+def list_samples(split):
+    images = sorted(image for image in os.listdir(f'{OUT_IMAGE_PATH}/{split}')
+                    if image.endswith(IMAGE_EXTENSIONS))
+    labels = set(os.listdir(f'{OUT_LABEL_PATH}/{split}'))
+
+    return [image for image in images if label_file_name(image) in labels]
+
+
+def add_member(tar, path, name):
+    """
+    Adds the file to the tar, returns the (offset, size) of its data in the
+    archive.
+    """
+    info = tar.gettarinfo(path, arcname=name)
+    with open(path, 'rb') as f:
+        tar.addfile(info, f)
+
+    # the data is followed by the padding up to the next 512 bytes block
+    data_blocks = -(-info.size // tarfile.BLOCKSIZE)
+    return tar.offset - data_blocks * tarfile.BLOCKSIZE, info.size
+
+
+def pack_shards(split, output, shard_size):
+    """
+    Writes the images and labels of the split into plain tar shards, so they
+    can also be read with the usual tools, and returns the index with the
+    byte offsets of every sample.
+    """
+    samples = list_samples(split)
+    index = np.zeros((len(samples), 5), dtype=np.int64)
+    shards = []
+    tar = None
+
+    for position, image in enumerate(samples):
+        if tar is None or tar.offset >= shard_size:
+            if tar is not None:
+                tar.close()
+            shards.append(f'shard-{len(shards):05d}.tar')
+            tar = tarfile.open(os.path.join(output, shards[-1]), 'w', format=tarfile.GNU_FORMAT)
+
+        label = label_file_name(image)
+        image_offset, image_size = add_member(tar, f'{OUT_IMAGE_PATH}/{split}/{image}', image)
+        label_offset, label_size = add_member(tar, f'{OUT_LABEL_PATH}/{split}/{label}', label)
+        index[position] = (len(shards) - 1, image_offset, image_size, label_offset, label_size)
+
+    if tar is not None:
+        tar.close()
+
+    return samples, index, shards
+
+
+def pack_array(split, samples, output):
+    """
+    Decodes every image into a single memory-mappable (N, height, width, 3)
+    uint8 array. All the renders share the resolution of the first one.
+    """
+    with Image.open(f'{OUT_IMAGE_PATH}/{split}/{samples[0]}') as first:
+        width, height = first.size
+
+    images = np.lib.format.open_memmap(
+        os.path.join(output, 'images.npy'), mode='w+',
+        dtype=np.uint8, shape=(len(samples), height, width, 3))
+
+    def decode(position):
+        with Image.open(f'{OUT_IMAGE_PATH}/{split}/{samples[position]}') as image:
+            if image.size != (width, height):
+                raise ValueError(f"{samples[position]} is {image.size}, expected {(width, height)}.")
+            images[position] = np.asarray(image.convert('RGB'))
+
+    with ThreadPoolExecutor(DECODE_THREADS) as executor:
+        list(executor.map(decode, range(len(samples))))
+
+    images.flush()
+    return images.shape
+
+
+def pack_split(split, output, shard_size, with_array):
+    """
+    Packs the split into a new folder that replaces the previous one once
+    it is complete, so no shard of an older pack is left and an interrupted
+    pack keeps the previous one. meta.json is written last.
+    """
+    os.makedirs(output, exist_ok=True)
+
+    with atomic_file.temporary_directory(os.path.join(output, split)) as split_output:
+        samples, index, shards = pack_shards(split, split_output, shard_size)
+        with atomic_file.atomic_open(os.path.join(split_output, 'index.npy'), 'wb') as f:
+            np.save(f, index)
+        with atomic_file.atomic_open(os.path.join(split_output, 'names.txt')) as f:
+            f.write('\n'.join(samples))
+
+        meta = {'samples': len(samples), 'shards': shards, 'array_shape': None}
+        if with_array and samples:
+            meta['array_shape'] = pack_array(split, samples, split_output)
+        atomic_file.write_json(os.path.join(split_output, 'meta.json'), meta, indent=4)
+
+    return meta
+
+
+class PackedDataset:
+    """
+    Random access to a packed split. The image and label bytes are views of
+    the memory-mapped shards, nothing is copied until they are decoded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, 'names.txt')) as f:
+            self.names = f.read().split('\n') if self.meta['samples'] else []
+
+        self.index = np.load(os.path.join(path, 'index.npy'))
+        self.array = None
+        if self.meta['array_shape']:
+            self.array = np.load(os.path.join(path, 'images.npy'), mmap_mode='r')
+        self.shards = {}
+
+    def __getstate__(self):
+        # memory maps can not be pickled, data loader workers map their own
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard(self, number):
+        if number not in self.shards:
+            with open(os.path.join(self.path, self.meta['shards'][number]), 'rb') as f:
+                self.shards[number] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        return self.shards[number]
+
+    def image_bytes(self, position):
+        entry = self.index[position]
+        offset = entry[IMAGE_OFFSET]
+        return self.shard(entry[SHARD])[offset:offset + entry[IMAGE_SIZE]]
+
+    def label(self, position):
+        entry = self.index[position]
+        offset = entry[LABEL_OFFSET]
+        return bytes(self.shard(entry[SHARD])[offset:offset + entry[LABEL_SIZE]]).decode()
+
+    def image(self, position):
+        """
+        (height, width, 3) uint8 image, a view of the array if it was packed
+        and decoded from the shard otherwise.
+        """
+        if self.array is not None:
+            return self.array[position]
+
+        with Image.open(io.BytesIO(self.image_bytes(position))) as image:
+            return np.asarray(image.convert('RGB'))
+
+    def __getitem__(self, position):
+        return self.image(position), self.label(position)
+
+
+def __main__():
+    parser = argparse.ArgumentParser(
+        description='Packs the YOLO dataset into tar shards with a byte offset index.')
+    parser.add_argument('--output', default=PACKED_PATH)
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE_MB,
+                        help='shard size in MB')
+    parser.add_argument('--array', action='store_true',
+                        help='also write the decoded images to a memory-mappable uint8 array')
+    args = parser.parse_args()
+
+    for split in SPLITS:
+        start = time.perf_counter()
+        meta = pack_split(split, args.output, args.shard_size << 20, args.array)
+        print(f"{split}: {meta['samples']} samples in {len(meta['shards'])} shards "
+              f"in {time.perf_counter() - start:.1f} s.")
+
+
+if __name__ == "__main__":
+    __main__()
@@ -1,5 +1,7 @@
+import annotation_log
 import create_labels
 import segmentate
 
+annotation_log.__main__()
 create_labels.__main__()
 segmentate.__main__()
@@ -0,0 +1,85 @@
+import numpy as np
+
+
+def frame_projection_matrix(frame, orthographic):
+    """
+    Builds a 4x4 matrix that maps camera space coordinates to the same space
+    as world_to_camera_view: after dividing x and y by w they are normalized
+    (0-1) frame coordinates and the third row is the depth in front of the
+    camera.
+
+    `frame` holds the corners of the camera view_frame (top right, bottom
+    right, bottom left, top left), so it already includes shift_x/shift_y,
+    sensor fit and the render aspect ratio.
+    """
+    frame = np.asarray(frame, dtype=np.float64)
+    min_x, max_x = frame[2, 0], frame[1, 0]
+    min_y, max_y = frame[1, 1], frame[0, 1]
+    width = max_x - min_x
+    height = max_y - min_y
+
+    if orthographic:
+        return np.array([
+            [1 / width, 0, 0, -min_x / width],
+            [0, 1 / height, 0, -min_y / height],
+            [0, 0, -1, 0],
+            [0, 0, 0, 1],
+        ])
+
+    # distance of the view frame plane to the camera
+    frame_distance = -frame[0, 2]
+    return np.array([
+        [frame_distance / width, 0, min_x / width, 0],
+        [0, frame_distance / height, min_y / height, 0],
+        [0, 0, -1, 0],
+        [0, 0, -1, 0],
+    ])
+
+
+def project_points(points, matrix_world, projection_matrix):
+    """
+    Projects (N, 3) object space points with a single matrix multiply.
+
+    Returns the normalized x, y coordinates and the depth of every point.
+    """
+    full_matrix = projection_matrix @ np.asarray(matrix_world)
+    projected = points @ full_matrix[:3, :3].T + full_matrix[:3, 3]
+    w = points @ full_matrix[3, :3] + full_matrix[3, 3]
+
+    depth = projected[:, 2]
+    # points behind the camera are discarded later, avoid dividing by zero
+    w = np.where(w == 0, 1, w)
+
+    return projected[:, 0] / w, projected[:, 1] / w, depth
+
+
+def bounding_box_from_projection(x_values, y_values, depth):
+    """
+    Turns projected coordinates into the normalized bounding box dictionary,
+    or None if nothing is in front of the camera or inside the frame.
+    """
+    visible = depth > 0
+
+    if not visible.any():
+        return None  # Object is not in view
+
+    x_values = x_values[visible]
+    y_values = y_values[visible]
+
+    # Clamp to screen edges (0.0 to 1.0)
+    box_min_x = max(0.0, float(x_values.min()))
+    box_max_x = min(1.0, float(x_values.max()))
+    box_min_y = max(0.0, float(y_values.min()))
+    box_max_y = min(1.0, float(y_values.max()))
+
+    area = (box_max_x - box_min_x) * (box_max_y - box_min_y)
+
+    if area <= 0:
+        return None  # Object is visible but outside the clamped frame
+
+    return {
+        'min_x': box_min_x,
+        'max_x': box_max_x,
+        'min_y': box_min_y,
+        'max_y': box_max_y,
+    }
@@ -1,7 +1,12 @@
+import argparse
+import hashlib
 import json
 import os
-import random
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from annotation_log import IMAGE_EXTENSIONS, label_file_name
 
 BASE_DIR = "./YOLO/dataset"
 
@@ -11,62 +16,135 @@ IN_LABEL_PATH = f'./labels'
 OUT_IMAGE_PATH = f'{BASE_DIR}/images'
 OUT_LABEL_PATH = f'{BASE_DIR}/labels'
 RATION_TRAIN_VALIDATION = 0.8
+# 'hardlink', 'symlink' or 'copy', links fall back to a copy when not possible
+LINK_MODE = 'hardlink'
+LINK_THREADS = 8
+NAME_SEPARATORS = '-_.'
+
+
+def split_of(image, ratio=RATION_TRAIN_VALIDATION):
+    """
+    'train' or 'val' from a hash of the file name, so an image always lands
+    in the same split no matter which other images exist.
+    """
+    digest = hashlib.blake2b(image.encode(), digest_size=8).digest()
+    position = int.from_bytes(digest, 'little') / 2 ** 64
+
+    return 'train' if position < ratio else 'val'
+
+
+def find_model(image, models):
+    """
+    Model of the image from its name prefix, looked up in the `models` set
+    at every separator instead of testing every model.
+    """
+    for position, character in enumerate(image):
+        if character in NAME_SEPARATORS and image[:position] in models:
+            return image[:position]
+
+    return None
+
+
+def is_materialized(source, destination, mode):
+    try:
+        if mode == 'symlink' and os.path.islink(destination):
+            return os.readlink(destination) == os.path.abspath(source)
+        if os.path.samefile(source, destination):
+            return True
+
+        source_stat = os.stat(source)
+        destination_stat = os.stat(destination)
+    except FileNotFoundError:
+        return False
+
+    # a copy, the same as long as the source was not written since
+    return (source_stat.st_size == destination_stat.st_size
+            and source_stat.st_mtime <= destination_stat.st_mtime)
+
+
+def materialize(source, destination, mode=LINK_MODE):
+    """
+    Links (or copies) the source to the destination unless it is already
+    there. Returns True if the destination was written.
+    """
+    if is_materialized(source, destination, mode):
+        return False
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        if mode == 'hardlink':
+            os.link(source, destination)
+            return True
+        if mode == 'symlink':
+            os.symlink(os.path.abspath(source), destination)
+            return True
+    except OSError:
+        # another file system, or links not supported
+        pass
+
+    shutil.copy2(source, destination)
+    return True
+
+
+def materialize_image(image, split, mode):
+    label = label_file_name(image)
+
+    written = materialize(f'{IN_IMAGE_PATH}/{image}',
+                          f'{OUT_IMAGE_PATH}/{split}/{image}', mode)
+    written |= materialize(f'{IN_LABEL_PATH}/{label}',
+                           f'{OUT_LABEL_PATH}/{split}/{label}', mode)
+
+    return written
 
 
 def __main__():
+    parser = argparse.ArgumentParser(
+        description='Splits the renders in train and val and links them into the YOLO dataset.')
+    parser.add_argument('--mode', choices=['hardlink', 'symlink', 'copy'],
+                        default=LINK_MODE)
+    args = parser.parse_args()
+
     with open("classes.json") as f:
         classes = json.load(f)
 
-    models = list(classes.keys())
-
-    schema = {}
-    all_images = os.listdir(IN_IMAGE_PATH)
-    all_labels = os.listdir(IN_LABEL_PATH)
+    models = set(classes.keys())
 
     filtered_all_images = [
-        image for image in all_images if image.endswith('.png')]
-    filtered_all_labels = [
-        label for label in all_labels if label.endswith('.txt')]
-
-    schema = {model: [] for model in models}
+        image for image in os.listdir(IN_IMAGE_PATH) if image.endswith(IMAGE_EXTENSIONS)]
+    filtered_all_labels = set(
+        label for label in os.listdir(IN_LABEL_PATH) if label.endswith('.txt'))
 
+    split_schema = []
+    unlabeled = 0
     for image in filtered_all_images:
-        for model in models:
-            if image.startswith(model):
-                schema[model].append(image)
-                break
-
-    split_schema = {}
-    total_train_count = 0
-    total_val_count = 0
-
-    for model, model_images in schema.items():
-        random.shuffle(model_images)
+        if find_model(image, models) is None:
+            continue
+        if label_file_name(image) not in filtered_all_labels:
+            unlabeled += 1
+            continue
 
-        num_images_model = len(model_images)
-        num_train_images = int(num_images_model * RATION_TRAIN_VALIDATION)
+        split_schema.append((image, split_of(image)))
 
-        train_images = model_images[:num_train_images]
-        val_images = model_images[num_train_images:]
+    for split in ('train', 'val'):
+        os.makedirs(f'{OUT_IMAGE_PATH}/{split}', exist_ok=True)
+        os.makedirs(f'{OUT_LABEL_PATH}/{split}', exist_ok=True)
 
-        split_schema[model] = {
-            "train": train_images,
-            "val": val_images
-        }
+    start = time.perf_counter()
+    with ThreadPoolExecutor(LINK_THREADS) as executor:
+        written = sum(executor.map(
+            lambda item: materialize_image(*item, args.mode), split_schema))
 
-        total_train_count += len(train_images)
-        total_val_count += len(val_images)
+    total_train_count = sum(1 for _, split in split_schema if split == 'train')
+    total_val_count = len(split_schema) - total_train_count
 
-    for model, split in split_schema.items():
+    print(f"{total_train_count} train and {total_val_count} val images, "
+          f"{written} new or changed and {len(split_schema) - written} unchanged "
+          f"({args.mode}) in {time.perf_counter() - start:.1f} s.")
+    if unlabeled:
+        print(f"{unlabeled} images without a label were skipped.")
 
-        for image in split['train']:
-            shutil.copy(f'{IN_IMAGE_PATH}/{image}',
-                        f'{BASE_DIR}/images/train/{image}')
-            shutil.copy(f'{IN_LABEL_PATH}/{image.replace('.png', '.txt')}',
-                        f'{BASE_DIR}/labels/train/{image.replace('.png', '.txt')}')
 
-        for image in split['val']:
-            shutil.copy(f'./renders/{image}',
-                        f'{BASE_DIR}/images/val/{image}')
-            shutil.copy(f'{IN_LABEL_PATH}/{image.replace('.png', '.txt')}',
-                        f'{BASE_DIR}/labels/val/{image.replace('.png', '.txt')}')
+if __name__ == "__main__":
+    __main__()
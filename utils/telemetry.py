@@ -0,0 +1,184 @@
+import os
+import resource
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import annotation_log
+import atomic_file
+
+METRICS_PATH = 'metrics.prom'
+# per-sample stage timings, one json record per line
+TELEMETRY_LOG = 'telemetry.jsonl'
+# seconds between two metrics files and summaries
+REPORT_INTERVAL = 60
+# finished samples used for the rate and the ETA
+RATE_WINDOW = 50
+
+
+def resident_memory():
+    """
+    Resident set size of the process in bytes, the peak where /proc is not
+    available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (FileNotFoundError, OSError):
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class Telemetry:
+    """
+    Counts the stage time, the rejections and the finished samples of a run.
+    The per-sample records are appended to `log_path`, and every `interval`
+    seconds the metrics are written to `metrics_path` in the Prometheus text
+    format and a summary is printed. `gauges` is called only then and
+    returns [(name, labels, value)] for the values that are costly to read.
+    """
+
+    def __init__(self, metrics_path=METRICS_PATH, log_path=TELEMETRY_LOG,
+                 interval=REPORT_INTERVAL, gauges=None, expected_samples=0):
+        self.metrics_path = metrics_path
+        self.log_path = log_path
+        self.interval = interval
+        self.gauges = gauges
+        self.expected_samples = expected_samples
+
+        self.start_time = time.time()
+        self.last_report = time.perf_counter()
+        self.samples = 0
+        self.rejections = {}
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.finish_times = deque(maxlen=RATE_WINDOW)
+        self.current = {'stages': {}, 'rejections': []}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+            stages = self.current['stages']
+            stages[name] = stages.get(name, 0.0) + elapsed
+
+    def reject(self, reason):
+        self.rejections[reason] = self.rejections.get(reason, 0) + 1
+        self.current['rejections'].append(reason)
+
+    def sample_done(self, file_name):
+        """
+        Closes the current sample: every stage time and rejection since the
+        previous one is attributed to it.
+        """
+        self.samples += 1
+        self.finish_times.append(time.perf_counter())
+
+        record = {'file_name': file_name, 'time': time.time(), **self.current}
+        annotation_log.append_records(self.log_path, [record], fsync=False)
+        self.current = {'stages': {}, 'rejections': []}
+
+        self.report()
+
+    def samples_per_minute(self):
+        if len(self.finish_times) < 2:
+            return 0.0
+        elapsed = self.finish_times[-1] - self.finish_times[0]
+        return (len(self.finish_times) - 1) / elapsed * 60 if elapsed else 0.0
+
+    def eta(self):
+        rate = self.samples_per_minute()
+        remaining = max(self.expected_samples - self.samples, 0)
+        return remaining / rate * 60 if rate else None
+
+    def metrics(self):
+        """
+        (name, type, help, [(labels, value)]) of every metric.
+        """
+        gauges = self.gauges() if self.gauges else []
+        eta = self.eta()
+
+        metrics = [
+            ('render_samples_total', 'counter', 'Samples written.',
+             [({}, self.samples)]),
+            ('render_rejections_total', 'counter', 'Rejected sample attempts by reason.',
+             [({'reason': reason}, count) for reason, count in self.rejections.items()]),
+            ('render_stage_seconds_total', 'counter', 'Seconds spent in every stage.',
+             [({'stage': name}, seconds) for name, seconds in self.stage_seconds.items()]),
+            ('render_stage_calls_total', 'counter', 'Calls of every stage.',
+             [({'stage': name}, calls) for name, calls in self.stage_calls.items()]),
+            ('render_samples_per_minute', 'gauge', f'Rate over the last {RATE_WINDOW} samples.',
+             [({}, self.samples_per_minute())]),
+            ('render_expected_samples', 'gauge', 'Samples this run should write.',
+             [({}, self.expected_samples)]),
+            ('render_eta_seconds', 'gauge', 'Estimated seconds to the end of the run.',
+             [({}, eta)] if eta is not None else []),
+            ('render_start_time_seconds', 'gauge', 'Unix time the run started.',
+             [({}, self.start_time)]),
+            ('process_resident_memory_bytes', 'gauge', 'Resident memory of the process.',
+             [({}, resident_memory())]),
+        ]
+
+        grouped = {}
+        for name, labels, value in gauges:
+            grouped.setdefault(name, []).append((labels, value))
+        for name, values in grouped.items():
+            metrics.append((name, 'gauge', '', values))
+
+        return metrics
+
+    def write_metrics(self):
+        lines = []
+        for name, metric_type, description, values in self.metrics():
+            if description:
+                lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines += [f'{name}{format_labels(labels)} {value}' for labels, value in values]
+
+        # a scraper never reads half a file
+        with atomic_file.atomic_open(self.metrics_path) as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def summary(self):
+        rejected = sum(self.rejections.values())
+        attempts = self.samples + rejected
+        eta = self.eta()
+
+        parts = [
+            f"{self.samples}/{self.expected_samples} samples",
+            f"{self.samples_per_minute():.1f}/min",
+            f"ETA {eta / 60:.1f} min" if eta is not None else "ETA unknown",
+            f"{rejected / attempts if attempts else 0:.0%} rejected",
+            f"RSS {resident_memory() / 2 ** 20:.0f} MB",
+        ]
+        stages = ', '.join(
+            f"{name} {seconds / self.stage_calls[name] * 1000:.0f} ms"
+            for name, seconds in self.stage_seconds.items())
+
+        return f"{', '.join(parts)} | {stages}"
+
+    def report(self, force=False):
+        """
+        Writes the metrics and prints the summary if `interval` seconds have
+        passed since the last time.
+        """
+        now = time.perf_counter()
+        if not force and now - self.last_report < self.interval:
+            return
+
+        self.last_report = now
+        self.write_metrics()
+        print(f"[telemetry] {self.summary()}")
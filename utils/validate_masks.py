@@ -0,0 +1,121 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+import annotation_log
+import atomic_file
+from masks import tight_box
+
+REPORT_PATH = 'mask_report.json'
+# boxes below this IoU with their mask box are reported
+MIN_IOU = 0.9
+# masks loaded by a worker at once
+CHUNK_SIZE = 64
+
+
+def mask_box(mask_path):
+    """
+    Tight box of the mask with the annotation conventions and its pixel
+    count: (min_x, max_x, min_y, max_y, pixels). NaN for an empty mask.
+    """
+    with Image.open(mask_path) as image:
+        mask = np.asarray(image.convert('L')) > 127
+
+    box = tight_box(mask)
+    if box is None:
+        return (np.nan, np.nan, np.nan, np.nan, 0)
+
+    return (*box, int(mask.sum()))
+
+
+def mask_boxes(mask_paths):
+    return [mask_box(mask_path) for mask_path in mask_paths]
+
+
+def box_iou(boxes, other_boxes):
+    """
+    IoU of every row of two (N, 4) arrays of (min_x, max_x, min_y, max_y).
+    """
+    width = np.minimum(boxes[:, 1], other_boxes[:, 1]) - np.maximum(boxes[:, 0], other_boxes[:, 0])
+    height = np.minimum(boxes[:, 3], other_boxes[:, 3]) - np.maximum(boxes[:, 2], other_boxes[:, 2])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+
+    area = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+    other_area = (other_boxes[:, 1] - other_boxes[:, 0]) * (other_boxes[:, 3] - other_boxes[:, 2])
+    union = area + other_area - intersection
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(union > 0, intersection / union, 0.0)
+
+
+def validate(records, workers, min_iou=MIN_IOU):
+    """
+    Compares the box of every record with the tight box of its mask. Returns
+    the report with the records below `min_iou` as outliers, worst first.
+    """
+    records = [record for record in records
+               if 'mask_path' in record and record['min_x'] is not None]
+    mask_paths = [record['mask_path'] for record in records]
+    chunks = [mask_paths[start:start + CHUNK_SIZE]
+              for start in range(0, len(mask_paths), CHUNK_SIZE)]
+
+    with Pool(workers) as pool:
+        measured = np.array([box for chunk in pool.imap(mask_boxes, chunks) for box in chunk],
+                            dtype=np.float64).reshape(-1, 5)
+
+    annotated = np.array([[record['min_x'], record['max_x'], record['min_y'], record['max_y']]
+                          for record in records], dtype=np.float64).reshape(-1, 4)
+    iou = box_iou(annotated, measured[:, :4])
+    empty = measured[:, 4] == 0
+
+    outliers = [
+        {
+            'file_name': records[position]['file_name'],
+            'iou': float(iou[position]),
+            'annotation': annotated[position].tolist(),
+            'mask': None if empty[position] else measured[position, :4].tolist(),
+        }
+        for position in np.argsort(iou)
+        if iou[position] < min_iou
+    ]
+
+    return {
+        'checked': len(records),
+        'empty_masks': int(empty.sum()),
+        'mean_iou': float(iou.mean()) if len(records) else None,
+        'min_iou': min_iou,
+        'outliers': outliers,
+    }
+
+
+def __main__():
+    parser = argparse.ArgumentParser(
+        description='Checks the annotated boxes against the tight boxes of the rendered object masks.')
+    parser.add_argument('logs', nargs='*', default=[annotation_log.LOG_PATH])
+    parser.add_argument('--output', default=REPORT_PATH)
+    parser.add_argument('--min-iou', type=float, default=MIN_IOU)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    records = {}
+    for log_path in args.logs:
+        for record in annotation_log.read_records(log_path):
+            records[record['file_name']] = record
+
+    start = time.perf_counter()
+    report = validate(list(records.values()), args.workers, args.min_iou)
+    elapsed = time.perf_counter() - start
+
+    atomic_file.write_json(args.output, report, indent=4)
+
+    print(f"Checked {report['checked']} masks in {elapsed:.1f} s, mean IoU {report['mean_iou']}, "
+          f"{len(report['outliers'])} below {args.min_iou} and {report['empty_masks']} empty, "
+          f"report in {args.output}.")
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,430 @@
+import argparse
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import annotation_log
+from atomic_file import write_json
+
+QUEUE_PATH = './queue'
+# a lease whose file was not touched for this long is given to another worker,
+# it has to cover the clock skew between the nodes and the longest render of
+# a single frame: blender holds the GIL while it renders, so the heartbeat
+# thread stalls and the leases are only touched between samples and frames
+LEASE_SECONDS = 600
+HEARTBEAT_SECONDS = 30
+# seconds between two looks at the queue while the other workers finish
+POLL_SECONDS = 10
+# samples per task
+CHUNK = 10
+
+
+def worker_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def plan_tasks(models, samples, chunk=CHUNK, background_samples=0):
+    """
+    (task id, task) of every `chunk` samples of every model, and of the
+    background samples rendered by cycles.
+    """
+    tasks = [
+        (f'{model}-{start:06d}',
+         {'kind': 'model', 'model': model, 'start': start, 'end': min(start + chunk, samples)})
+        for model in sorted(models)
+        for start in range(0, samples, chunk)
+    ]
+    tasks += [
+        (f'background-{start:06d}',
+         {'kind': 'background', 'start': start, 'end': min(start + chunk, background_samples)})
+        for start in range(0, background_samples, chunk)
+    ]
+
+    return tasks
+
+
+class WorkQueue:
+    """
+    Task queue in a directory of a shared file system, no other service is
+    needed. Every task is a file in `tasks/`. A worker takes one by creating
+    its lease in `leases/` with a hard link, which fails if the file exists,
+    also over NFS. The worker touches its leases every `heartbeat_seconds`,
+    a lease not touched for `lease_seconds` belongs to a crashed worker and
+    is taken over, see take_over_expired. A finished task gets a marker in
+    `done/`.
+
+    Workers can join or leave at any time, a task taken twice is only
+    rendered twice: the samples are seeded and finished ones are skipped.
+    """
+
+    def __init__(self, path=QUEUE_PATH, worker=None, lease_seconds=LEASE_SECONDS,
+                 heartbeat_seconds=HEARTBEAT_SECONDS):
+        self.path = path
+        self.worker = worker or worker_name()
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+
+        for folder in ('tasks', 'leases', 'done', 'workers'):
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+        # lease token by task id of the tasks this worker holds
+        self.leases = {}
+        # tasks another worker took over while this one worked on them
+        self.lost = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+        self.last_heartbeat = time.time()
+
+    def task_path(self, task_id):
+        return os.path.join(self.path, 'tasks', f'{task_id}.json')
+
+    def lease_path(self, task_id):
+        return os.path.join(self.path, 'leases', f'{task_id}.lease')
+
+    def done_path(self, task_id):
+        return os.path.join(self.path, 'done', f'{task_id}.json')
+
+    def worker_path(self, name):
+        """
+        Path of a file of this worker, every worker writes its own logs.
+        """
+        folder = os.path.join(self.path, 'workers', self.worker)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, name)
+
+    def meta(self):
+        return read_json(os.path.join(self.path, 'queue.json')) or {}
+
+    def create(self, tasks, meta):
+        """
+        Adds the tasks that are not in the queue yet, so creating it again
+        with more models only adds theirs. Returns the number added.
+        """
+        meta_path = os.path.join(self.path, 'queue.json')
+        existing = read_json(meta_path)
+        if existing is not None and existing != meta:
+            raise ValueError(f"{self.path} was created with {existing}, not {meta}.")
+        write_json(meta_path, meta)
+
+        added = 0
+        for task_id, task in tasks:
+            if not os.path.exists(self.task_path(task_id)):
+                write_json(self.task_path(task_id), task)
+                added += 1
+
+        return added
+
+    def task_ids(self):
+        return sorted(os.path.splitext(name)[0]
+                      for name in os.listdir(os.path.join(self.path, 'tasks'))
+                      if name.endswith('.json'))
+
+    def is_done(self, task_id):
+        return os.path.exists(self.done_path(task_id))
+
+    def lease_age(self, task_id):
+        """
+        Seconds since the lease was last touched, None if there is none.
+        """
+        try:
+            return time.time() - os.stat(self.lease_path(task_id)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def take_over_expired(self, task_id):
+        """
+        Removes the lease of the task if it expired. Between reading the
+        lease and renaming it another worker can take the task over, so the
+        renamed file is checked against the lease that was read: the token
+        must be the same and its mtime still expired, otherwise it is put
+        back. Returns True if the expired lease was removed.
+        """
+        lease_path = self.lease_path(task_id)
+        age = self.lease_age(task_id)
+        observed = read_json(lease_path)
+        if age is None or age < self.lease_seconds or observed is None:
+            return False
+
+        stale_path = f'{lease_path}.{uuid.uuid4().hex}.stale'
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return False
+
+        renamed = read_json(stale_path)
+        renamed_age = time.time() - os.stat(stale_path).st_mtime
+        if renamed is None or renamed['token'] != observed['token'] or \
+                renamed_age < self.lease_seconds:
+            # a live lease, fails only if a third worker leased the task meanwhile
+            try:
+                os.link(stale_path, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+
+        os.remove(stale_path)
+        print(f"Lease of {task_id} expired after {age:.0f} s, taking it over.")
+        return True
+
+    def try_lease(self, task_id):
+        """
+        Takes the task if nobody holds it or its lease expired. Returns True
+        if this worker holds it now.
+        """
+        lease_path = self.lease_path(task_id)
+        if os.path.exists(lease_path) and not self.take_over_expired(task_id):
+            return False
+
+        token = uuid.uuid4().hex
+        temporary_path = f'{lease_path}.{token}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({'worker': self.worker, 'token': token, 'time': time.time()}, f)
+        try:
+            os.link(temporary_path, lease_path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temporary_path)
+
+        # done by another worker between the listing and the lease
+        if self.is_done(task_id):
+            os.remove(lease_path)
+            return False
+
+        with self.lock:
+            self.leases[task_id] = token
+        return True
+
+    def holds(self, task_id):
+        lease = read_json(self.lease_path(task_id))
+        return lease is not None and lease['token'] == self.leases.get(task_id)
+
+    def heartbeat(self):
+        """
+        Touches the leases of this worker. Returns the ids of the ones taken
+        over by another worker, see has_lost.
+        """
+        with self.lock:
+            held = [task_id for task_id in self.leases if task_id not in self.lost]
+
+        lost = []
+        for task_id in held:
+            if self.holds(task_id):
+                os.utime(self.lease_path(task_id))
+            else:
+                lost.append(task_id)
+                print(f"Lost the lease of {task_id} to another worker.")
+
+        with self.lock:
+            self.lost.update(lost)
+            self.last_heartbeat = time.time()
+        return lost
+
+    def heartbeat_if_due(self):
+        """
+        Heartbeat from the main loop, between the renders that keep the
+        heartbeat thread waiting for the GIL.
+        """
+        if time.time() - self.last_heartbeat >= self.heartbeat_seconds:
+            self.heartbeat()
+
+    def has_lost(self, task_id):
+        """
+        True once a heartbeat found the task taken over, the worker should
+        stop it and leave it to the new holder.
+        """
+        with self.lock:
+            return task_id in self.lost
+
+    def heartbeat_loop(self):
+        while not self.stopped.wait(self.heartbeat_seconds):
+            self.heartbeat()
+
+    def start_heartbeat(self):
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
+            self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self.stopped.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+        self.stopped.clear()
+
+    def release(self, task_id, done=False):
+        """
+        Gives the task back, or marks it as done first.
+        """
+        if done:
+            write_json(self.done_path(task_id), {'worker': self.worker, 'time': time.time()})
+
+        # a lease taken over by another worker is not ours to remove
+        if self.holds(task_id):
+            try:
+                os.remove(self.lease_path(task_id))
+            except FileNotFoundError:
+                pass
+
+        with self.lock:
+            self.leases.pop(task_id, None)
+            self.lost.discard(task_id)
+
+    def acquire(self):
+        """
+        Leases the first task that is not done and free, returns (task id,
+        task) or None.
+        """
+        for task_id in self.task_ids():
+            if not self.is_done(task_id) and self.try_lease(task_id):
+                return task_id, read_json(self.task_path(task_id))
+
+        return None
+
+    def status(self):
+        counts = {'done': 0, 'leased': 0, 'expired': 0, 'pending': 0}
+        for task_id in self.task_ids():
+            age = self.lease_age(task_id)
+            if self.is_done(task_id):
+                counts['done'] += 1
+            elif age is None:
+                counts['pending'] += 1
+            elif age < self.lease_seconds:
+                counts['leased'] += 1
+            else:
+                counts['expired'] += 1
+
+        return counts
+
+    def is_finished(self):
+        return all(self.is_done(task_id) for task_id in self.task_ids())
+
+    def leased_tasks(self, wait=True):
+        """
+        Yields (task id, task) until every task is done, with the heartbeat
+        running. The task is marked done when the loop asks for the next
+        one, and given back if the loop raises. A task whose lease was lost
+        meanwhile is left to the worker that holds it now, the loop should
+        stop it early, see has_lost. With `wait`, a worker that
+        finds every remaining task leased waits for them, to take over the
+        ones of a crashed worker.
+        """
+        self.start_heartbeat()
+        try:
+            while True:
+                leased = self.acquire()
+                if leased is None:
+                    if not wait or self.is_finished():
+                        return
+                    time.sleep(POLL_SECONDS)
+                    continue
+
+                task_id = leased[0]
+                try:
+                    yield leased
+                except BaseException:
+                    self.release(task_id)
+                    raise
+                if self.has_lost(task_id) or not self.holds(task_id):
+                    print(f"Leaving {task_id} to the worker that took it over.")
+                    self.release(task_id)
+                else:
+                    self.release(task_id, done=True)
+        finally:
+            self.stop_heartbeat()
+
+    def annotation_logs(self):
+        return sorted(glob.glob(os.path.join(self.path, 'workers', '*', 'annotations.jsonl')))
+
+
+def merge_logs(queue, annotations_path):
+    """
+    Appends the annotation logs of every worker to `annotations_path` and
+    removes them. The records already there are skipped, so an interrupted
+    merge can run again. Returns the number of records appended.
+    """
+    merged = 0
+    for log_path in queue.annotation_logs():
+        records = annotation_log.append_new_records(
+            annotations_path, annotation_log.read_records(log_path))
+        os.remove(log_path)
+        merged += len(records)
+
+    return merged
+
+
+def simulate_worker(queue, seconds):
+    """
+    Takes the tasks and finishes them after `seconds` without rendering, to
+    try the queue with several processes.
+    """
+    finished = 0
+    for task_id, task in queue.leased_tasks():
+        print(f"{queue.worker} working on {task_id}")
+        deadline = time.time() + seconds
+        while time.time() < deadline and not queue.has_lost(task_id):
+            time.sleep(min(1.0, seconds))
+        if not queue.has_lost(task_id):
+            finished += 1
+
+    return finished
+
+
+def __main__():
+    parser = argparse.ArgumentParser(
+        description='Creates and inspects the shared work queue of auto_render.py --queue.')
+    parser.add_argument('command', choices=['create', 'status', 'merge', 'simulate'])
+    parser.add_argument('queue', nargs='?', default=QUEUE_PATH)
+    parser.add_argument('--models-path', default='./models')
+    parser.add_argument('--samples', type=int, default=10,
+                        help='samples per model')
+    parser.add_argument('--background-samples', type=int, default=0,
+                        help='background samples rendered by cycles')
+    parser.add_argument('--chunk', type=int, default=CHUNK,
+                        help='samples per task')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='run seed, the workers must use the same one')
+    parser.add_argument('--annotations', default=annotation_log.LOG_PATH,
+                        help='log the worker logs are merged into')
+    parser.add_argument('--lease-seconds', type=float, default=LEASE_SECONDS)
+    parser.add_argument('--seconds', type=float, default=1.0,
+                        help='time a simulated task takes')
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue, lease_seconds=args.lease_seconds,
+                      heartbeat_seconds=min(HEARTBEAT_SECONDS, args.lease_seconds / 4))
+
+    if args.command == 'create':
+        models = [f for f in os.listdir(args.models_path) if f.endswith('.blend')]
+        tasks = plan_tasks(models, args.samples, args.chunk, args.background_samples)
+        added = queue.create(tasks, {'seed': args.seed})
+        print(f"Added {added} of {len(tasks)} tasks to {args.queue}.")
+    elif args.command == 'status':
+        print(', '.join(f'{count} {state}' for state, count in queue.status().items()))
+    elif args.command == 'merge':
+        if not queue.is_finished():
+            print(f"Some tasks are not done yet: {queue.status()}")
+            return
+        merged = merge_logs(queue, args.annotations)
+        print(f"Merged {merged} records into {args.annotations}.")
+    else:
+        finished = simulate_worker(queue, args.seconds)
+        print(f"{queue.worker} finished {finished} tasks.")
+
+
+if __name__ == "__main__":
+    __main__()